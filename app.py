@@ -20,17 +20,34 @@ bot.
 """
 
 # Import libraries
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler, ConversationHandler
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, Update
+from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler, ConversationHandler, TypeHandler
+from telegram.ext.dispatcher import run_async
 from telegram.error import TelegramError, Unauthorized, BadRequest, TimedOut, ChatMigrated, NetworkError
+import asyncio
 import logging
 import time
 import random
 import re
-from functools import wraps
-from firebase_connector import FirebaseConnector
-from argon2 import PasswordHasher
-import quantumrandom
+import threading
+import datetime
+from functools import wraps, partial
+from storage_backend import ClaimResult
+from hash_service import VerificationHashService
+from broadcast_engine import BroadcastEngine
+from outbox import Outbox, QueuedBot
+from dedup import UpdateDeduplicator, SqliteUpdateStore
+from partitioned_dispatcher import PartitionedDispatcher, PartitionSafeConversationHandler
+from multiprocess_webhook import WorkerPool, follow_feed, report_metrics
+from async_firebase_connector import AsyncFirebaseConnector, start_event_loop, stop_event_loop, coroutine_handler
+from cooldown import CooldownTracker
+from hint_scheduler import HintScheduler
+from hint_pool import HINT_ORDER
+from claim_guard import ClaimGuard
+from receipts import ReceiptSigner, RevocationList
+from warm_start import load_snapshot, SnapshotWriter
+import metrics
+from concurrent.futures import TimeoutError as HashTimeoutError
 
 import saved_strings
 import credentials
@@ -41,21 +58,35 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 
 logger = logging.getLogger(__name__)
 
+# Used to report the time-to-first-response after a restart
+START_TIME = time.time()
+
 # Telegram Bot Auth Key
 auth_key = credentials.TELEGRAM_TOKEN
 
-# Initialize FirebaseConnector class
-pb = FirebaseConnector()
-
-ph = PasswordHasher()
+# Storage backend and the services built on it, created by `_init_services` in the processes that handle updates
+# Nothing is started at import time, so that the front process of the multi-process webhook mode only routes updates
+pb = apb = hasher = cooldowns = hint_scheduler = revocations = snapshots = None
 
 # GLOBAL VARS
 TIME_INTERVAL_BETWEEN_HINTS = 3600  # Unit in seconds
-ALL_TOKENS = pb.get_all_tokens()
 MASTER_ID = credentials.MASTER_TOKEN  # Bot owner Telegram ID
 ADMIN_LIST = credentials.ADMIN_LIST
 SUTD_AUTH = credentials.SUTD_AUTH
 
+# Signed claim receipts can be checked by /verify and scripts/verify_receipt.py without any database reads
+# They are only issued if RECEIPT_SECRET is set
+signer = ReceiptSigner(credentials.RECEIPT_SECRET) if credentials.RECEIPT_SECRET else None
+
+# Invalid /claim attempts are throttled per user in memory, before the hash and the Firestore transaction
+claim_guard = ClaimGuard(max_attempts=credentials.CLAIM_MAX_ATTEMPTS, window=credentials.CLAIM_WINDOW,
+                         lockout=credentials.CLAIM_LOCKOUT, max_lockout=credentials.CLAIM_MAX_LOCKOUT)
+
+first_response_reported = False
+
+# Index of this worker process when WEB_WORKERS > 1 (see run_worker), None otherwise
+worker_index = None
+
 PORT = credentials.PORT
 WEBHOOK_URL = credentials.WEBHOOK_URL
 
@@ -68,9 +99,9 @@ def registered_only(func):
     @wraps(func)
     def wrapped(bot, update, *args, **kwargs):
         user_id = update.effective_user.id
-        student_id = pb.get_student_id(user_id)
 
-        if (str(user_id) not in pb.get_current_users()) or (int(student_id) == 0):
+        # Served from the participant cache kept in sync by FirebaseConnector
+        if not pb.is_registered(user_id):
             print(f'Unauthorized access denied for user {user_id}.')
             bot.send_message(
                 chat_id=user_id, text='That command is only available for registered users. Please register first!')
@@ -114,6 +145,82 @@ def _error(bot, update, error):
     logger.warning('Update "%s" caused error "%s"', update, error)
 
 
+def _warm_up(feed=None, write_snapshots=True):
+    """ Warm the caches from the on-disk snapshot, then reconcile them with Firestore. """
+
+    snapshot = load_snapshot(credentials.STATE_SNAPSHOT_FILE)
+
+    # Worker processes follow the listener changes forwarded by the front process instead of attaching their own
+    pb.start(snapshot, listen=feed is None)
+    if feed is not None:
+        threading.Thread(target=follow_feed, args=(feed, pb.listeners()), name='Feed', daemon=True).start()
+
+    if snapshot is not None:
+        cooldowns.load({user_id: participant.get('last_hint') for user_id, participant in snapshot['participants'].items()})
+        logger.info('Serving from state snapshot %.2f seconds after startup', time.time() - START_TIME)
+
+    # Blocks until the Firestore listeners have delivered their first snapshots
+    cooldowns.load(pb.get_last_hint_times())
+    logger.info('Caches synced with Firestore %.2f seconds after startup', time.time() - START_TIME)
+
+    if write_snapshots:
+        snapshots.start()
+
+    if signer is not None:
+        revocations.start()
+
+
+def _report_first_response(bot, update):
+    """ Log the time-to-first-response once after startup. """
+
+    global first_response_reported
+
+    if not first_response_reported:
+        first_response_reported = True
+        logger.info('First update handled %.2f seconds after startup', time.time() - START_TIME)
+
+
+def _report_lockout(bot, update, lockout):
+    """ Log a /claim lockout and notify the admins. """
+
+    user = update.effective_user
+    text = f'{user.first_name} ({user.id}) has been locked out of /claim for {lockout} seconds after too many invalid tokens.'
+
+    logger.warning(text)
+    for admin_id in ADMIN_LIST:
+        bot.send_message(admin_id, text=text)
+
+
+def _announce_hints(bot, released):
+    """ Tell the users who turned on /alerts that new hints have been released. """
+
+    tiers = {}
+    for color, tier in released:
+        tiers.setdefault(tier, []).append(color)
+
+    lines = [f'{HINT_ORDER[tier].split("_")[0].capitalize()} hints for {", ".join(sorted(colors))} tokens'
+             for tier, colors in sorted(tiers.items())]
+    text = 'New hints have been released!\r\n\r\n' + '\r\n'.join(lines) + '\r\n\r\nUse /hint to get one.'
+
+    for user_id in pb.get_hint_alert_users():
+        bot.send_message(int(user_id), text=text)
+
+
+def _run_broadcast(bot, user_id, broadcast_id):
+    """ Send a broadcast and report the delivery counts to the bot owner. """
+
+    with metrics.attributed_to('broadcast'):
+        # BroadcastEngine tracks deliveries itself, so it bypasses the outbox
+        result = BroadcastEngine(getattr(bot, 'direct', bot), pb).run(broadcast_id, pb.get_current_users())
+
+    if result is None:
+        bot.send_message(user_id, text=f'Broadcast {broadcast_id} is already being sent.')
+        return
+
+    bot.send_message(user_id, text=f'Broadcast {broadcast_id} finished.\r\n\r\n'
+                                   f'Delivered: {result["delivered"]}\r\nFailed: {result["failed"]}')
+
+
 # =============================================================================
 # LEVEL 0 COMMANDS
 # =============================================================================
@@ -151,22 +258,27 @@ def help(bot, update):
                  '• /help to display usage help text for the bot.\r\n'
                  '• /register to register as a participant.\r\n'
                  '• /hint to ask the bot for hints.\r\n'
-                 '• /claim <token> to attempt to claim the specified token.')
+                 '• /claim <token> to attempt to claim the specified token.\r\n'
+                 '• /progress to see how many tokens are left (admins also see the top claimants).\r\n'
+                 '• /alerts to turn notifications of newly released hints on or off.')
 
     bot.send_message(chat_id=user_id, text=help_text)
 
     if user_id in ADMIN_LIST:
         admin_text = ('These are the possible admin commands:\r\n\r\n'
-                      '• /verify <hash> to verify a claim\'s hash.')
+                      '• /verify <hash or receipt> to verify a claim\'s hash or receipt.\r\n'
+                      '• /revoke <receipt> to revoke a claim receipt.\r\n'
+                      '• /stats to display per-command latency and Firestore usage.\r\n'
+                      '• /broadcast <message> to send a message to all participants (bot owner only).\r\n'
+                      '• /broadcast resume to resume an interrupted broadcast (bot owner only).')
 
         bot.send_message(chat_id=user_id, text=admin_text)
 
 
 def begin_register(bot, update):
     user_id = update.effective_user.id
-    student_id = pb.get_student_id(user_id)
 
-    if (str(user_id) in pb.get_current_users()) and (int(student_id) != 0):
+    if pb.is_registered(user_id):
         bot.send_message(
             chat_id=user_id, text='You are already registered. There is no need to register again.')
 
@@ -205,11 +317,11 @@ def studentid_input(bot, update):
             chat_id=user_id, text="Please enter a valid student ID.")
 
     else:
-        if int(student_id) in pb.get_all_current_student_id():
-            msg = "Student ID already registered!"
-        else:
-            pb.update_student_id(user_id, int(student_id))
+        # Uniqueness is enforced by a transaction on the student ID, so concurrent registrations cannot both succeed
+        if pb.register_student_id(user_id, int(student_id)):
             msg = f"Successfully registered, {student_id}!"
+        else:
+            msg = "Student ID already registered!"
         bot.send_message(chat_id=user_id, text=msg)
 
         return ConversationHandler.END
@@ -218,26 +330,27 @@ def studentid_input(bot, update):
 @registered_only
 def hint(bot, update):
     user_id = update.effective_user.id
+
+    # Hold requests that arrive before the cooldown table and the token index have been loaded,
+    # but only up to WARM_UP_TIMEOUT so that the partition is not blocked while Firestore is unreachable
+    cooldowns.wait_loaded(credentials.WARM_UP_TIMEOUT)
+    if not pb.wait_ready(credentials.WARM_UP_TIMEOUT):
+        bot.send_message(user_id, text=saved_strings.BOT_STARTING)
+        return
+
     # Get current time
     now = time.time()
-    # Get last_hint_time
-    last_hint_time = pb.get_last_hint_time(user_id)
-    # if last_hint_time is None, get new hint
-    if last_hint_time is None:
-        output_msg = pb.get_hint()
-
-        if output_msg != '':
-            pb.update_last_hint_time(user_id, now)
+    # Get remaining cooldown time (no Firestore reads)
+    remaining = cooldowns.remaining(user_id, now)
 
-    elif (int(now) - int(last_hint_time) >= TIME_INTERVAL_BETWEEN_HINTS):
-        output_msg = pb.get_hint()
+    if remaining == 0:
+        output_msg = pb.get_hint(user_id)
 
         if output_msg != '':
-            pb.update_last_hint_time(user_id, now)
+            cooldowns.record(user_id, now)
 
     else:
-        output_msg = "Please try again in {} seconds.".format(
-            int(last_hint_time) + TIME_INTERVAL_BETWEEN_HINTS - int(time.time()))
+        output_msg = "Please try again in {} seconds.".format(int(remaining))
 
     if output_msg == '':
         bot.send_message(
@@ -247,6 +360,7 @@ def hint(bot, update):
         bot.send_message(user_id, text=output_msg)
 
 
+# Runs in its user's dispatcher partition, so each user's claims are handled in order (see _setup_dispatcher)
 @registered_only
 def claim(bot, update, args=[]):
     user_id = update.effective_user.id
@@ -255,21 +369,53 @@ def claim(bot, update, args=[]):
 
         code = args[0]
 
-        if code not in ALL_TOKENS:
-            bot.send_message(user_id, text=saved_strings.INVALID_CLAIM_1)
+        remaining = claim_guard.remaining(user_id)
 
-        elif code in pb.get_unclaimed_tokens():
+        if remaining > 0:
+            bot.send_message(user_id, text=saved_strings.CLAIM_LOCKED.format(int(remaining) + 1))
 
-            if str(user_id) in pb.get_all_users():
+        # Claims are held until the token index has been reconciled with Firestore
+        elif not pb.wait_synced(credentials.WARM_UP_TIMEOUT):
+            bot.send_message(user_id, text=saved_strings.CLAIM_BUSY)
 
-                # Prevent bot message tampering
-                verification_hash = ph.hash(
-                    str(code) + str(user_id) + str(time.time()) + str(quantumrandom.hex()))
-                pb.claim_token(user_id, code, verification_hash)
+        # Checked against the in-memory token index, so invalid guesses cost no Firestore reads
+        elif not pb.is_token(code):
+            lockout = claim_guard.record_failure(user_id)
+
+            if lockout:
+                bot.send_message(user_id, text=saved_strings.CLAIM_LOCKED.format(lockout))
+                _report_lockout(bot, update, lockout)
+            else:
+                bot.send_message(user_id, text=saved_strings.INVALID_CLAIM_1)
+
+        elif pb.is_unclaimed(code):
+
+            # Prevent bot message tampering
+            try:
+                verification_hash = hasher.hash(code, user_id)
+
+            except HashTimeoutError:
+                bot.send_message(user_id, text=saved_strings.CLAIM_BUSY)
+                return
+
+            # Single transactional check-and-set, so concurrent claims of the same token cannot both succeed
+            result = pb.claim_token_atomic(user_id, code, verification_hash)
+
+            if result is ClaimResult.CLAIMED:
+                proof = f'Your verification hash is:\r\n\r\n{verification_hash}'
+                if signer is not None:
+                    receipt = signer.issue(code, pb.get_token_color(code), user_id)
+                    proof += f'\r\n\r\nYour receipt is:\r\n\r\n{receipt}'
 
                 bot.send_message(user_id, text=saved_strings.VALID_CLAIM)
                 bot.send_message(user_id, text=f'Please keep this message and present it to the House Guardians as proof when collecting your reward. '
-                                               f'Your verification hash is:\r\n\r\n{verification_hash}')
+                                               f'{proof}')
+
+            elif result is ClaimResult.ALREADY_CLAIMED:
+                bot.send_message(user_id, text=saved_strings.INVALID_CLAIM_2)
+
+            else:
+                bot.send_message(user_id, text=saved_strings.INVALID_CLAIM_1)
 
         else:
             bot.send_message(user_id, text=saved_strings.INVALID_CLAIM_2)
@@ -281,7 +427,53 @@ def claim(bot, update, args=[]):
         bot.send_message(user_id, text=saved_strings.INVALID_CLAIM_3)
 
 
-# This is risky since it could go over Telegram's rate limits
+# Served from the aggregate counters updated with every claim, not by scanning the token maps
+# Runs on the event loop, so that its reads (and the leaderboard's name lookups) overlap instead of holding a partition
+@registered_only
+async def progress(bot, update):
+    user_id = update.effective_user.id
+
+    progress = await apb.get_progress(user_id)
+
+    lines = ['Tokens claimed so far:\r\n']
+    for color, counts in progress['colors'].items():
+        lines.append(f'{color.capitalize()}: {counts["claimed"]}/{counts["total"]} claimed '
+                     f'({max(0, counts["total"] - counts["claimed"])} left)')
+
+    claimant = progress['claimant']
+    if claimant and claimant['claimed']:
+        colors = ', '.join(f'{count} {color}' for color, count in sorted(claimant['colors'].items()))
+        lines.append(f'\r\nYou have claimed {claimant["claimed"]} tokens ({colors}).')
+    else:
+        lines.append('\r\nYou have not claimed any tokens yet.')
+
+    bot.send_message(user_id, text='\r\n'.join(lines))
+
+    if user_id in ADMIN_LIST:
+        claimants = await apb.get_leaderboard()
+        names = await asyncio.gather(*(apb.get_name(claimant_id) for claimant_id, count in claimants))
+        leaderboard = [f'{rank}. {name} ({claimant_id}): {count}'
+                       for rank, ((claimant_id, count), name) in enumerate(zip(claimants, names), 1)]
+        bot.send_message(user_id, text='Top claimants:\r\n\r\n' + ('\r\n'.join(leaderboard) or 'No claims yet.'))
+
+
+@registered_only
+def alerts(bot, update):
+    """ Turn notifications of newly released hints on or off. """
+
+    user_id = update.effective_user.id
+
+    enabled = not pb.get_hint_alerts(user_id)
+    pb.set_hint_alerts(user_id, enabled)
+
+    if enabled:
+        bot.send_message(user_id, text='You will be notified when new hints are released. Send /alerts again to stop.')
+    else:
+        bot.send_message(user_id, text='You will no longer be notified when new hints are released.')
+
+
+# Sent through BroadcastEngine to stay within Telegram's rate limits, on its own thread so that a long broadcast
+# does not hold up the dispatcher partition of the bot owner
 @restricted
 def broadcast(bot, update, args=[]):
     """ To broadcast message to everyone. """
@@ -289,14 +481,27 @@ def broadcast(bot, update, args=[]):
     user_id = update.effective_user.id
 
     if user_id == MASTER_ID:
-        msg = ''
-        # TODO: Construct message here
-        all_users = pb.get_current_users()
-        for user in all_users:
-            try:
-                bot.send_message(user, text=msg)
-            except:
-                pass
+
+        if args == ['resume']:
+            broadcast_id = pb.get_unfinished_broadcast()
+
+            if broadcast_id is None:
+                bot.send_message(user_id, text='There is no interrupted broadcast to resume.')
+                return
+
+        elif len(args) > 0:
+            # Keep the original formatting (including line breaks) of the message
+            msg = update.message.text.split(None, 1)[1]
+            broadcast_id = pb.create_broadcast(msg)
+
+        else:
+            bot.send_message(
+                user_id, text='Please enter the message together with the command.\r\n\r\nFormat of message: /broadcast <message>')
+            return
+
+        bot.send_message(user_id, text=f'Broadcast {broadcast_id} started.')
+
+        threading.Thread(target=_run_broadcast, args=(bot, user_id, broadcast_id), name='Broadcast', daemon=True).start()
 
 
 @restricted
@@ -307,13 +512,32 @@ def verify_hash(bot, update, args=[]):
 
         auth_hash = args[0]
 
-        if auth_hash in pb.get_all_hash():
-            name = pb.get_name(user_id)
-            student_id = pb.get_student_id(user_id)
-            bot.send_message(user_id, text=f'Hash exists in database.\r\n\r\nName: {name}\r\nStudent ID: {student_id}')
+        # Receipts are checked locally against their signature and the revocation list, Argon2 hashes contain '$'
+        receipt = signer.verify(auth_hash) if signer is not None and '$' not in auth_hash else None
+
+        if receipt is not None:
+            if revocations.is_revoked(receipt['receipt_id']):
+                bot.send_message(user_id, text='Receipt is authentic but has been revoked.')
+            else:
+                claimant = receipt['claimant']
+                claimed_at = datetime.datetime.fromtimestamp(receipt['claimed_at']).strftime('%Y-%m-%d %H:%M:%S')
+                bot.send_message(user_id, text=f'Receipt is valid.\r\n\r\nName: {pb.get_name(claimant)}\r\n'
+                                               f'Student ID: {pb.get_student_id(claimant)}\r\n'
+                                               f'Token: {receipt["token"]} ({receipt["color"]})\r\nClaimed at: {claimed_at}')
 
         else:
-            bot.send_message(user_id, text='Hash does not exist in database.')
+            verification = pb.get_verification(auth_hash)
+
+            if verification is not None:
+                # Show the claimant's details, not the admin's
+                claimant = verification['claimant']
+                name = pb.get_name(claimant)
+                student_id = pb.get_student_id(claimant)
+                bot.send_message(user_id, text=f'Hash exists in database.\r\n\r\nName: {name}\r\nStudent ID: {student_id}\r\n'
+                                               f'Token: {verification["token"]} ({verification["color"]})')
+
+            else:
+                bot.send_message(user_id, text='Hash does not exist in database.')
 
     elif len(args) == 0:
         bot.send_message(
@@ -324,6 +548,37 @@ def verify_hash(bot, update, args=[]):
             user_id, text='Please provide one hash at a time!\r\n\r\nFormat of message: /verify <hash>')
 
 
+@restricted
+def revoke(bot, update, args=[]):
+    user_id = update.effective_user.id
+
+    receipt = signer.verify(args[0]) if signer is not None and len(args) == 1 else None
+
+    if receipt is not None:
+        revocations.revoke(receipt['receipt_id'], user_id)
+        bot.send_message(user_id, text=f'Receipt for token {receipt["token"]} ({receipt["color"]}) has been revoked.')
+
+    else:
+        bot.send_message(
+            user_id, text='Please provide one valid receipt.\r\n\r\nFormat of message: /revoke <receipt>')
+
+
+@restricted
+def stats(bot, update):
+    user_id = update.effective_user.id
+
+    # Each worker process only knows its own numbers, the metrics path of the webhook covers all of them
+    scope = ''
+    if worker_index is not None:
+        scope = (f'Worker {worker_index + 1} of {credentials.WEB_WORKERS} only, '
+                 f'see {credentials.METRICS_PATH} for all workers\r\n\r\n')
+
+    cache = pb.get_cache_stats()
+    bot.send_message(user_id, text=f'{scope}Uptime: {int(time.time() - START_TIME)} seconds\r\n\r\n{metrics.registry.summary()}\r\n\r\n'
+                                   f'Participant cache: {cache[u"size"]} cached, {cache[u"hits"]} hits, '
+                                   f'{cache[u"misses"]} misses, {cache[u"invalidations"]} invalidations')
+
+
 # =============================================================================
 # OTHER COMMANDS
 # =============================================================================
@@ -348,15 +603,72 @@ def cancel(bot, update):
 # =============================================================================
 
 
-def main():
-    """ Start the bot. """
-    # Create the EventHandler and pass it your bot's token.
-    updater = Updater(auth_key)
+def _init_services():
+    """ Create the storage backend and the services shared by the handlers. """
+
+    global pb, apb, hasher, cooldowns, hint_scheduler, revocations, snapshots
+
+    # Argon2 hashing runs in a process pool so that claims do not block the dispatcher
+    # Created before the storage backend, so that its worker processes are forked before any gRPC threads start
+    hasher = VerificationHashService(workers=credentials.HASH_POOL_SIZE,
+                                     time_cost=credentials.ARGON2_TIME_COST,
+                                     memory_cost=credentials.ARGON2_MEMORY_COST,
+                                     parallelism=credentials.ARGON2_PARALLELISM,
+                                     timeout=credentials.HASH_TIMEOUT)
+
+    # Initialize storage backend (FirebaseConnector unless running offline)
+    # Its caches are warmed in the background by `_warm_up` so that nothing blocks on Firestore here
+    if credentials.STORAGE_BACKEND == 'local':
+        from local_backend import LocalBackend
+        pb = LocalBackend(credentials.LOCAL_DATA_FILE)
+    else:
+        from firebase_connector import FirebaseConnector
+        metrics.instrument_firestore()
+        pb = FirebaseConnector()
+
+    # Participant cache hits, misses and invalidations for /metrics, collected from the unwrapped backend because
+    # InstrumentedConnector records its calls in the registry that is rendering the gauges
+    metrics.registry.add_gauge('hostelhunt_participant_cache', 'stat', pb.get_cache_stats)
+
+    # Time every storage backend call for /metrics and /stats
+    pb = metrics.InstrumentedConnector(pb)
+
+    # Coroutine interface to the same backend for the handlers running on the event loop (see _setup_dispatcher)
+    apb = AsyncFirebaseConnector(pb)
+
+    # /hint cooldowns are checked in memory and `last_hint` is written back to Firestore in batches
+    cooldowns = CooldownTracker(pb, TIME_INTERVAL_BETWEEN_HINTS, flush_interval=credentials.COOLDOWN_FLUSH_INTERVAL)
+    cooldowns.start()
+
+    # Hints with a release time in the future are moved into the hint pool when they are due (see hint_pool.py)
+    hint_scheduler = HintScheduler(pb.token_index)
+
+    revocations = RevocationList(pb, interval=credentials.REVOCATION_SYNC_INTERVAL)
+
+    # Periodically saves the token and participant state to disk to speed up the next cold start
+    snapshots = SnapshotWriter(pb, credentials.STATE_SNAPSHOT_FILE, interval=credentials.SNAPSHOT_INTERVAL)
+
+
+def _setup_dispatcher(updater, announce_hints=True):
+    """ Register the handlers and start the reply and update queues, returns what _stop needs to stop them. """
 
     # Get the dispatcher to register handlers
     dp = updater.dispatcher
 
-    register_conv_handler = ConversationHandler(
+    # Async handlers are scheduled on this loop and return right away
+    loop = start_event_loop()
+
+    # Drop updates that Telegram delivers more than once before any handler runs (group -1 is processed first)
+    dedup_store = None
+    if credentials.UPDATE_DEDUP_STORE == 'firestore':
+        dedup_store = pb
+    elif credentials.UPDATE_DEDUP_STORE == 'sqlite':
+        dedup_store = SqliteUpdateStore(credentials.UPDATE_DEDUP_SQLITE_FILE)
+    dedup = UpdateDeduplicator(ttl=credentials.UPDATE_DEDUP_TTL, store=dedup_store)
+    dp.add_handler(TypeHandler(Update, dedup.check), group=-1)
+
+    # Conversations of different users can be handled at the same time by the dispatcher partitions
+    register_conv_handler = PartitionSafeConversationHandler(
         entry_points=[CommandHandler("register", begin_register)],
 
         states={
@@ -372,8 +684,12 @@ def main():
                    CommandHandler("register", fallback),
                    CommandHandler('hint', fallback),
                    CommandHandler('claim', fallback),
+                   CommandHandler('progress', fallback),
+                   CommandHandler('alerts', fallback),
                    CommandHandler('broadcast', fallback),
-                   CommandHandler('verify', fallback)],
+                   CommandHandler('verify', fallback),
+                   CommandHandler('revoke', fallback),
+                   CommandHandler('stats', fallback)],
 
         per_message=False,
 
@@ -386,18 +702,146 @@ def main():
     dp.add_handler(CommandHandler("start", start))
     dp.add_handler(CommandHandler("help", help))
     dp.add_handler(CommandHandler("hint", hint))
-    dp.add_handler(CommandHandler("claim", claim, pass_args=True))
+    # With dispatcher partitions, claims run in their user's partition: in order for each user, and a slow claim only
+    # delays the users of its own partition. Without them, claims run on the run_async pool so they do not block polling
+    dp.add_handler(CommandHandler("claim", claim if credentials.DISPATCHER_PARTITIONS > 0 else run_async(claim),
+                                  pass_args=True))
+    # Read-only, so it does not need to stay in order with the user's other commands in their partition
+    dp.add_handler(CommandHandler("progress", coroutine_handler(loop)(progress)))
+    dp.add_handler(CommandHandler("alerts", alerts))
 
     # Administrative commands
-    # dp.add_handler(CommandHandler("broadcast", broadcast, pass_args=True))
+    dp.add_handler(CommandHandler("broadcast", broadcast, pass_args=True))
     dp.add_handler(CommandHandler("verify", verify_hash, pass_args=True))
+    dp.add_handler(CommandHandler("revoke", revoke, pass_args=True))
+    dp.add_handler(CommandHandler("stats", stats))
+
+    # Time every command and attribute its Firestore reads/writes and Telegram API calls to it
+    for handler in dp.handlers[0]:
+        if isinstance(handler, ConversationHandler):
+            # Every step of a conversation is attributed to the command that started it
+            command = handler.entry_points[0].command[0]
+            steps = handler.entry_points + handler.fallbacks + [h for hs in handler.states.values() for h in hs]
+            for step in steps:
+                step.callback = metrics.instrument_handler(command, step.callback)
+        else:
+            handler.callback = metrics.instrument_handler(handler.command[0], handler.callback)
+
+    metrics.instrument_bot(updater.bot)
+
+    # Handlers queue their replies and return, consecutive replies of one handler call are coalesced into one message
+    outbox = None
+    if credentials.OUTBOX_WORKERS > 0:
+        outbox = Outbox(updater.bot, workers=credentials.OUTBOX_WORKERS, linger=credentials.OUTBOX_LINGER)
+        outbox.start()
+        dp.bot = QueuedBot(updater.bot, outbox)
+
+    # Release scheduled hints on time; with several worker processes, only one of them announces the releases
+    hint_scheduler.start(partial(_announce_hints, dp.bot) if announce_hints else None)
+
+    # Report the time-to-first-response (runs after the command handlers in group 0)
+    dp.add_handler(TypeHandler(Update, _report_first_response), group=1)
 
     # Log all errors
     dp.add_error_handler(_error)
 
+    # Handle updates on partitions keyed by user ID: in order for each user, in parallel across users
+    partitions = None
+    if credentials.DISPATCHER_PARTITIONS > 0:
+        partitions = PartitionedDispatcher(dp, partitions=credentials.DISPATCHER_PARTITIONS)
+        partitions.install()
+
+    return partitions, outbox, loop
+
+
+def _stop(partitions, outbox, loop, write_snapshot=True):
+    """ Finish the queued updates and replies, then write any pending hint times and a final state snapshot. """
+
+    if partitions is not None:
+        partitions.stop()
+    stop_event_loop(loop)
+    apb.shutdown()
+    hint_scheduler.stop()
+    if outbox is not None:
+        outbox.stop()
+    cooldowns.stop()
+    if write_snapshot:
+        snapshots.stop()
+    revocations.stop()
+
+
+def run_worker(index, updates, feed, reports):
+    """ Handle the updates routed to this worker process by the front process (see multiprocess_webhook.py). """
+
+    global worker_index
+    worker_index = index
+
+    _init_services()
+
+    # The front process serves the metrics of every worker
+    stop_reporting = threading.Event()
+    reporter = threading.Thread(target=report_metrics, args=(reports, stop_reporting), name='Metrics', daemon=True)
+    reporter.start()
+
+    # Only the first worker writes the on-disk state snapshot
+    threading.Thread(target=_warm_up, args=(feed, index == 0), name='WarmUp', daemon=True).start()
+
+    updater = Updater(auth_key)
+    partitions, outbox, loop = _setup_dispatcher(updater, announce_hints=index == 0)
+    threading.Thread(target=updater.dispatcher.start, name='Dispatcher', daemon=True).start()
+
+    for update in iter(updates.get, None):
+        updater.update_queue.put(Update.de_json(update, updater.bot))
+
+    updater.dispatcher.stop()
+    _stop(partitions, outbox, loop, write_snapshot=index == 0)
+
+    stop_reporting.set()
+    reporter.join()
+
+
+def _run_front():
+    """ Bind the webhook and route updates to WEB_WORKERS worker processes, which run the handlers. """
+
+    # Only the Firestore client for the listeners forwarded to the workers, none of the services of _init_services
+    from firebase_connector import FirebaseConnector
+    metrics.instrument_firestore()
+    pool = WorkerPool(credentials.WEB_WORKERS, FirebaseConnector().db)
+    pool.start()
+
+    updater = Updater(auth_key)
+    updater.dispatcher.process_update = pool.submit
+
+    metrics.install_webhook_metrics(credentials.METRICS_PATH)
+    updater.start_webhook(listen='0.0.0.0', port=PORT, url_path=auth_key)
+    updater.bot.set_webhook(WEBHOOK_URL + auth_key)
+
+    updater.idle()
+
+    pool.stop()
+
+
+def main():
+    """ Start the bot. """
+    # The worker processes share the Firestore listeners of the front process, which LocalBackend does not have
+    if credentials.WEB_WORKERS > 1 and credentials.STORAGE_BACKEND != 'local':
+        _run_front()
+        return
+
+    _init_services()
+
+    # Warm the caches in the background so that the webhook is bound right away
+    threading.Thread(target=_warm_up, name='WarmUp', daemon=True).start()
+
+    # Create the EventHandler and pass it your bot's token.
+    updater = Updater(auth_key)
+    partitions, outbox, loop = _setup_dispatcher(updater)
+
     # Start the bot
     # updater.start_polling(timeout=0)
 
+    # Serve Prometheus metrics on GET requests to METRICS_PATH, on the webhook's port
+    metrics.install_webhook_metrics(credentials.METRICS_PATH)
     updater.start_webhook(listen='0.0.0.0', port=PORT, url_path=auth_key)
     updater.bot.set_webhook(WEBHOOK_URL + auth_key)
 
@@ -406,6 +850,8 @@ def main():
     # start_polling() is non-blocking and will stop the bot gracefully.
     updater.idle()
 
+    _stop(partitions, outbox, loop)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,89 @@
+# Asyncio interface to FirebaseConnector
+# google-cloud-firestore 1.x has no async client, so every FirebaseConnector method is exposed as a coroutine
+# that runs the blocking call on a dedicated I/O thread pool. Many concurrent coroutines can therefore overlap
+# their Firestore round trips without tying up the Dispatcher's worker threads
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+import contextvars
+import asyncio
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncFirebaseConnector:
+    def __init__(self, connector=None, max_workers=32):
+        # Share an existing connector (and its caches and listeners) if one is given, its owner starts it
+        if connector is None:
+            from firebase_connector import FirebaseConnector
+            connector = FirebaseConnector()
+            connector.start()
+
+        self.connector = connector
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='AsyncFirebaseConnector')
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not defined on this class
+        attr = getattr(self.connector, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        @wraps(attr)
+        async def method(*args, **kwargs):
+            # Run in the calling task's context, so that reads and writes are attributed to its command in /metrics
+            call = partial(contextvars.copy_context().run, attr, *args, **kwargs)
+            return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+        # Cache the wrapper so that __getattr__ is only called once per method
+        setattr(self, name, method)
+        return method
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+# Event loop that async handlers are scheduled on, running in its own thread next to the Dispatcher
+def start_event_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name='EventLoop', daemon=True).start()
+
+    return loop
+
+
+# Lets the handlers already scheduled on `loop` finish (for at most `timeout` seconds), then stops it
+def stop_event_loop(loop, timeout=10):
+    async def drain():
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+    asyncio.run_coroutine_threadsafe(drain(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def _log_exception(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error('Async handler raised an exception', exc_info=future.exception())
+
+
+# Allows an `async def` handler to be registered with the usual telegram.ext handlers
+# The Dispatcher thread only schedules the coroutine and returns its concurrent.futures.Future right away (timed until
+# it finishes by metrics.instrument_handler), so this cannot be used for ConversationHandler states, which need the
+# handler's return value. Decorators such as registered_only may return None instead of the coroutine
+def coroutine_handler(loop):
+    def decorator(func):
+        @wraps(func)
+        def wrapped(bot, update, *args, **kwargs):
+            coroutine = func(bot, update, *args, **kwargs)
+            if not asyncio.iscoroutine(coroutine):
+                return coroutine
+
+            future = asyncio.run_coroutine_threadsafe(coroutine, loop)
+            future.add_done_callback(_log_exception)
+            return future
+
+        return wrapped
+
+    return decorator
@@ -0,0 +1,148 @@
+# Rate-limited broadcast engine for the /broadcast command
+# Messages are sent by a pool of concurrent senders, throttled by a global and a per-chat token bucket,
+# and progress is checkpointed to Firestore so that an interrupted broadcast can be resumed
+
+from concurrent.futures import ThreadPoolExecutor
+from telegram.error import TelegramError, Unauthorized, BadRequest, TimedOut, NetworkError, RetryAfter
+from rate_limiter import TokenBucket, ChatBuckets
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastEngine:
+    def __init__(self, bot, connector, global_rate=25, per_chat_rate=1, workers=8, max_retries=5, checkpoint_every=50,
+                 lease=60):
+        self.bot = bot
+        self.connector = connector
+        self.lease = lease  # Unit in seconds, how long a run that stopped renewing its lease keeps others from resuming
+        self.workers = workers
+        self.max_retries = max_retries
+        self.checkpoint_every = checkpoint_every
+
+        # Telegram allows roughly 30 messages per second overall and 1 message per second per chat
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_buckets = ChatBuckets(per_chat_rate)
+
+    def _send(self, chat_id, text):
+        # Returns True if the message was delivered, False if it permanently failed
+        backoff = 1
+        for attempt in range(self.max_retries + 1):
+            self.chat_buckets.get(chat_id).acquire()
+            self.global_bucket.acquire()
+
+            try:
+                self.bot.send_message(chat_id=chat_id, text=text)
+                return True
+
+            except RetryAfter as e:
+                logger.warning('Broadcast to %s hit flood control, retrying in %s seconds', chat_id, e.retry_after)
+                time.sleep(e.retry_after)
+
+            # Blocked the bot, deleted account or invalid chat (BadRequest is a subclass of NetworkError)
+            except (Unauthorized, BadRequest) as e:
+                logger.info('Broadcast to %s failed permanently: %s', chat_id, e)
+                return False
+
+            except (TimedOut, NetworkError) as e:
+                logger.warning('Broadcast to %s failed (attempt %d): %s', chat_id, attempt + 1, e)
+                time.sleep(backoff)
+                backoff *= 2
+
+            # e.g. ChatMigrated, which a broadcast to private chats should never get
+            except TelegramError as e:
+                logger.info('Broadcast to %s failed: %s', chat_id, e)
+                return False
+
+        return False
+
+    def run(self, broadcast_id, chat_ids):
+        """ Send the broadcast to every chat that has not received it yet and return the delivery counts,
+        or None if it is already being sent. """
+
+        # Only one run at a time may send a broadcast, otherwise resuming it during a live send would message the
+        # remaining chats twice. The lease is renewed with every checkpoint and released by the last one
+        if not self.connector.acquire_broadcast(broadcast_id, self.lease):
+            return None
+
+        delivered, failed = [], []
+        pending_delivered, pending_failed = [], []
+        lock = threading.Lock()
+
+        def checkpoint(finished=False, release=False):
+            # The pending chats are taken under the lock but written outside of it, so that senders are not held up
+            with lock:
+                batch_delivered, batch_failed = pending_delivered[:], pending_failed[:]
+                pending_delivered.clear()
+                pending_failed.clear()
+
+            try:
+                self.connector.update_broadcast_progress(broadcast_id, batch_delivered, batch_failed, finished,
+                                                         0 if release else time.time() + self.lease)
+
+            except Exception:
+                # Written again with the next checkpoint
+                with lock:
+                    pending_delivered.extend(batch_delivered)
+                    pending_failed.extend(batch_failed)
+                raise
+
+        def send(chat_id):
+            # One recipient failing in an unexpected way must not stop the rest of the broadcast
+            try:
+                ok = self._send(chat_id, broadcast[u'text'])
+
+            except Exception:
+                logger.exception('Unexpected error while broadcasting to %s', chat_id)
+                ok = False
+
+            with lock:
+                (delivered if ok else failed).append(f'{chat_id}')
+                (pending_delivered if ok else pending_failed).append(f'{chat_id}')
+                due = len(pending_delivered) + len(pending_failed) >= self.checkpoint_every
+
+            if due:
+                try:
+                    checkpoint()
+
+                except Exception:
+                    logger.exception('Failed to checkpoint broadcast %s', broadcast_id)
+
+        stopped = threading.Event()
+
+        def heartbeat():
+            # Keeps the lease while no checkpoint is due, e.g. while every sender waits out flood control
+            while not stopped.wait(self.lease / 3):
+                try:
+                    checkpoint()
+
+                except Exception:
+                    logger.exception('Failed to renew the lease of broadcast %s', broadcast_id)
+
+        heartbeat_thread = threading.Thread(target=heartbeat, name='BroadcastLease', daemon=True)
+        heartbeat_thread.start()
+
+        # The last checkpoint is always written, so that resuming an interrupted broadcast skips the chats it reached
+        # It is only marked as finished if every remaining chat was attempted
+        finished = False
+        try:
+            broadcast = self.connector.get_broadcast(broadcast_id)
+            done = set(broadcast[u'delivered']) | set(broadcast[u'failed'])
+            remaining = [chat_id for chat_id in chat_ids if f'{chat_id}' not in done]
+
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(executor.map(send, remaining))
+            finished = True
+
+        finally:
+            stopped.set()
+            heartbeat_thread.join()
+            checkpoint(finished, release=True)
+
+        return {
+            u'delivered': len(broadcast[u'delivered']) + len(delivered),
+            u'failed': len(broadcast[u'failed']) + len(failed),
+            u'skipped': len(chat_ids) - len(remaining)
+        }
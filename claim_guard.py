@@ -0,0 +1,48 @@
+# Per-user throttling of invalid /claim attempts to stop teams from brute-forcing tokens
+# Invalid guesses are counted in a sliding window; going over the limit locks the user out of /claim,
+# for twice as long on every further lockout. Everything is kept in memory, so rejected claims cost no Firestore reads
+
+from collections import deque
+import threading
+import time
+
+
+class ClaimGuard:
+    def __init__(self, max_attempts=5, window=60, lockout=60, max_lockout=3600):
+        self.max_attempts = max_attempts  # Invalid claims allowed per window
+        self.window = window  # Unit in seconds
+        self.lockout = lockout  # Unit in seconds, length of the first lockout
+        self.max_lockout = max_lockout  # Unit in seconds
+
+        self.lock = threading.Lock()
+        self.failures = {}  # user ID -> deque of invalid claim times within the window
+        self.locked_until = {}  # user ID -> end of the current lockout
+        self.lockouts = {}  # user ID -> number of lockouts so far
+
+    def remaining(self, user_id, now=None):
+        # Seconds left until `user_id` may claim again (0 if allowed now)
+        now = now if now is not None else time.time()
+
+        return max(0, self.locked_until.get(f'{user_id}', 0) - now)
+
+    def record_failure(self, user_id, now=None):
+        # Returns the length of the lockout if this invalid claim triggered one, otherwise 0
+        now = now if now is not None else time.time()
+        user_id = f'{user_id}'
+
+        with self.lock:
+            failures = self.failures.setdefault(user_id, deque())
+            failures.append(now)
+            while failures[0] <= now - self.window:
+                failures.popleft()
+
+            if len(failures) <= self.max_attempts:
+                return 0
+
+            failures.clear()
+            lockouts = self.lockouts.get(user_id, 0)
+            self.lockouts[user_id] = lockouts + 1
+            duration = min(self.max_lockout, self.lockout * 2 ** lockouts)
+            self.locked_until[user_id] = now + duration
+
+            return duration
@@ -0,0 +1,74 @@
+# In-memory /hint cooldown table with write-behind persistence of `last_hint`
+# Cooldown checks never touch the storage backend; new `last_hint` values are flushed periodically in batches
+
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CooldownTracker:
+    def __init__(self, connector, interval, flush_interval=30):
+        self.connector = connector
+        self.interval = interval  # Unit in seconds
+        self.flush_interval = flush_interval  # Unit in seconds
+
+        self.lock = threading.Lock()
+        self.next_allowed = {}  # user ID -> timestamp of the next allowed hint
+        self.pending = {}  # user ID -> `last_hint` value not yet written to the storage backend
+        self.loaded = threading.Event()
+
+        self.stop_event = threading.Event()
+        self.flush_thread = threading.Thread(target=self._flush_loop, name='CooldownTracker', daemon=True)
+
+    def load(self, last_hints):
+        # Rehydrate from {user ID: last_hint} as stored in the `participants` collection
+        # Can be called more than once (e.g. from an on-disk snapshot and then from Firestore), the latest time wins
+        with self.lock:
+            for user_id, last_hint in last_hints.items():
+                if last_hint is not None:
+                    next_allowed = float(last_hint) + self.interval
+                    if next_allowed > self.next_allowed.get(f'{user_id}', 0):
+                        self.next_allowed[f'{user_id}'] = next_allowed
+
+        self.loaded.set()
+
+    def wait_loaded(self, timeout=None):
+        return self.loaded.wait(timeout)
+
+    def start(self):
+        self.flush_thread.start()
+
+    def remaining(self, user_id, now):
+        # Seconds left until `user_id` may get another hint (0 if allowed now)
+        return max(0, self.next_allowed.get(f'{user_id}', 0) - now)
+
+    def record(self, user_id, now):
+        with self.lock:
+            self.next_allowed[f'{user_id}'] = now + self.interval
+            self.pending[f'{user_id}'] = now
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        if not pending:
+            return
+
+        try:
+            self.connector.update_last_hint_times(pending)
+
+        except Exception as e:
+            logger.warning('Failed to flush %d hint times: %s', len(pending), e)
+            # Keep the values for the next flush unless they have been superseded in the meantime
+            with self.lock:
+                for user_id, last_hint in pending.items():
+                    self.pending.setdefault(user_id, last_hint)
+
+    def _flush_loop(self):
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def stop(self):
+        self.stop_event.set()
+        self.flush()
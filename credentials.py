@@ -9,3 +9,67 @@ SUTD_AUTH = ast.literal_eval(os.environ['SUTD_AUTH'])
 
 PORT = int(os.environ.get('PORT', '5000'))
 WEBHOOK_URL = os.environ['WEBHOOK_URL']
+
+# Verification hash service tuning (defaults match argon2-cffi's PasswordHasher defaults)
+ARGON2_TIME_COST = int(os.environ.get('ARGON2_TIME_COST', '2'))
+ARGON2_MEMORY_COST = int(os.environ.get('ARGON2_MEMORY_COST', '102400'))  # Unit in KiB
+ARGON2_PARALLELISM = int(os.environ.get('ARGON2_PARALLELISM', '8'))
+HASH_POOL_SIZE = int(os.environ.get('HASH_POOL_SIZE', '2'))
+HASH_TIMEOUT = int(os.environ.get('HASH_TIMEOUT', '10'))  # Unit in seconds
+
+# Storage backend: 'firestore' (default) or 'local' to run offline from a JSON export such as sutd-hostel-hunt-bot.json
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'firestore')
+LOCAL_DATA_FILE = os.environ.get('LOCAL_DATA_FILE', 'sutd-hostel-hunt-bot.json')
+# With FIRESTORE_EMULATOR_HOST set (e.g. 'localhost:8080' for scripts/benchmark.py), Firestore runs against the emulator
+# under the GOOGLE_CLOUD_PROJECT project ID, without any credentials
+FIRESTORE_EMULATOR_HOST = os.environ.get('FIRESTORE_EMULATOR_HOST')
+FIRESTORE_PROJECT = os.environ.get('GOOGLE_CLOUD_PROJECT', 'hostelhunt')
+
+# Hint selection: HINT_POLICY is 'random', 'progressive' (second and third hints unlock every HINT_TIER_INTERVAL seconds
+# after HUNT_START_TIME, a Unix timestamp that must be set with it) or 'balanced' (every colour equally likely)
+# Tokens can also give each hint its own release time (see scripts/token_adder.py), which overrides the policy's
+HINT_POLICY = os.environ.get('HINT_POLICY', 'random')
+HINT_NO_REPEAT = ast.literal_eval(os.environ.get('HINT_NO_REPEAT', 'False'))
+COOLDOWN_FLUSH_INTERVAL = int(os.environ.get('COOLDOWN_FLUSH_INTERVAL', '30'))  # Unit in seconds
+HINT_TIER_INTERVAL = int(os.environ.get('HINT_TIER_INTERVAL', '3600'))  # Unit in seconds
+HUNT_START_TIME = ast.literal_eval(os.environ.get('HUNT_START_TIME', 'None'))
+# Fail at startup rather than unlocking the hint tiers relative to whenever the bot last restarted
+if HINT_POLICY == 'progressive' and HUNT_START_TIME is None:
+    raise ValueError('HUNT_START_TIME must be set when HINT_POLICY is progressive')
+
+# Startup: state snapshot used to warm the caches, how often it is rewritten and how long requests wait for warm-up
+STATE_SNAPSHOT_FILE = os.environ.get('STATE_SNAPSHOT_FILE', 'state_snapshot.json')
+SNAPSHOT_INTERVAL = int(os.environ.get('SNAPSHOT_INTERVAL', '300'))  # Unit in seconds
+WARM_UP_TIMEOUT = int(os.environ.get('WARM_UP_TIMEOUT', '30'))  # Unit in seconds
+
+# Path on the webhook port where Prometheus metrics are served
+METRICS_PATH = os.environ.get('METRICS_PATH', '/metrics')
+
+# Outbound replies: number of sender threads (0 sends replies directly from the handlers) and how long a reply waits
+# to be coalesced with the next reply of the same handler call
+OUTBOX_WORKERS = int(os.environ.get('OUTBOX_WORKERS', '4'))
+OUTBOX_LINGER = float(os.environ.get('OUTBOX_LINGER', '0.05'))  # Unit in seconds
+
+# Duplicate webhook updates are dropped for UPDATE_DEDUP_TTL seconds, optionally across processes through
+# UPDATE_DEDUP_STORE: 'memory' (default, this process only), 'firestore' or 'sqlite' (processes on the same host)
+UPDATE_DEDUP_TTL = int(os.environ.get('UPDATE_DEDUP_TTL', '600'))  # Unit in seconds
+UPDATE_DEDUP_STORE = os.environ.get('UPDATE_DEDUP_STORE', 'memory')
+UPDATE_DEDUP_SQLITE_FILE = os.environ.get('UPDATE_DEDUP_SQLITE_FILE', 'updates.sqlite3')
+
+# Claim throttling: more than CLAIM_MAX_ATTEMPTS invalid tokens within CLAIM_WINDOW seconds locks a user out of /claim
+# for CLAIM_LOCKOUT seconds, doubling on every further lockout up to CLAIM_MAX_LOCKOUT seconds
+CLAIM_MAX_ATTEMPTS = int(os.environ.get('CLAIM_MAX_ATTEMPTS', '5'))
+CLAIM_WINDOW = int(os.environ.get('CLAIM_WINDOW', '60'))  # Unit in seconds
+CLAIM_LOCKOUT = int(os.environ.get('CLAIM_LOCKOUT', '60'))  # Unit in seconds
+CLAIM_MAX_LOCKOUT = int(os.environ.get('CLAIM_MAX_LOCKOUT', '3600'))  # Unit in seconds
+
+# Number of dispatcher partitions handling updates in parallel across users and in order per user
+# (0 handles every update on the Dispatcher's own thread)
+DISPATCHER_PARTITIONS = int(os.environ.get('DISPATCHER_PARTITIONS', '8'))
+
+# Secret used to sign claim receipts (receipts are not issued if unset) and how often revoked receipts are synced
+RECEIPT_SECRET = os.environ.get('RECEIPT_SECRET')
+REVOCATION_SYNC_INTERVAL = int(os.environ.get('REVOCATION_SYNC_INTERVAL', '60'))  # Unit in seconds
+
+# Number of worker processes handling updates (1 handles them in the webhook process, more needs the Firestore backend)
+WEB_WORKERS = int(os.environ.get('WEB_WORKERS', '1'))
@@ -0,0 +1,81 @@
+# Drops webhook updates that Telegram delivers more than once (e.g. when it retries after a slow response)
+# Runs in dispatcher group -1, before any handler, and keeps a bounded set of recently seen update IDs that expire
+# after `ttl` seconds. A shared store can be added so that duplicates are also caught across processes
+
+from collections import OrderedDict
+from telegram.ext import DispatcherHandlerStop
+import threading
+import logging
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SqliteUpdateStore:
+    # Update IDs shared by the processes of one host through an SQLite file
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()  # sqlite3 connections cannot be shared between threads
+
+        with sqlite3.connect(self.path) as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS updates (update_id INTEGER PRIMARY KEY, expire_at REAL)')
+
+    def _connection(self):
+        if not hasattr(self.local, 'connection'):
+            self.local.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+
+        return self.local.connection
+
+    def mark_update_seen(self, update_id, ttl):
+        # Returns True if no other process has seen `update_id` in the last `ttl` seconds
+        now = time.time()
+        connection = self._connection()
+        connection.execute('DELETE FROM updates WHERE expire_at < ?', (now,))
+        cursor = connection.execute('INSERT OR IGNORE INTO updates VALUES (?, ?)', (update_id, now + ttl))
+
+        return cursor.rowcount == 1
+
+
+class UpdateDeduplicator:
+    def __init__(self, ttl=600, max_size=100000, store=None):
+        self.ttl = ttl  # Unit in seconds, Telegram gives up retrying an update well before this
+        self.max_size = max_size
+        self.store = store  # Optional shared store with a `mark_update_seen(update_id, ttl)` method
+
+        self.lock = threading.Lock()
+        self.seen = OrderedDict()  # update ID -> time first seen, oldest first
+        self.duplicates = 0
+
+    def is_duplicate(self, update_id, now=None):
+        now = now if now is not None else time.time()
+
+        with self.lock:
+            while self.seen and (len(self.seen) >= self.max_size or next(iter(self.seen.values())) < now - self.ttl):
+                self.seen.popitem(last=False)
+
+            if update_id in self.seen:
+                self.duplicates += 1
+                return True
+
+            self.seen[update_id] = now
+
+        if self.store is not None:
+            try:
+                if not self.store.mark_update_seen(update_id, self.ttl):
+                    with self.lock:
+                        self.duplicates += 1
+                    return True
+
+            # Better to risk processing a duplicate than to drop updates while the store is unavailable
+            except Exception as e:
+                logger.warning('Failed to check update %s against the shared store: %s', update_id, e)
+
+        return False
+
+    def check(self, bot, update):
+        """ Stop duplicate updates before they reach any handler. """
+
+        if update.update_id is not None and self.is_duplicate(update.update_id):
+            logger.info('Dropped duplicate update %s', update.update_id)
+            raise DispatcherHandlerStop()
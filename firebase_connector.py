@@ -1,125 +1,370 @@
 from google.cloud import firestore
+from google.api_core.exceptions import AlreadyExists
+from google.auth.credentials import AnonymousCredentials
 import credentials
 import fnmatch
 import datetime
-import secrets
+import threading
+import hashlib
+import time
+from token_index import TokenIndex
+from hint_pool import HintPool
+from storage_backend import StorageBackend, ClaimResult, MAX_BATCH_SIZE
+
+
+# Argon2 hashes may contain '/', which is not allowed in document IDs, so verifications are keyed by a digest of the hash
+def _verification_key(verification_hash):
+    return hashlib.sha256(f'{verification_hash}'.encode('utf-8')).hexdigest()
+
+
+# Check and set the token's `claimed` flag within a single transaction so that two teams can never claim the same token
+# The `verifications` entry for the hash and the `progress` and `claimants` counters are written in the same commit,
+# so /verify and /progress only need single document reads
+# Firestore retries this function automatically if the colour document changes before the commit
+@firestore.transactional
+def _claim_in_transaction(transaction, color_ref, verification_ref, progress_ref, claimant_ref, user_id, token,
+                          verification_hash):
+    value = (color_ref.get(transaction=transaction).to_dict() or {}).get(token)
+
+    if value is None:
+        return ClaimResult.UNKNOWN
+
+    if value['claimed'] == True:
+        return ClaimResult.ALREADY_CLAIMED
+
+    transaction.set(color_ref, {
+        f'{token}': {
+            u'claimant': f'{user_id}',
+            u'claimed': True,
+            u'hash': f'{verification_hash}'
+        }
+    }, merge=True)
+    transaction.set(verification_ref, {
+        u'hash': f'{verification_hash}',
+        u'token': f'{token}',
+        u'color': color_ref.id,
+        u'claimant': f'{user_id}',
+        u'claimed_at': firestore.SERVER_TIMESTAMP
+    })
+    transaction.set(progress_ref, {u'claimed': firestore.Increment(1)}, merge=True)
+    transaction.set(claimant_ref, {
+        u'claimed': firestore.Increment(1),
+        u'colors': {color_ref.id: firestore.Increment(1)},
+        u'last_claimed_at': firestore.SERVER_TIMESTAMP
+    }, merge=True)
+
+    return ClaimResult.CLAIMED
+
+
+# Reserve `student_id` for `user_id` in the `student_ids` uniqueness index and record it on the participant in one commit
+# Returns False if the student ID already belongs to someone else, so concurrent registrations cannot both succeed
+@firestore.transactional
+def _register_in_transaction(transaction, student_id_ref, participant_ref, user_id, student_id):
+    snapshot = student_id_ref.get(transaction=transaction)
+
+    if snapshot.exists:
+        return snapshot.to_dict()[u'user_id'] == f'{user_id}'
+
+    transaction.create(student_id_ref, {u'user_id': f'{user_id}'})
+    transaction.set(participant_ref, {u'student_id': student_id}, merge=True)
+
+    return True
+
+
+# Take the lease on a broadcast for `lease` seconds, unless it is finished or another run holds an unexpired lease
+@firestore.transactional
+def _acquire_broadcast_in_transaction(transaction, broadcast_ref, lease):
+    broadcast = broadcast_ref.get(transaction=transaction).to_dict()
+
+    if broadcast is None or broadcast[u'done'] or broadcast.get(u'running_until', 0) > time.time():
+        return False
+
+    transaction.update(broadcast_ref, {u'running_until': time.time() + lease})
+
+    return True
+
+
+# Page through a collection in document ID order with query cursors, so that only one page is held in memory at a time
+# and no single query runs long enough to hit the stream deadline on large collections
+def iter_documents(db, collection, page_size=MAX_BATCH_SIZE):
+    query = db.collection(collection).order_by(u'__name__').limit(page_size)
+    last = None
+
+    while True:
+        page = list((query.start_after(last) if last is not None else query).stream())
+        yield from page
+
+        if len(page) < page_size:
+            return
+        last = page[-1]
 
 
 # We use Cloud Firestore instead of Realtime Database since Firestore supports more query flexibility (better arrays!)
 # Read more here: https://firebase.googleblog.com/2018/08/better-arrays-in-cloud-firestore.html
 # We do not use asyncio since coroutines take too much time and threads require many event loops (we need numerous functions and for our current scale, it should be fine)
-class FirebaseConnector:
+# Handlers that run on an event loop use the asyncio interface on top of this class in async_firebase_connector.py
+class FirebaseConnector(StorageBackend):
     def __init__(self):
-        # Establish Firestore Client connection
-        self.db = firestore.Client()
+        # Establish Firestore Client connection (the emulator does not check credentials)
+        if credentials.FIRESTORE_EMULATOR_HOST:
+            self.db = firestore.Client(project=credentials.FIRESTORE_PROJECT, credentials=AnonymousCredentials())
+        else:
+            self.db = firestore.Client()
+
+        # Local mirror of the `participants` collection, keyed by user ID (as a string)
+        # Kept up to date by a Firestore listener so that authorization checks do not need any reads
+        self.participants = {}
+        self.participants_lock = threading.Lock()
+        self.participants_synced = threading.Event()
+        self.cache_stats = {u'hits': 0, u'misses': 0, u'invalidations': 0}
+        # Local mirror of registered student IDs (student ID -> user ID), derived from the same listener
+        self.student_ids = {}
+        self.participants_watch = None
+
+        # Materialized view of the `tokens` collection, built from the first snapshot and then updated incrementally
+        self.token_index = TokenIndex(HintPool(credentials.HINT_POLICY, credentials.HINT_NO_REPEAT,
+                                               credentials.HINT_TIER_INTERVAL, credentials.HUNT_START_TIME))
+        self.tokens_watch = None
+
+    def start(self, snapshot=None, listen=True):
+        # Serve from an on-disk snapshot (see warm_start.py) until the listeners have delivered their first snapshots,
+        # which then reconcile the caches with Firestore
+        # With `listen=False` the listener callbacks are driven by someone else (see multiprocess_webhook.py)
+        if snapshot is not None:
+            self.token_index.load(snapshot[u'tokens'])
+            with self.participants_lock:
+                for user_id, participant in snapshot[u'participants'].items():
+                    self._set_participant(user_id, participant)
+
+        if listen:
+            self.participants_watch = self.db.collection(u'participants').on_snapshot(self._on_participants_snapshot)
+            self.tokens_watch = self.db.collection(u'tokens').on_snapshot(self.token_index.on_snapshot)
+
+    def listeners(self):
+        # Listener callbacks by collection
+        return {u'participants': self._on_participants_snapshot, u'tokens': self.token_index.on_snapshot}
+
+    def wait_ready(self, timeout=None):
+        # Token lookups wait for the on-disk snapshot or the first listener snapshot, but never longer than
+        # WARM_UP_TIMEOUT, so that requests cannot block forever while Firestore is unreachable
+        return self.token_index.wait_ready(credentials.WARM_UP_TIMEOUT if timeout is None else timeout)
+
+    def wait_synced(self, timeout=None):
+        return self.participants_synced.wait(timeout) and self.token_index.wait_synced(timeout)
+
+    def export_snapshot(self):
+        with self.participants_lock:
+            participants = {user_id: dict(participant) for user_id, participant in self.participants.items()}
+
+        return {u'participants': participants, u'tokens': self.token_index.export()}
+
+    def _set_participant(self, user_id, participant):
+        # Must be called with `participants_lock` held; `participant` is None to remove the entry
+        old_participant = self.participants.get(user_id)
+        if old_participant is not None and int(old_participant.get(u'student_id', 0)) != 0:
+            self.student_ids.pop(int(old_participant[u'student_id']), None)
+
+        if participant is None:
+            self.participants.pop(user_id, None)
+        else:
+            self.participants[user_id] = participant
+            if int(participant.get(u'student_id', 0)) != 0:
+                self.student_ids[int(participant[u'student_id'])] = user_id
+
+    def _on_participants_snapshot(self, docs, changes, read_time):
+        # Runs on the listener's background thread; the first call delivers every document as ADDED
+        with self.participants_lock:
+            if not self.participants_synced.is_set():
+                # Drop entries from the on-disk snapshot that no longer exist in Firestore
+                for user_id in self.participants.keys() - {doc.id for doc in docs}:
+                    self._set_participant(user_id, None)
+
+            for change in changes:
+                user_id = change.document.id
+                if user_id in self.participants:
+                    self.cache_stats[u'invalidations'] += 1
+
+                if change.type.name == 'REMOVED':
+                    self._set_participant(user_id, None)
+                else:
+                    self._set_participant(user_id, change.document.to_dict())
+
+        self.participants_synced.set()
+
+    def _get_participant(self, user_id):
+        user_id = f'{user_id}'
+
+        with self.participants_lock:
+            participant = self.participants.get(user_id)
+            # Once the listener has delivered its first snapshot the cache holds every participant, so a user that is
+            # not in it is not registered and needs no read (our own add_user writes through to the cache)
+            if participant is not None or self.participants_synced.is_set():
+                self.cache_stats[u'hits'] += 1
+                return participant
+            self.cache_stats[u'misses'] += 1
+
+        # Fall back to a single document read before the listener has delivered its first snapshot
+        participant = self.db.collection(u'participants').document(user_id).get().to_dict()
+        if participant is not None:
+            with self.participants_lock:
+                self.participants.setdefault(user_id, participant)
+
+        return participant
+
+    def _update_participant(self, user_id, fields):
+        # Write-through so that our own writes are visible before the listener echoes them back
+        # Entries that are not cached yet are filled in by the listener instead
+        with self.participants_lock:
+            participant = self.participants.get(f'{user_id}')
+            if participant is not None:
+                participant.update(fields)
+
+    def is_registered(self, user_id):
+        participant = self._get_participant(user_id)
+
+        return participant is not None and int(participant.get(u'student_id', 0)) != 0
+
+    def get_cache_stats(self):
+        with self.participants_lock:
+            return dict(self.cache_stats, size=len(self.participants))
 
     def get_all_tokens(self):
-        tokens = []
-        colors = self.db.collection(u'tokens').stream()
-        for color in colors:
-            tokens.extend(list(color.to_dict().keys()))
+        self.wait_ready()
+
+        return self.token_index.all_tokens()
+
+    def is_token(self, token):
+        self.wait_ready()
+
+        return self.token_index.is_token(token)
+
+    def is_unclaimed(self, token):
+        self.wait_ready()
 
-        return tokens
+        return self.token_index.is_unclaimed(token)
 
     def get_current_users(self):
-        current_users = self.db.collection(u'participants').stream()
+        current_users = iter_documents(self.db, u'participants')
 
         return [user.id for user in current_users]
 
     def add_user(self, user_id, first_name):
-        self.db.collection(u'participants').document(f'{user_id}').set({
+        participant = {
             u'last_hint': None,
             u'name': f'{first_name}',
             u'student_id': 0
-        })
+        }
+        self.db.collection(u'participants').document(f'{user_id}').set(participant)
+
+        with self.participants_lock:
+            self.participants[f'{user_id}'] = dict(participant)
     
     def get_name(self, user_id):
-        user = self.db.collection(u'participants').document(f'{user_id}')
+        participant = self._get_participant(user_id)
 
-        try:
-            return user.get().to_dict()['name']
-            
-        except TypeError as e:
-            if len(e.args) > 0 and e.args[0] == "'NoneType' object is not subscriptable":
-                return 0
-            else:
-                raise e
+        if participant is None:
+            return 0
+
+        return participant['name']
 
     def get_all_current_student_id(self):
         student_ids = []
-        current_users = self.db.collection(u'participants').stream()
+        current_users = iter_documents(self.db, u'participants')
         for user in current_users:
             student_ids.append(user.to_dict()['student_id'])
 
         return student_ids
 
     def get_student_id(self, user_id):
-        user = self.db.collection(u'participants').document(f'{user_id}')
+        participant = self._get_participant(user_id)
 
-        try:
-            return user.get().to_dict()['student_id']
-            
-        except TypeError as e:
-            if len(e.args) > 0 and e.args[0] == "'NoneType' object is not subscriptable":
-                return 0
-            else:
-                raise e
-        
+        if participant is None:
+            return 0
+
+        return participant['student_id']
 
     def update_student_id(self, user_id, student_id):
         self.db.collection(u'participants').document(
             f'{user_id}').set({u'student_id': student_id}, merge=True)
+        self._update_participant(user_id, {u'student_id': student_id})
+
+    def register_student_id(self, user_id, student_id):
+        # Reject known duplicates locally, otherwise let the transaction on `student_ids/{student_id}` decide
+        owner = self.student_ids.get(int(student_id))
+        if owner is not None and owner != f'{user_id}':
+            return False
+
+        student_id_ref = self.db.collection(u'student_ids').document(f'{student_id}')
+        participant_ref = self.db.collection(u'participants').document(f'{user_id}')
+        registered = _register_in_transaction(self.db.transaction(), student_id_ref, participant_ref, user_id, student_id)
+
+        if registered:
+            with self.participants_lock:
+                self.student_ids[int(student_id)] = f'{user_id}'
+            self._update_participant(user_id, {u'student_id': student_id})
+
+        return registered
 
     def get_last_hint_time(self, user_id):
-        user = self.db.collection(u'participants').document(f'{user_id}')
+        return self._get_participant(user_id)['last_hint']
+
+    def get_hint(self, user_id=None):
+        self.wait_ready()
 
-        return user.get().to_dict()['last_hint']
+        # Select an unclaimed hint according to HINT_POLICY, or '' if there are none left
+        return self.token_index.random_hint(user_id)
 
-    def get_hint(self):
-        tokens = []
-        colors = self.db.collection(u'tokens').stream()
-        for color in colors:
-            tokens.append(color.to_dict())
+    def update_last_hint_time(self, user_id, last_hint):
+        self.db.collection(u'participants').document(
+            f'{user_id}').set({u'last_hint': last_hint}, merge=True)
+        self._update_participant(user_id, {u'last_hint': last_hint})
 
-        unclaimed_hints = []
-        for color in tokens:
-            for token, value in color.items():
-                if value['claimed'] == False:
-                    for order in ['first_hint', 'second_hint', 'third_hint']:
-                        unclaimed_hints.append(value[order])
+    def get_last_hint_times(self):
+        # Served from the participant cache once the listener has synced (used to rehydrate the cooldown table)
+        self.participants_synced.wait()
 
-        try:
-            # Select a random unclaimed hint
-            return secrets.choice(unclaimed_hints)
+        with self.participants_lock:
+            return {user_id: participant.get(u'last_hint') for user_id, participant in self.participants.items()}
 
-        # Catch specific error
-        except IndexError as e:
-            if len(e.args) > 0 and e.args[0] == 'Cannot choose from an empty sequence':
-                return ''
-            else:
-                raise e
+    def update_last_hint_times(self, last_hints):
+        # Write-behind flush of {user ID: last_hint} using batched writes
+        items = list(last_hints.items())
+        for i in range(0, len(items), MAX_BATCH_SIZE):
+            batch = self.db.batch()
+            for user_id, last_hint in items[i:i + MAX_BATCH_SIZE]:
+                batch.set(self.db.collection(u'participants').document(f'{user_id}'), {u'last_hint': last_hint},
+                          merge=True)
+            batch.commit()
+
+        for user_id, last_hint in items:
+            self._update_participant(user_id, {u'last_hint': last_hint})
 
-    def update_last_hint_time(self, user_id, time):
+    def get_hint_alerts(self, user_id):
+        participant = self._get_participant(user_id)
+
+        return participant is not None and participant.get(u'hint_alerts') == True
+
+    def set_hint_alerts(self, user_id, enabled):
         self.db.collection(u'participants').document(
-            f'{user_id}').set({u'last_hint': time}, merge=True)
+            f'{user_id}').set({u'hint_alerts': enabled}, merge=True)
+        self._update_participant(user_id, {u'hint_alerts': enabled})
 
-    def get_unclaimed_tokens(self):
-        tokens = []
-        colors = self.db.collection(u'tokens').stream()
-        for color in colors:
-            tokens.append(color.to_dict())
+    def get_hint_alert_users(self):
+        # Served from the participant cache, so announcing a hint release costs no reads
+        self.participants_synced.wait()
 
-        unclaimed_tokens = []
-        for color in tokens:
-            for token, value in color.items():
-                if value['claimed'] == False:
-                    unclaimed_tokens.append(token)
+        with self.participants_lock:
+            return [user_id for user_id, participant in self.participants.items()
+                    if participant.get(u'hint_alerts') == True]
 
-        return unclaimed_tokens
+    def get_unclaimed_tokens(self):
+        self.wait_ready()
+
+        return self.token_index.unclaimed_tokens()
 
     def get_all_users(self):
         all_users = []
-        users = self.db.collection(u'participants').stream()
+        users = iter_documents(self.db, u'participants')
 
         for user in users:
             all_users.append(user.id)
@@ -127,27 +372,144 @@ class FirebaseConnector:
         return all_users
 
     def claim_token(self, user_id, token, verification_hash):
-        color = self.db.collection(u'tokens').where(
-            f'`{token}`.`claimed`', '==', False).stream()
-        color = [i.id for i in color][0]
-        self.db.collection(u'tokens').document(f'{color}').set({
-            f'{token}': {
-                u'claimant': f'{user_id}',
-                u'claimed': True,
-                u'hash': f'{verification_hash}'
-            }
-        }, merge=True)
+        self.claim_token_atomic(user_id, token, verification_hash)
+
+    def claim_token_atomic(self, user_id, token, verification_hash):
+        self.wait_ready()
+
+        # The colour comes from the local index, so there is no query before the transaction
+        color = self.token_index.get_color(token)
+        if color is None:
+            return ClaimResult.UNKNOWN
+
+        color_ref = self.db.collection(u'tokens').document(f'{color}')
+        verification_ref = self.db.collection(u'verifications').document(_verification_key(verification_hash))
+        progress_ref = self.db.collection(u'progress').document(f'{color}')
+        claimant_ref = self.db.collection(u'claimants').document(f'{user_id}')
+        result = _claim_in_transaction(self.db.transaction(), color_ref, verification_ref, progress_ref, claimant_ref,
+                                       user_id, token, verification_hash)
+
+        if result is ClaimResult.CLAIMED:
+            self.token_index.mark_claimed(token, user_id, verification_hash)
+
+        return result
 
     def get_all_hash(self):
-        tokens = []
-        colors = self.db.collection(u'tokens').stream()
-        for color in colors:
-            tokens.append(color.to_dict())
-
-        hashes = []
-        for color in tokens:
-            for token, value in color.items():
-                if value['claimed'] == True:
-                    hashes.append(value['hash'])
-
-        return hashes
+        self.wait_ready()
+
+        return self.token_index.all_hashes()
+
+    def get_hash_claim(self, verification_hash):
+        # Returns (token, claimant) for a claimed token's verification hash, or None
+        self.wait_ready()
+
+        return self.token_index.get_hash_claim(verification_hash)
+
+    def get_token_color(self, token):
+        self.wait_ready()
+
+        return self.token_index.get_color(token)
+
+    def get_verification(self, verification_hash):
+        # Returns {hash, token, color, claimant, claimed_at} for a claimed token's verification hash, or None
+        verification = self.db.collection(u'verifications').document(_verification_key(verification_hash)).get().to_dict()
+
+        # Claims made before the `verifications` collection existed are only recorded in the token maps
+        if verification is None:
+            claim = self.get_hash_claim(verification_hash)
+            if claim is not None:
+                token, claimant = claim
+                verification = {u'hash': verification_hash, u'token': token, u'color': self.token_index.get_color(token),
+                                u'claimant': claimant, u'claimed_at': None}
+
+        return verification
+
+    def get_progress(self, user_id=None):
+        # Returns {colors: {colour: {claimed, total}}, claimant: {claimed, colors} or None} from the aggregate counters
+        # maintained by claim_token_atomic and scripts/token_adder.py, fetched in a single round trip
+        self.wait_ready()
+
+        refs = [self.db.collection(u'progress').document(f'{color}') for color in self.token_index.all_colors()]
+        if user_id is not None:
+            refs.append(self.db.collection(u'claimants').document(f'{user_id}'))
+
+        progress = {u'colors': {}, u'claimant': None}
+        for snapshot in self.db.get_all(refs):
+            value = snapshot.to_dict() or {}
+            if snapshot.reference.parent.id == u'claimants':
+                progress[u'claimant'] = {u'claimed': value.get(u'claimed', 0), u'colors': value.get(u'colors', {})}
+            else:
+                progress[u'colors'][snapshot.id] = {u'claimed': value.get(u'claimed', 0), u'total': value.get(u'total', 0)}
+
+        return progress
+
+    def get_leaderboard(self, limit=10):
+        # Returns [(user ID, number of tokens claimed), ...] for the top `limit` claimants
+        claimants = self.db.collection(u'claimants').order_by(
+            u'claimed', direction=firestore.Query.DESCENDING).limit(limit).stream()
+
+        return [(claimant.id, claimant.to_dict()[u'claimed']) for claimant in claimants]
+
+    def create_broadcast(self, text):
+        broadcast = self.db.collection(u'broadcasts').document()
+        broadcast.set({
+            u'text': text,
+            u'created': firestore.SERVER_TIMESTAMP,
+            u'done': False,
+            u'running_until': 0,
+            u'delivered': [],
+            u'failed': []
+        })
+
+        return broadcast.id
+
+    def get_broadcast(self, broadcast_id):
+        return self.db.collection(u'broadcasts').document(f'{broadcast_id}').get().to_dict()
+
+    def get_unfinished_broadcast(self):
+        # The oldest unfinished broadcast that is not being sent right now (see acquire_broadcast)
+        # Sorted here rather than with order_by, which would need a composite index with the `done` filter
+        oldest = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+        broadcasts = sorted(self.db.collection(u'broadcasts').where(u'done', '==', False).stream(),
+                            key=lambda broadcast: broadcast.to_dict().get(u'created') or oldest)
+
+        for broadcast in broadcasts:
+            if (broadcast.to_dict().get(u'running_until') or 0) <= time.time():
+                return broadcast.id
+
+        return None
+
+    def acquire_broadcast(self, broadcast_id, lease):
+        broadcast_ref = self.db.collection(u'broadcasts').document(f'{broadcast_id}')
+
+        return _acquire_broadcast_in_transaction(self.db.transaction(), broadcast_ref, lease)
+
+    def update_broadcast_progress(self, broadcast_id, delivered, failed, done=False, running_until=0):
+        self.db.collection(u'broadcasts').document(f'{broadcast_id}').set({
+            u'delivered': firestore.ArrayUnion(delivered),
+            u'failed': firestore.ArrayUnion(failed),
+            u'done': done,
+            u'running_until': running_until
+        }, merge=True)
+
+    def revoke_receipt(self, receipt_id, revoked_by):
+        self.db.collection(u'revoked_receipts').document(f'{receipt_id}').set({
+            u'revoked_by': f'{revoked_by}',
+            u'revoked_at': firestore.SERVER_TIMESTAMP
+        })
+
+    def get_revoked_receipts(self):
+        return [receipt.id for receipt in self.db.collection(u'revoked_receipts').stream()]
+
+    def mark_update_seen(self, update_id, ttl):
+        # Returns True if no other process has seen `update_id`, create() fails if the document already exists
+        # `expire_at` can be used as the collection's TTL field so that Firestore deletes old entries
+        try:
+            self.db.collection(u'updates').document(f'{update_id}').create({
+                u'seen_at': firestore.SERVER_TIMESTAMP,
+                u'expire_at': datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)
+            })
+            return True
+
+        except AlreadyExists:
+            return False
@@ -0,0 +1,92 @@
+# Verification hash service used by /claim
+# Argon2 hashing runs in a separate process pool and the quantum entropy is pre-fetched in the background,
+# so that a burst of claims does not queue behind CPU-heavy hashing or the external ANU API
+
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from argon2 import PasswordHasher
+import quantumrandom
+import threading
+import logging
+import secrets
+import time
+
+logger = logging.getLogger(__name__)
+
+# Set in each worker process by `_init_worker`
+_hasher = None
+
+
+def _init_worker(time_cost, memory_cost, parallelism):
+    global _hasher
+    _hasher = PasswordHasher(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism)
+
+
+def _hash(data):
+    return _hasher.hash(data)
+
+
+class EntropyBuffer:
+    def __init__(self, size=256, block_size=32, refill_interval=30):
+        self.size = size
+        self.block_size = block_size
+        self.refill_interval = refill_interval
+        self.buffer = deque(maxlen=size)
+        self.stats = {u'quantum': 0, u'fallback': 0}
+        self.refill_needed = threading.Event()
+
+        self.refill_thread = threading.Thread(target=self._refill_loop, name='EntropyBuffer', daemon=True)
+        self.refill_thread.start()
+
+    def _refill_loop(self):
+        while True:
+            try:
+                missing = self.size - len(self.buffer)
+                if missing > 0:
+                    # A single API call returns `missing` blocks of entropy (the API caps this at 1024)
+                    blocks = quantumrandom.get_data('hex16', min(missing, quantumrandom.MAX_LEN), self.block_size)
+                    self.buffer.extend(blocks)
+
+            except Exception as e:
+                logger.warning('Failed to refill entropy buffer: %s', e)
+                # Back off instead of retrying on every claim while the API is unreachable
+                time.sleep(self.refill_interval)
+
+            self.refill_needed.wait(self.refill_interval)
+            self.refill_needed.clear()
+
+    def take(self):
+        try:
+            entropy = self.buffer.popleft()
+            self.stats[u'quantum'] += 1
+
+        # Never block a claim on the external API
+        except IndexError:
+            entropy = secrets.token_hex(self.block_size)
+            self.stats[u'fallback'] += 1
+
+        if len(self.buffer) < self.size // 4:
+            self.refill_needed.set()
+
+        return entropy
+
+
+class VerificationHashService:
+    def __init__(self, workers=2, time_cost=2, memory_cost=102400, parallelism=8, timeout=10, entropy_buffer_size=256):
+        self.timeout = timeout
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                        initargs=(time_cost, memory_cost, parallelism))
+        # The pool only forks its workers on the first submit, which must happen before this process starts any
+        # threads: forking after the Firestore client's gRPC threads are running can deadlock the workers
+        self.pool.submit(int).result()
+
+        self.entropy = EntropyBuffer(size=entropy_buffer_size)
+
+    def hash(self, token, user_id):
+        data = str(token) + str(user_id) + str(time.time()) + str(self.entropy.take())
+
+        # Raises `concurrent.futures.TimeoutError` if the pool is saturated for longer than `timeout` seconds
+        return self.pool.submit(_hash, data).result(timeout=self.timeout)
+
+    def shutdown(self):
+        self.pool.shutdown()
@@ -0,0 +1,154 @@
+# Pool of hints for unclaimed tokens, kept in sync by TokenIndex as tokens are claimed
+# Hints are stored in one array per (colour, tier) and removed by swapping with the last element,
+# so adding, removing and picking a hint are all O(1) (the number of colours and tiers is fixed and small)
+# Hints with a release time in the future wait in a heap until HintScheduler moves them into the pool,
+# so picking a hint never has to look at the release schedule
+
+import itertools
+import secrets
+import heapq
+import time
+
+
+HINT_ORDER = ['first_hint', 'second_hint', 'third_hint']
+
+# Selection policies
+RANDOM = 'random'  # Every available hint is equally likely
+PROGRESSIVE = 'progressive'  # Only first hints at the start, second and third hints unlock every tier interval
+BALANCED = 'balanced'  # Every colour with hints left is equally likely, whatever its number of tokens
+
+# Number of picks tried before giving up on finding a hint that the user has not seen yet
+NO_REPEAT_ATTEMPTS = 8
+
+
+class HintPool:
+    def __init__(self, policy=RANDOM, no_repeat=False, tier_interval=3600, start_time=None):
+        if policy not in (RANDOM, PROGRESSIVE, BALANCED):
+            raise ValueError(f'Unknown hint policy: {policy}')
+
+        # Falling back to the current time would re-lock the later tiers for everyone whenever the bot restarts
+        if policy == PROGRESSIVE and start_time is None:
+            raise ValueError('The progressive hint policy needs the start time of the hunt')
+
+        self.policy = policy
+        self.no_repeat = no_repeat
+        self.tier_interval = tier_interval  # Unit in seconds, used by the progressive policy
+        self.start_time = start_time
+
+        self.entries = {}  # (colour, tier) -> [(token, hint), ...]
+        self.positions = {}  # token -> [(colour, tier, index), ...]
+        self.seen = {}  # user ID -> {(token, tier), ...}
+
+        self.schedule = []  # Heap of (release time, sequence number, colour, token, tier, hint)
+        self.scheduled = {}  # token -> {sequence number, ...} of its releases still in the heap
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.entries.values())
+
+    def add(self, color, token, tier, hint):
+        entries = self.entries.setdefault((color, tier), [])
+        self.positions.setdefault(token, []).append((color, tier, len(entries)))
+        entries.append((token, hint))
+
+    def release_time(self, tier, value):
+        # A token's `<tier>_release` field (Unix timestamp) overrides the default schedule of its policy
+        release = value.get(f'{HINT_ORDER[tier]}_release')
+        if release not in (None, u''):
+            return float(release)
+
+        if self.policy == PROGRESSIVE:
+            return self.start_time + tier * self.tier_interval
+
+        return 0
+
+    def add_token(self, color, token, value, now=None):
+        now = now if now is not None else time.time()
+
+        for tier, order in enumerate(HINT_ORDER):
+            if not value.get(order):
+                continue
+
+            release = self.release_time(tier, value)
+            if release <= now:
+                self.add(color, token, tier, value[order])
+            else:
+                sequence = next(self.sequence)
+                heapq.heappush(self.schedule, (release, sequence, color, token, tier, value[order]))
+                self.scheduled.setdefault(token, set()).add(sequence)
+
+    def _pending(self, entry):
+        return entry[1] in self.scheduled.get(entry[3], ())
+
+    def next_release(self):
+        # Time of the earliest scheduled release, or None if there are none left
+        # Releases of tokens removed in the meantime are only dropped from the heap when they reach the top
+        while self.schedule and not self._pending(self.schedule[0]):
+            heapq.heappop(self.schedule)
+
+        return self.schedule[0][0] if self.schedule else None
+
+    def release_due(self, now=None):
+        # Move every hint whose release time has passed into the pool, returns the (colour, tier) pairs released
+        now = now if now is not None else time.time()
+        released = set()
+
+        while self.schedule and self.schedule[0][0] <= now:
+            entry = heapq.heappop(self.schedule)
+            if not self._pending(entry):
+                continue
+
+            release, sequence, color, token, tier, hint = entry
+            self.scheduled[token].discard(sequence)
+            if not self.scheduled[token]:
+                del self.scheduled[token]
+
+            self.add(color, token, tier, hint)
+            released.add((color, tier))
+
+        return released
+
+    def remove_token(self, token):
+        self.scheduled.pop(token, None)
+        for color, tier, index in self.positions.pop(token, []):
+            entries = self.entries[(color, tier)]
+            last = entries.pop()
+
+            # Move the last entry into the freed slot and point its token at the new index
+            if index < len(entries):
+                entries[index] = last
+                last_positions = self.positions[last[0]]
+                last_positions[last_positions.index((color, tier, len(entries)))] = (color, tier, index)
+
+    def _pick(self):
+        pools = [(key, entries) for key, entries in self.entries.items() if entries]
+        if not pools:
+            return None
+
+        if self.policy == BALANCED:
+            color = secrets.choice(sorted({key[0] for key, entries in pools}))
+            pools = [(key, entries) for key, entries in pools if key[0] == color]
+
+        # Weight each array by its size so that every remaining hint is equally likely
+        pick = secrets.randbelow(sum(len(entries) for key, entries in pools))
+        for (color, tier), entries in pools:
+            if pick < len(entries):
+                token, hint = entries[pick]
+                return token, tier, hint
+            pick -= len(entries)
+
+    def choose(self, user_id=None):
+        # Returns a released hint, or '' if none are available
+        entry = self._pick()
+        if entry is None:
+            return ''
+
+        if self.no_repeat and user_id is not None:
+            seen = self.seen.setdefault(user_id, set())
+            for _ in range(NO_REPEAT_ATTEMPTS - 1):
+                if entry[:2] not in seen:
+                    break
+                entry = self._pick()
+            seen.add(entry[:2])
+
+        return entry[2]
@@ -0,0 +1,46 @@
+# Timer that releases scheduled hints into the HintPool of a TokenIndex at their release times
+# The thread sleeps until the earliest release in the pool's heap (or until tokens change), so /hint itself never
+# checks the schedule, however many releases are pending
+
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class HintScheduler:
+    def __init__(self, token_index):
+        self.token_index = token_index
+        self.on_release = None  # Called with the released {(colour, tier), ...}, outside the index's lock
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='HintScheduler', daemon=True)
+
+    def start(self, on_release=None):
+        self.on_release = on_release
+        self.thread.start()
+
+    def _run(self):
+        pool = self.token_index.hint_pool
+
+        while not self.stop_event.is_set():
+            with self.token_index.changed:
+                released = pool.release_due(time.time())
+                if not released:
+                    next_release = pool.next_release()
+                    self.token_index.changed.wait(None if next_release is None else max(0, next_release - time.time()))
+                    continue
+
+            logger.info('Released hints: %s', ', '.join(f'{color} tier {tier + 1}' for color, tier in sorted(released)))
+            if self.on_release is not None:
+                try:
+                    self.on_release(released)
+
+                except Exception:
+                    logger.exception('Failed to announce released hints')
+
+    def stop(self):
+        self.stop_event.set()
+        with self.token_index.changed:
+            self.token_index.changed.notify_all()
@@ -0,0 +1,281 @@
+# In-memory stand-in for FirebaseConnector, used to run the bot offline (e.g. for load testing)
+# State can be loaded from a Firestore export in the same format as sutd-hostel-hunt-bot.json
+
+from storage_backend import StorageBackend, ClaimResult
+from token_index import TokenIndex
+from hint_pool import HintPool
+import itertools
+import copy
+import time
+import threading
+import json
+import credentials
+
+
+# Values in the sample export are all strings, so normalize them to what the bot writes to Firestore
+def _normalize_participant(participant):
+    return {
+        u'name': participant.get(u'name', u''),
+        u'student_id': int(participant.get(u'student_id') or 0),
+        u'last_hint': float(participant[u'last_hint']) if participant.get(u'last_hint') not in (None, u'') else None,
+        u'hint_alerts': f'{participant.get(u"hint_alerts", False)}'.lower() == u'true'
+    }
+
+
+def _normalize_token(value):
+    value = dict(value)
+    if isinstance(value.get(u'claimed'), str):
+        value[u'claimed'] = value[u'claimed'].lower() == u'true'
+
+    return value
+
+
+class LocalBackend(StorageBackend):
+    def __init__(self, data=None):
+        # `data` is either a path to a JSON export or an already loaded {participants, tokens} dictionary
+        if isinstance(data, str):
+            with open(data, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        data = data or {}
+
+        self.lock = threading.Lock()
+        self.participants = {user_id: _normalize_participant(participant)
+                             for user_id, participant in data.get(u'participants', {}).items()}
+        self.colors = {color: {token: _normalize_token(value) for token, value in tokens.items()}
+                       for color, tokens in data.get(u'tokens', {}).items()}
+        self.student_ids = {participant[u'student_id']: user_id
+                            for user_id, participant in self.participants.items() if participant[u'student_id'] != 0}
+        self.verifications = {}
+        self.broadcasts = {}
+        self.seen_updates = {}  # update ID -> expiry time
+        self.revoked_receipts = {}  # receipt ID -> {revoked_by, revoked_at}
+        self.broadcast_ids = itertools.count(1)
+
+        self.token_index = TokenIndex(HintPool(credentials.HINT_POLICY, credentials.HINT_NO_REPEAT,
+                                               credentials.HINT_TIER_INTERVAL, credentials.HUNT_START_TIME))
+        self.token_index.load(copy.deepcopy(self.colors))
+
+    # Everything is already in memory, so there is nothing to warm up or reconcile
+    def start(self, snapshot=None, listen=True):
+        pass
+
+    def listeners(self):
+        return {}
+
+    def wait_ready(self, timeout=None):
+        return True
+
+    def wait_synced(self, timeout=None):
+        return True
+
+    def export_snapshot(self):
+        with self.lock:
+            return copy.deepcopy({u'participants': self.participants, u'tokens': self.colors})
+
+    # Participants
+    def is_registered(self, user_id):
+        participant = self.participants.get(f'{user_id}')
+
+        return participant is not None and participant[u'student_id'] != 0
+
+    def get_cache_stats(self):
+        return {u'hits': 0, u'misses': 0, u'invalidations': 0, u'size': len(self.participants)}
+
+    def get_current_users(self):
+        return list(self.participants)
+
+    def get_all_users(self):
+        return list(self.participants)
+
+    def add_user(self, user_id, first_name):
+        with self.lock:
+            self.participants[f'{user_id}'] = {u'last_hint': None, u'name': f'{first_name}', u'student_id': 0}
+
+    def get_name(self, user_id):
+        participant = self.participants.get(f'{user_id}')
+
+        return participant[u'name'] if participant is not None else 0
+
+    def get_all_current_student_id(self):
+        return [participant[u'student_id'] for participant in self.participants.values()]
+
+    def get_student_id(self, user_id):
+        participant = self.participants.get(f'{user_id}')
+
+        return participant[u'student_id'] if participant is not None else 0
+
+    def update_student_id(self, user_id, student_id):
+        with self.lock:
+            self.participants.setdefault(f'{user_id}', {u'last_hint': None, u'name': u''})[u'student_id'] = student_id
+
+    def register_student_id(self, user_id, student_id):
+        with self.lock:
+            if self.student_ids.setdefault(int(student_id), f'{user_id}') != f'{user_id}':
+                return False
+
+            self.participants.setdefault(f'{user_id}', {u'last_hint': None, u'name': u''})[u'student_id'] = int(student_id)
+
+        return True
+
+    def get_last_hint_time(self, user_id):
+        return self.participants[f'{user_id}'][u'last_hint']
+
+    def update_last_hint_time(self, user_id, last_hint):
+        with self.lock:
+            self.participants[f'{user_id}'][u'last_hint'] = last_hint
+
+    def get_last_hint_times(self):
+        return {user_id: participant[u'last_hint'] for user_id, participant in self.participants.items()}
+
+    def update_last_hint_times(self, last_hints):
+        with self.lock:
+            for user_id, last_hint in last_hints.items():
+                self.participants[f'{user_id}'][u'last_hint'] = last_hint
+
+    def get_hint_alerts(self, user_id):
+        participant = self.participants.get(f'{user_id}')
+
+        return participant is not None and participant.get(u'hint_alerts', False)
+
+    def set_hint_alerts(self, user_id, enabled):
+        with self.lock:
+            self.participants[f'{user_id}'][u'hint_alerts'] = enabled
+
+    def get_hint_alert_users(self):
+        return [user_id for user_id, participant in self.participants.items() if participant.get(u'hint_alerts', False)]
+
+    # Tokens
+    def get_all_tokens(self):
+        return self.token_index.all_tokens()
+
+    def is_token(self, token):
+        return self.token_index.is_token(token)
+
+    def is_unclaimed(self, token):
+        return self.token_index.is_unclaimed(token)
+
+    def get_hint(self, user_id=None):
+        return self.token_index.random_hint(user_id)
+
+    def get_unclaimed_tokens(self):
+        return self.token_index.unclaimed_tokens()
+
+    def claim_token(self, user_id, token, verification_hash):
+        self.claim_token_atomic(user_id, token, verification_hash)
+
+    def claim_token_atomic(self, user_id, token, verification_hash):
+        with self.lock:
+            color = self.token_index.get_color(token)
+            if color is None:
+                return ClaimResult.UNKNOWN
+
+            value = self.colors[color][token]
+            if value[u'claimed'] == True:
+                return ClaimResult.ALREADY_CLAIMED
+
+            value.update({u'claimant': f'{user_id}', u'claimed': True, u'hash': f'{verification_hash}'})
+            self.verifications[f'{verification_hash}'] = {u'hash': f'{verification_hash}', u'token': token, u'color': color,
+                                                        u'claimant': f'{user_id}', u'claimed_at': time.time()}
+            self.token_index.mark_claimed(token, user_id, verification_hash)
+
+        return ClaimResult.CLAIMED
+
+    def get_all_hash(self):
+        return self.token_index.all_hashes()
+
+    def get_hash_claim(self, verification_hash):
+        return self.token_index.get_hash_claim(verification_hash)
+
+    def get_token_color(self, token):
+        return self.token_index.get_color(token)
+
+    def get_verification(self, verification_hash):
+        return self.verifications.get(verification_hash)
+
+    # Progress is counted from the token maps, there are no aggregate documents to maintain offline
+    def get_progress(self, user_id=None):
+        progress = {u'colors': {}, u'claimant': None}
+        if user_id is not None:
+            progress[u'claimant'] = {u'claimed': 0, u'colors': {}}
+
+        with self.lock:
+            for color, tokens in sorted(self.colors.items()):
+                claimed = [value for value in tokens.values() if value[u'claimed'] == True]
+                progress[u'colors'][color] = {u'claimed': len(claimed), u'total': len(tokens)}
+
+                if user_id is not None:
+                    count = sum(1 for value in claimed if value[u'claimant'] == f'{user_id}')
+                    if count:
+                        progress[u'claimant'][u'claimed'] += count
+                        progress[u'claimant'][u'colors'][color] = count
+
+        return progress
+
+    def get_leaderboard(self, limit=10):
+        counts = {}
+        with self.lock:
+            for tokens in self.colors.values():
+                for value in tokens.values():
+                    if value[u'claimed'] == True:
+                        counts[value[u'claimant']] = counts.get(value[u'claimant'], 0) + 1
+
+        return sorted(counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    # Broadcasts
+    def create_broadcast(self, text):
+        broadcast_id = f'{next(self.broadcast_ids)}'
+        self.broadcasts[broadcast_id] = {u'text': text, u'created': time.time(), u'done': False, u'running_until': 0,
+                                         u'delivered': [], u'failed': []}
+
+        return broadcast_id
+
+    def get_broadcast(self, broadcast_id):
+        # A copy, like a Firestore snapshot, so that later progress updates do not change it
+        with self.lock:
+            return copy.deepcopy(self.broadcasts.get(f'{broadcast_id}'))
+
+    def get_unfinished_broadcast(self):
+        with self.lock:
+            for broadcast_id, broadcast in sorted(self.broadcasts.items(), key=lambda item: item[1][u'created']):
+                if not broadcast[u'done'] and broadcast[u'running_until'] <= time.time():
+                    return broadcast_id
+
+        return None
+
+    def acquire_broadcast(self, broadcast_id, lease):
+        with self.lock:
+            broadcast = self.broadcasts.get(f'{broadcast_id}')
+            if broadcast is None or broadcast[u'done'] or broadcast[u'running_until'] > time.time():
+                return False
+
+            broadcast[u'running_until'] = time.time() + lease
+            return True
+
+    def update_broadcast_progress(self, broadcast_id, delivered, failed, done=False, running_until=0):
+        with self.lock:
+            broadcast = self.broadcasts[f'{broadcast_id}']
+            broadcast[u'delivered'].extend(chat_id for chat_id in delivered if chat_id not in broadcast[u'delivered'])
+            broadcast[u'failed'].extend(chat_id for chat_id in failed if chat_id not in broadcast[u'failed'])
+            broadcast[u'done'] = done
+            broadcast[u'running_until'] = running_until
+
+    # Claim receipts
+    def revoke_receipt(self, receipt_id, revoked_by):
+        with self.lock:
+            self.revoked_receipts[receipt_id] = {u'revoked_by': f'{revoked_by}', u'revoked_at': time.time()}
+
+    def get_revoked_receipts(self):
+        with self.lock:
+            return list(self.revoked_receipts)
+
+    # Webhook updates
+    def mark_update_seen(self, update_id, ttl):
+        now = time.time()
+        with self.lock:
+            self.seen_updates = {seen: expire_at for seen, expire_at in self.seen_updates.items() if expire_at >= now}
+            if update_id in self.seen_updates:
+                return False
+
+            self.seen_updates[update_id] = now + ttl
+
+        return True
@@ -0,0 +1,393 @@
+# Instrumentation for the bot: per-handler and per-connector-method latency histograms,
+# Firestore documents read/written and Telegram API calls, attributed to the command being handled
+# Exposed in the Prometheus text format on the webhook port and summarized by the /stats admin command
+
+from collections import defaultdict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from functools import wraps
+from telegram.ext.dispatcher import run_async
+from telegram.utils.webhookhandler import WebhookHandler
+import contextvars
+import itertools
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets, unit in seconds
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf')]
+
+# Every handler decorated with @run_async shares the code object of run_async's inner function
+_RUN_ASYNC_CODE = run_async(lambda: None).__code__
+
+# Attributes of Metrics holding histograms and counters, in the form they are exported in (see Metrics.export)
+HISTOGRAMS = ['handler_latency', 'connector_latency', 'dispatcher_wait']
+COUNTERS = ['documents_read', 'documents_written', 'api_calls']
+
+# Command being handled by the current thread (or asyncio task), used to attribute reads, writes and API calls
+_command = contextvars.ContextVar('command', default=None)
+# Number of the `attributed_to` block being run (one per handler call), so that the outbox only coalesces the replies
+# of the same handler call
+_invocation = contextvars.ContextVar('invocation', default=None)
+_invocations = itertools.count(1)
+
+
+def current_command():
+    return _command.get() or 'background'
+
+
+def current_invocation():
+    # None outside of any handler, e.g. for background announcements
+    return _invocation.get()
+
+
+@contextmanager
+def attributed_to(command):
+    # Attribute the reads, writes and API calls made by the current thread to `command`
+    token = _command.set(command)
+    invocation_token = _invocation.set(next(_invocations))
+    try:
+        yield
+
+    finally:
+        _invocation.reset(invocation_token)
+        _command.reset(token)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket containing the q-th quantile
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+
+        return BUCKETS[-1]
+
+    def merge(self, state):
+        # `state` is a (counts, sum, count) tuple from Metrics.export
+        counts, total, count = state
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.sum += total
+        self.count += count
+
+
+def _add_exported(target, exported):
+    # Add the histograms and counters of a Metrics.export() to those of the Metrics `target`
+    for attr, histograms in exported['histograms'].items():
+        for key, state in histograms.items():
+            getattr(target, attr)[key].merge(state)
+
+    for attr, counter in exported['counters'].items():
+        for key, count in counter.items():
+            getattr(target, attr)[key] += count
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handler_latency = defaultdict(Histogram)  # command -> Histogram
+        self.connector_latency = defaultdict(Histogram)  # method -> Histogram
+        self.documents_read = defaultdict(int)  # command -> documents
+        self.documents_written = defaultdict(int)  # command -> documents
+        self.api_calls = defaultdict(int)  # (command, Bot API method) -> calls
+        self.dispatcher_wait = defaultdict(Histogram)  # dispatcher partition -> Histogram of queueing times
+        self.gauges = {}  # name -> (label, function returning {label value: value})
+        # With WEB_WORKERS > 1, the front process renders its own metrics plus those reported by the worker processes
+        self.workers = {}  # worker process ID -> latest Metrics.export() of that worker
+        self.exited = set()  # Worker process IDs whose counts have been added to this process's own
+
+    def observe_handler(self, command, seconds):
+        with self.lock:
+            self.handler_latency[command].observe(seconds)
+
+    def observe_connector(self, method, seconds):
+        with self.lock:
+            self.connector_latency[method].observe(seconds)
+
+    def add_reads(self, count, command=None):
+        with self.lock:
+            self.documents_read[command or current_command()] += count
+
+    def add_writes(self, count, command=None):
+        with self.lock:
+            self.documents_written[command or current_command()] += count
+
+    def add_api_call(self, method):
+        with self.lock:
+            self.api_calls[(current_command(), method)] += 1
+
+    def observe_dispatcher_wait(self, partition, seconds):
+        with self.lock:
+            self.dispatcher_wait[partition].observe(seconds)
+
+    def add_gauge(self, name, label, collect):
+        # `collect` is called whenever the metrics are rendered
+        with self.lock:
+            self.gauges[name] = (label, collect)
+
+    def export(self):
+        """ Picklable copy of every metric, reported by the worker processes to the front process. """
+
+        with self.lock:
+            return {
+                'histograms': {attr: {key: (list(histogram.counts), histogram.sum, histogram.count)
+                                      for key, histogram in getattr(self, attr).items()} for attr in HISTOGRAMS},
+                'counters': {attr: dict(getattr(self, attr)) for attr in COUNTERS},
+                'gauges': {name: (label, collect()) for name, (label, collect) in self.gauges.items()}
+            }
+
+    def set_worker(self, worker, exported):
+        with self.lock:
+            if worker not in self.exited:
+                self.workers[worker] = exported
+
+    def worker_exited(self, worker):
+        # Keep the counts of a worker that exited, so that the totals do not go backwards when it is restarted
+        with self.lock:
+            self.exited.add(worker)
+            exported = self.workers.pop(worker, None)
+            if exported is not None:
+                _add_exported(self, exported)
+
+    def _merged(self):
+        # This process's metrics plus the latest ones of every worker process, must be called with `lock` held
+        if not self.workers:
+            return self, {name: (label, collect()) for name, (label, collect) in self.gauges.items()}
+
+        merged = Metrics()
+        _add_exported(merged, {'histograms': {attr: {key: (histogram.counts, histogram.sum, histogram.count)
+                                                     for key, histogram in getattr(self, attr).items()}
+                                              for attr in HISTOGRAMS},
+                           'counters': {attr: getattr(self, attr) for attr in COUNTERS}})
+        gauges = {name: (label, dict(collect())) for name, (label, collect) in self.gauges.items()}
+
+        for exported in self.workers.values():
+            _add_exported(merged, exported)
+            # Gauges are summed over the workers, e.g. the updates queued on each worker's partition 0
+            for name, (label, values) in exported['gauges'].items():
+                totals = gauges.setdefault(name, (label, {}))[1]
+                for key, value in values.items():
+                    totals[key] = totals.get(key, 0) + value
+
+        return merged, gauges
+
+    def render(self):
+        """ Render every metric in the Prometheus text exposition format. """
+
+        lines = []
+        with self.lock:
+            merged, gauges = self._merged()
+
+            for name, label, histograms in [('hostelhunt_handler_latency_seconds', 'command', merged.handler_latency),
+                                            ('hostelhunt_connector_latency_seconds', 'method', merged.connector_latency),
+                                            ('hostelhunt_dispatcher_wait_seconds', 'partition', merged.dispatcher_wait)]:
+                lines.append(f'# TYPE {name} histogram')
+                for key, histogram in sorted(histograms.items()):
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS, histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else f'{bound}'
+                        lines.append(f'{name}_bucket{{{label}="{key}",le="{le}"}} {cumulative}')
+                    lines.append(f'{name}_sum{{{label}="{key}"}} {histogram.sum}')
+                    lines.append(f'{name}_count{{{label}="{key}"}} {histogram.count}')
+
+            for name, counter in [('hostelhunt_firestore_documents_read_total', merged.documents_read),
+                                  ('hostelhunt_firestore_documents_written_total', merged.documents_written)]:
+                lines.append(f'# TYPE {name} counter')
+                for command, count in sorted(counter.items()):
+                    lines.append(f'{name}{{command="{command}"}} {count}')
+
+            lines.append('# TYPE hostelhunt_telegram_api_calls_total counter')
+            for (command, method), count in sorted(merged.api_calls.items()):
+                lines.append(f'hostelhunt_telegram_api_calls_total{{command="{command}",method="{method}"}} {count}')
+
+            for name, (label, values) in sorted(gauges.items()):
+                lines.append(f'# TYPE {name} gauge')
+                for key, value in sorted(values.items()):
+                    lines.append(f'{name}{{{label}="{key}"}} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """ Human-readable per-command summary for the /stats command. """
+
+        with self.lock:
+            api_calls = defaultdict(int)
+            for (command, method), count in self.api_calls.items():
+                api_calls[command] += count
+
+            lines = []
+            for command, histogram in sorted(self.handler_latency.items()):
+                lines.append(f'/{command}: {histogram.count} calls, '
+                             f'mean {histogram.sum / histogram.count * 1000:.1f} ms, '
+                             f'p95 ≤ {histogram.quantile(0.95) * 1000:.0f} ms, '
+                             f'{self.documents_read[command] / histogram.count:.1f} reads, '
+                             f'{self.documents_written[command] / histogram.count:.1f} writes, '
+                             f'{api_calls[command] / histogram.count:.1f} API calls per call')
+
+            lines.append(f'Firestore totals: {sum(self.documents_read.values())} reads, '
+                         f'{sum(self.documents_written.values())} writes '
+                         f'(listeners: {self.documents_read.get("listener", 0)} reads)')
+
+            if self.dispatcher_wait:
+                slowest = max(self.dispatcher_wait.items(), key=lambda item: item[1].quantile(0.95))
+                lines.append(f'Dispatcher: {len(self.dispatcher_wait)} partitions, slowest p95 wait ≤ '
+                             f'{slowest[1].quantile(0.95) * 1000:.0f} ms (partition {slowest[0]})')
+
+        return '\r\n\r\n'.join(lines)
+
+
+registry = Metrics()
+
+
+def instrument_handler(command, callback):
+    # Handlers decorated with @run_async are re-wrapped so that the timing covers the threaded execution
+    if getattr(callback, '__code__', None) is _RUN_ASYNC_CODE:
+        return run_async(instrument_handler(command, callback.__wrapped__))
+
+    @wraps(callback)
+    def wrapped(bot, update, *args, **kwargs):
+        start = time.perf_counter()
+        result = None
+
+        try:
+            with attributed_to(command):
+                result = callback(bot, update, *args, **kwargs)
+                return result
+
+        finally:
+            # Handlers scheduled on the event loop (see async_firebase_connector.py) are timed until they finish
+            if isinstance(result, Future):
+                result.add_done_callback(lambda future: registry.observe_handler(command, time.perf_counter() - start))
+            else:
+                registry.observe_handler(command, time.perf_counter() - start)
+
+    return wrapped
+
+
+class InstrumentedConnector:
+    # Times every public method of the wrapped storage backend
+    def __init__(self, connector):
+        self.connector = connector
+
+    def __getattr__(self, name):
+        attr = getattr(self.connector, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def method(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                registry.observe_connector(name, time.perf_counter() - start)
+
+        # Cache the wrapper so that __getattr__ is only called once per method
+        setattr(self, name, method)
+        return method
+
+
+def instrument_bot(bot):
+    # Every Bot API method goes through the bot's Request object, whose URL ends with the method name
+    request = bot._request
+
+    def wrap(send):
+        @wraps(send)
+        def wrapped(url, *args, **kwargs):
+            registry.add_api_call(url.rsplit('/', 1)[-1])
+            return send(url, *args, **kwargs)
+
+        return wrapped
+
+    request.post = wrap(request.post)
+    request.get = wrap(request.get)
+
+
+def instrument_firestore():
+    """ Count the documents read and written through the Firestore client, per command. """
+
+    from google.cloud.firestore_v1 import batch, client, collection, document, query, transaction
+
+    def counting_stream(stream):
+        @wraps(stream)
+        def wrapped(*args, **kwargs):
+            for snapshot in stream(*args, **kwargs):
+                registry.add_reads(1)
+                yield snapshot
+
+        return wrapped
+
+    def counting_get(get):
+        @wraps(get)
+        def wrapped(*args, **kwargs):
+            registry.add_reads(1)
+            return get(*args, **kwargs)
+
+        return wrapped
+
+    def counting_commit(commit):
+        @wraps(commit)
+        def wrapped(self, *args, **kwargs):
+            registry.add_writes(len(self._write_pbs))
+            return commit(self, *args, **kwargs)
+
+        return wrapped
+
+    def counting_on_snapshot(on_snapshot):
+        # Listener updates are billed as one read per changed document
+        @wraps(on_snapshot)
+        def wrapped(self, callback):
+            def counting_callback(docs, changes, read_time):
+                registry.add_reads(len(changes), command='listener')
+                return callback(docs, changes, read_time)
+
+            return on_snapshot(self, counting_callback)
+
+        return wrapped
+
+    document.DocumentReference.get = counting_get(document.DocumentReference.get)
+    client.Client.get_all = counting_stream(client.Client.get_all)
+    query.Query.stream = counting_stream(query.Query.stream)
+    batch.WriteBatch.commit = counting_commit(batch.WriteBatch.commit)
+    transaction.Transaction._commit = counting_commit(transaction.Transaction._commit)
+    collection.CollectionReference.on_snapshot = counting_on_snapshot(collection.CollectionReference.on_snapshot)
+
+
+class MetricsWebhookHandler(WebhookHandler):
+    # Serves the metrics on GET requests to `metrics_path`, everything else is handled by the usual webhook handler
+    metrics_path = '/metrics'
+
+    def do_GET(self):
+        if self.path != self.metrics_path:
+            return super(MetricsWebhookHandler, self).do_GET()
+
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def install_webhook_metrics(metrics_path):
+    # Updater._start_webhook looks WebhookHandler up in its module when the webhook server is created
+    import telegram.ext.updater
+
+    MetricsWebhookHandler.metrics_path = metrics_path
+    telegram.ext.updater.WebhookHandler = MetricsWebhookHandler
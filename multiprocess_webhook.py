@@ -0,0 +1,176 @@
+# Multi-process webhook mode, used when WEB_WORKERS > 1
+# The front process binds the webhook and routes every update by user ID to one of the worker processes, which run
+# the usual dispatcher and handlers, so that each user's updates are always handled by the same worker (and its
+# in-memory cooldowns, claim guard and conversations). The front process also owns the only Firestore listeners:
+# their changes are fanned out to every worker, which applies them to its caches as if they came from its own listener
+# Every worker reports its metrics to the front process, which serves them all on the webhook's metrics path
+
+from collections import namedtuple
+from partitioned_dispatcher import partition_key
+import multiprocessing
+import threading
+import logging
+import metrics
+import signal
+import sys
+
+logger = logging.getLogger(__name__)
+
+# Collections whose listener changes are forwarded to the workers
+COLLECTIONS = [u'participants', u'tokens']
+
+# How often the workers report their metrics to the front process, unit in seconds
+METRICS_INTERVAL = 5
+
+# Picklable stand-ins for the listener callback arguments, with the attributes the callbacks use
+ChangeType = namedtuple('ChangeType', ['name'])
+DocumentChange = namedtuple('DocumentChange', ['type', 'document'])
+
+
+class DocumentSnapshot:
+    def __init__(self, id, data=None):
+        self.id = id
+        self.data = data
+
+    def to_dict(self):
+        return dict(self.data) if self.data is not None else None
+
+
+def follow_feed(feed, listeners):
+    # Worker side: apply forwarded (collection, document IDs, [(change type, document ID, data), ...]) messages
+    # Only a collection's first message carries its document IDs (None afterwards): the listener callbacks only use
+    # them to drop stale entries until their first snapshot, so later messages only need the changes
+    for collection, doc_ids, changes in iter(feed.get, None):
+        docs = [DocumentSnapshot(doc_id) for doc_id in doc_ids or []]
+        changes = [DocumentChange(ChangeType(name), DocumentSnapshot(doc_id, data)) for name, doc_id, data in changes]
+        listeners[collection](docs, changes, None)
+
+
+def report_metrics(reports, stop_event, interval=METRICS_INTERVAL):
+    # Worker side: send every metric to the front process until `stop_event` is set, then one last time
+    while not stop_event.wait(interval):
+        reports.put((multiprocessing.current_process().pid, metrics.registry.export()))
+
+    reports.put((multiprocessing.current_process().pid, metrics.registry.export()))
+
+
+def worker_main(index, updates, feed, reports):
+    # Shutdown is driven by the front process, which stops the workers once it has stopped receiving updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    # With the spawn start method, the front's main script (app.py) has already been imported again as __mp_main__,
+    # so reuse it instead of importing it a second time
+    app = sys.modules.get('__mp_main__')
+    if not hasattr(app, 'run_worker'):
+        import app
+
+    app.run_worker(index, updates, feed, reports)
+
+
+class WorkerPool:
+    def __init__(self, workers, db):
+        self.db = db
+        # Workers are spawned rather than forked, since the Firestore client and its threads do not survive a fork
+        self.context = multiprocessing.get_context('spawn')
+
+        self.lock = threading.Lock()
+        self.processes = [None] * workers
+        self.updates = [None] * workers  # Queues of update dictionaries, one per worker
+        self.feeds = [None] * workers  # Queues of listener changes, one per worker
+        self.reports = self.context.Queue()  # (worker process ID, metrics) reported by every worker
+        self.documents = {collection: {} for collection in COLLECTIONS}  # Latest data, replayed to restarted workers
+        self.synced = set()  # Collections whose listener has delivered its first snapshot
+        self.watches = []
+
+        self.stop_event = threading.Event()
+        self.supervisor = threading.Thread(target=self._supervise, name='WorkerPool', daemon=True)
+        self.collector = threading.Thread(target=self._collect_metrics, name='WorkerMetrics', daemon=True)
+
+    def _start_worker(self, index, replay=False):
+        # Must be called with `lock` held
+        self.updates[index] = self.context.Queue()
+        self.feeds[index] = self.context.Queue()
+        self.processes[index] = self.context.Process(target=worker_main, name=f'Worker_{index}', daemon=True,
+                                                     args=(index, self.updates[index], self.feeds[index],
+                                                           self.reports))
+        self.processes[index].start()
+
+        # A restarted worker gets the current state as if its listeners had just delivered their first snapshots
+        # (collections still waiting for theirs are sent the first snapshot like every other worker)
+        if replay:
+            for collection in self.synced:
+                documents = self.documents[collection]
+                self.feeds[index].put((collection, list(documents),
+                                       [('ADDED', doc_id, data) for doc_id, data in documents.items()]))
+
+    def start(self):
+        with self.lock:
+            for index in range(len(self.processes)):
+                self._start_worker(index)
+
+        for collection in COLLECTIONS:
+            self.watches.append(self.db.collection(collection).on_snapshot(
+                lambda docs, changes, read_time, collection=collection: self._on_snapshot(collection, docs, changes)))
+
+        self.supervisor.start()
+        self.collector.start()
+
+    def _on_snapshot(self, collection, docs, changes):
+        # Runs on the listener's background thread, forwards the change to every worker in order
+        forwarded = []
+        with self.lock:
+            documents = self.documents[collection]
+            for change in changes:
+                doc_id = change.document.id
+                if change.type.name == 'REMOVED':
+                    documents.pop(doc_id, None)
+                    forwarded.append(('REMOVED', doc_id, None))
+                else:
+                    documents[doc_id] = change.document.to_dict()
+                    forwarded.append((change.type.name, doc_id, documents[doc_id]))
+
+            # The full list of document IDs is only needed with the first snapshot
+            doc_ids = None
+            if collection not in self.synced:
+                doc_ids = [doc.id for doc in docs]
+                self.synced.add(collection)
+
+            message = (collection, doc_ids, forwarded)
+            for feed in self.feeds:
+                feed.put(message)
+
+    def submit(self, update):
+        # Replaces the front Dispatcher's process_update, so updates are routed instead of handled
+        # Keyed like the worker's own dispatcher partitions, so that each user always goes to the same worker
+        with self.lock:
+            self.updates[partition_key(update) % len(self.updates)].put(update.to_dict())
+
+    def _collect_metrics(self):
+        for worker, exported in iter(self.reports.get, None):
+            metrics.registry.set_worker(worker, exported)
+
+    def _supervise(self):
+        while not self.stop_event.wait(5):
+            with self.lock:
+                for index, process in enumerate(self.processes):
+                    if not process.is_alive():
+                        logger.warning('Worker %d exited with code %s, restarting it', index, process.exitcode)
+                        metrics.registry.worker_exited(process.pid)
+                        self._start_worker(index, replay=True)
+
+    def stop(self, timeout=30):
+        self.stop_event.set()
+        for watch in self.watches:
+            watch.unsubscribe()
+
+        with self.lock:
+            for index in range(len(self.processes)):
+                self.updates[index].put(None)
+                self.feeds[index].put(None)
+
+        for process in self.processes:
+            process.join(timeout)
+
+        self.reports.put(None)
+        self.collector.join(timeout)
@@ -0,0 +1,196 @@
+# Outbound message queue for handler replies
+# Handlers return as soon as their replies are queued. A pool of senders delivers them within Telegram's flood limits,
+# one chat at a time per sender so that replies to a chat keep their order, and consecutive replies to the same chat
+# are coalesced into a single message where possible
+
+from telegram.error import Unauthorized, BadRequest, TimedOut, NetworkError, RetryAfter
+from rate_limiter import TokenBucket, ChatBuckets
+import threading
+import heapq
+import logging
+import metrics
+import time
+
+logger = logging.getLogger(__name__)
+
+# Telegram rejects messages longer than this
+MAX_MESSAGE_LENGTH = 4096
+SEPARATOR = '\r\n\r\n'
+
+
+def coalesce(messages):
+    # Merge consecutive [(command, invocation, send_message kwargs), ...] into as few messages as possible
+    # Only replies of the same handler call are merged (see metrics.current_invocation), never replies to different
+    # updates or background messages without one. Only a message without a keyboard can be merged into the next one,
+    # and both must use the same options
+    merged = []
+    for command, invocation, kwargs in messages:
+        if merged and invocation is not None and merged[-1][1] == invocation:
+            last = merged[-1][2]
+            text = f'{last["text"]}{SEPARATOR}{kwargs["text"]}'
+            options = {k: v for k, v in kwargs.items() if k not in ('text', 'reply_markup')}
+            if ('reply_markup' not in last and {k: v for k, v in last.items() if k != 'text'} == options
+                    and len(text) <= MAX_MESSAGE_LENGTH):
+                merged[-1] = (command, invocation, dict(kwargs, text=text))
+                continue
+
+        merged.append((command, invocation, kwargs))
+
+    return merged
+
+
+class Reply:
+    # A coalesced message waiting to be sent to its chat, with the number of failed attempts so far
+    def __init__(self, command, kwargs):
+        self.command = command
+        self.kwargs = kwargs
+        self.attempts = 0
+
+
+class Outbox:
+    def __init__(self, bot, global_rate=25, per_chat_rate=1, workers=4, linger=0.05, max_retries=5):
+        self.bot = bot
+        self.linger = linger  # Unit in seconds, how long replies wait for the next reply to the same chat
+        self.max_retries = max_retries
+
+        # Same limits as BroadcastEngine: roughly 30 messages per second overall and 1 message per second per chat
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_buckets = ChatBuckets(per_chat_rate)
+
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.pending = {}  # chat ID -> [(command, invocation, send_message kwargs), ...] not picked up by a sender yet
+        self.retrying = {}  # chat ID -> [Reply, ...] put back by a sender until the chat can be sent to again
+        self.active = set()  # chat IDs scheduled or being sent to, so that only one sender handles a chat at a time
+
+        # Heap of (time the chat can be sent to, chat ID), so that senders only wait while no chat is due
+        # instead of each sleeping on the chat they picked up (for the linger, the rate limits or a retry)
+        self.schedule = []
+        self.due = threading.Condition(self.lock)
+        self.stopping = False
+
+        self.threads = [threading.Thread(target=self._run, name=f'Outbox_{i}', daemon=True) for i in range(workers)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def send_message(self, chat_id, text, **kwargs):
+        # Remember the command and handler call so that the API call is still attributed to it in /stats, and so that
+        # only the replies of the same handler call are coalesced
+        with self.lock:
+            self.pending.setdefault(chat_id, []).append(
+                (metrics.current_command(), metrics.current_invocation(), dict(kwargs, text=text)))
+            if chat_id not in self.active:
+                self.active.add(chat_id)
+                self._schedule(chat_id, self.linger)
+
+    def _schedule(self, chat_id, delay):
+        # Called with the lock held
+        heapq.heappush(self.schedule, (time.monotonic() + delay, chat_id))
+        self.due.notify()
+
+    def _next_chat(self):
+        # Blocks until a chat is due, returns None once the outbox is stopped
+        with self.lock:
+            while not self.stopping:
+                timeout = None
+                if self.schedule:
+                    timeout = self.schedule[0][0] - time.monotonic()
+                    if timeout <= 0:
+                        return heapq.heappop(self.schedule)[1]
+
+                self.due.wait(timeout)
+
+    def _send(self, chat_id, reply):
+        # Returns None once the reply is sent or given up on, otherwise the number of seconds to wait before trying again
+        chat_bucket = self.chat_buckets.get(chat_id)
+        wait = chat_bucket.try_acquire()
+        if wait > 0:
+            return wait
+
+        wait = self.global_bucket.try_acquire()
+        if wait > 0:
+            chat_bucket.refund()
+            return wait
+
+        try:
+            self.bot.send_message(chat_id=chat_id, **reply.kwargs)
+            return None
+
+        except RetryAfter as e:
+            logger.warning('Reply to %s hit flood control, retrying in %s seconds', chat_id, e.retry_after)
+            delay = e.retry_after
+
+        # Blocked the bot, deleted account or invalid chat (BadRequest is a subclass of NetworkError)
+        except (Unauthorized, BadRequest) as e:
+            logger.info('Reply to %s failed permanently: %s', chat_id, e)
+            return None
+
+        except (TimedOut, NetworkError) as e:
+            logger.warning('Reply to %s failed (attempt %d): %s', chat_id, reply.attempts + 1, e)
+            delay = 2 ** reply.attempts
+
+        reply.attempts += 1
+        if reply.attempts > self.max_retries:
+            logger.warning('Dropped reply to %s after %d attempts', chat_id, reply.attempts)
+            return None
+
+        return delay
+
+    def _run(self):
+        for chat_id in iter(self._next_chat, None):
+            with self.lock:
+                replies = self.retrying.pop(chat_id, []) + [Reply(command, kwargs) for command, invocation, kwargs
+                                                            in coalesce(self.pending.pop(chat_id, []))]
+
+            delay = None
+            while replies:
+                try:
+                    with metrics.attributed_to(replies[0].command):
+                        delay = self._send(chat_id, replies[0])
+
+                except Exception:
+                    logger.exception('Unexpected error while replying to %s', chat_id)
+                    delay = None
+
+                if delay is not None:
+                    break
+                replies.pop(0)
+
+            with self.lock:
+                # Replies left over or queued while sending are picked up by a sender again, in order
+                if replies:
+                    self.retrying[chat_id] = replies
+                    self._schedule(chat_id, delay)
+                elif chat_id in self.pending:
+                    self._schedule(chat_id, self.linger)
+                else:
+                    self.active.discard(chat_id)
+                    if not self.active:
+                        self.idle.notify_all()
+
+    def flush(self, timeout=None):
+        # Wait until every queued reply has been sent, returns False on timeout
+        with self.lock:
+            return self.idle.wait_for(lambda: not self.active, timeout)
+
+    def stop(self, timeout=10):
+        self.flush(timeout)
+        with self.lock:
+            self.stopping = True
+            self.due.notify_all()
+
+
+class QueuedBot:
+    # Passed to handlers instead of the Bot: send_message goes through the outbox and returns immediately,
+    # everything else goes straight to the Bot
+    def __init__(self, bot, outbox):
+        self.direct = bot  # For sends whose outcome matters, e.g. BroadcastEngine's delivery tracking
+        self.outbox = outbox
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.outbox.send_message(chat_id, text, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.direct, name)
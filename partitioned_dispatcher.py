@@ -0,0 +1,90 @@
+# Runs the Dispatcher's handlers on a pool of partitions keyed by user ID
+# Updates from the same user are handled one at a time and in order (so /hint cooldowns and /register conversations
+# cannot race), while updates from different users are handled in parallel, so a slow claim only delays its partition
+
+from telegram.ext import ConversationHandler
+from queue import Queue
+import threading
+import logging
+import metrics
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def partition_key(update):
+    # Updates are keyed by user ID (or chat ID), errors from polling have neither and get 0
+    user = getattr(update, 'effective_user', None)
+    chat = getattr(update, 'effective_chat', None)
+
+    return user.id if user is not None else chat.id if chat is not None else 0
+
+
+class PartitionSafeConversationHandler(ConversationHandler):
+    # ConversationHandler keeps the conversation matched by check_update in instance attributes until handle_update runs;
+    # keep them per thread so that partitions can handle different users' conversations at the same time
+    def __init__(self, *args, **kwargs):
+        self.local = threading.local()
+        super(PartitionSafeConversationHandler, self).__init__(*args, **kwargs)
+
+    @property
+    def current_conversation(self):
+        return getattr(self.local, 'current_conversation', None)
+
+    @current_conversation.setter
+    def current_conversation(self, value):
+        self.local.current_conversation = value
+
+    @property
+    def current_handler(self):
+        return getattr(self.local, 'current_handler', None)
+
+    @current_handler.setter
+    def current_handler(self, value):
+        self.local.current_handler = value
+
+
+class PartitionedDispatcher:
+    def __init__(self, dispatcher, partitions=8):
+        self.dispatcher = dispatcher
+        self.process_update = dispatcher.process_update  # The Dispatcher's own method, run by the partitions
+
+        self.queues = [Queue() for _ in range(partitions)]  # (time queued, update), or None to stop a partition
+        self.threads = [threading.Thread(target=self._run, args=(i,), name=f'Partition_{i}', daemon=True)
+                        for i in range(partitions)]
+
+        metrics.registry.add_gauge('hostelhunt_dispatcher_queue_depth', 'partition', self.queue_depths)
+
+    def install(self):
+        # Dispatcher.start() hands every update to `process_update`, which now only queues it on its partition
+        for thread in self.threads:
+            thread.start()
+
+        self.dispatcher.process_update = self.submit
+
+    def partition(self, update):
+        return partition_key(update) % len(self.queues)
+
+    def submit(self, update):
+        self.queues[self.partition(update)].put((time.perf_counter(), update))
+
+    def _run(self, partition):
+        for queued, update in iter(self.queues[partition].get, None):
+            metrics.registry.observe_dispatcher_wait(f'{partition}', time.perf_counter() - queued)
+
+            try:
+                self.process_update(update)
+
+            except Exception:
+                logger.exception('Unexpected error while processing an update in partition %d', partition)
+
+    def queue_depths(self):
+        return {f'{i}': queue.qsize() for i, queue in enumerate(self.queues)}
+
+    def stop(self, timeout=10):
+        # Let the partitions finish the updates already queued
+        for queue in self.queues:
+            queue.put(None)
+
+        for thread in self.threads:
+            thread.join(timeout)
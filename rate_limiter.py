@@ -0,0 +1,57 @@
+# Thread-safe token bucket used to stay within Telegram's flood limits
+# Read more here: https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        # `rate` is in tokens per second, `capacity` is the largest burst allowed
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def try_acquire(self):
+        # Returns 0 if a token was taken, otherwise the number of seconds until one is available
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+
+            return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        # Give back a token taken by try_acquire that ended up unused
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    def acquire(self):
+        # Block until a token is available
+        wait = self.try_acquire()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.try_acquire()
+
+
+class ChatBuckets:
+    # One token bucket per chat, created the first time the chat is sent to, with bursts of a single message
+    def __init__(self, rate):
+        self.rate = rate
+        self.buckets = {}  # chat ID -> TokenBucket
+        self.lock = threading.Lock()
+
+    def get(self, chat_id):
+        with self.lock:
+            if chat_id not in self.buckets:
+                self.buckets[chat_id] = TokenBucket(self.rate, 1)
+
+            return self.buckets[chat_id]
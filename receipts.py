@@ -0,0 +1,97 @@
+# Signed claim receipts that the prize desk can verify without any database reads
+# A receipt is the claim's token, colour, claimant and time, followed by an HMAC-SHA256 tag over them, both base64url
+# encoded into a short ASCII string (easy to copy or to turn into a QR code). The tag doubles as the receipt's ID
+# in the revocation list, which is synced periodically from the storage backend
+
+import threading
+import logging
+import base64
+import hashlib
+import hmac
+import time
+
+logger = logging.getLogger(__name__)
+
+# Length of the HMAC tag kept in receipts, unit in bytes
+TAG_LENGTH = 16
+
+
+def _encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class ReceiptSigner:
+    def __init__(self, secret):
+        self.key = secret.encode('utf-8') if isinstance(secret, str) else secret
+
+    def _tag(self, payload):
+        return hmac.new(self.key, payload, hashlib.sha256).digest()[:TAG_LENGTH]
+
+    def issue(self, token, color, claimant, claimed_at=None):
+        claimed_at = int(claimed_at if claimed_at is not None else time.time())
+        payload = f'{token}|{color}|{claimant}|{claimed_at}'.encode('utf-8')
+
+        return f'{_encode(payload)}.{_encode(self._tag(payload))}'
+
+    def verify(self, receipt):
+        # Returns {receipt_id, token, color, claimant, claimed_at} if the receipt is authentic, otherwise None
+        try:
+            payload, tag = receipt.strip().split('.')
+            payload, tag = _decode(payload), _decode(tag)
+            if not hmac.compare_digest(tag, self._tag(payload)):
+                return None
+
+            # Tokens could contain '|', the other fields cannot
+            token, color, claimant, claimed_at = payload.decode('utf-8').rsplit('|', 3)
+
+        except ValueError:
+            return None
+
+        return {u'receipt_id': _encode(tag), u'token': token, u'color': color, u'claimant': claimant,
+                u'claimed_at': int(claimed_at)}
+
+
+class RevocationList:
+    def __init__(self, connector, interval=60):
+        self.connector = connector
+        self.interval = interval  # Unit in seconds
+
+        self.lock = threading.Lock()
+        self.revoked = set()  # Receipt IDs
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='RevocationList', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def sync(self):
+        try:
+            revoked = self.connector.get_revoked_receipts()
+
+        except Exception as e:
+            logger.warning('Failed to sync the receipt revocation list: %s', e)
+            return
+
+        with self.lock:
+            self.revoked = set(revoked)
+
+    def _run(self):
+        self.sync()
+        while not self.stop_event.wait(self.interval):
+            self.sync()
+
+    def revoke(self, receipt_id, revoked_by):
+        # Takes effect locally right away, other processes pick it up on their next sync
+        self.connector.revoke_receipt(receipt_id, revoked_by)
+        with self.lock:
+            self.revoked.add(receipt_id)
+
+    def is_revoked(self, receipt_id):
+        return receipt_id in self.revoked
+
+    def stop(self):
+        self.stop_event.set()
@@ -5,3 +5,6 @@ INVALID_CLAIM_1 = 'Please provide a valid token!'
 INVALID_CLAIM_2 = 'I am sorry, but that token has been claimed by someone else! Try finding another token!'
 INVALID_CLAIM_3 = 'Please provide one token at a time!\r\n\r\nFormat of message: /claim <token>'
 INVALID_CLAIM_4 = 'Please provide the token together when sending the command!\r\n\r\nFormat of message: /claim <token>'
+CLAIM_LOCKED = 'Too many invalid tokens have been claimed from your account. Please try again in {} seconds.'
+CLAIM_BUSY = 'The bot is currently processing many claims. Please try claiming the token again in a moment!'
+BOT_STARTING = 'The bot is still starting up. Please try again in a moment!'
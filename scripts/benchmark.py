@@ -0,0 +1,295 @@
+# Benchmark of the FirebaseConnector methods against the Firestore emulator
+# For each dataset size, the emulator is cleared and seeded with that many tokens and registered participants,
+# then every method is timed cold (on a fresh connector, including its first listener snapshots) and warm,
+# and the documents read per call are counted with the same instrumentation as /metrics
+# Start the emulator first (gcloud beta emulators firestore start --host-port=localhost:8080), then run from the
+# repository root: FIRESTORE_EMULATOR_HOST=localhost:8080 python3 scripts/benchmark.py --sizes 100 1000 10000
+# Compare with an earlier run with --baseline old.json, which exits with 1 if anything regressed past the thresholds
+
+# Import libraries
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import itertools
+import subprocess
+import urllib.request
+from collections import OrderedDict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from common import COLORS, percentile
+from hint_pool import HINT_ORDER
+from storage_backend import MAX_BATCH_SIZE
+
+USER_ID_BASE = 100000000
+
+
+class Dataset:
+    # Arguments for the benchmarked calls; claims use up the tokens in order so that every claim succeeds,
+    # and registrations use new users and student IDs so that every registration creates its `student_ids` document
+    def __init__(self, size, seed):
+        self.size = size
+        self.random = random.Random(seed)
+        self.tokens = [f'TOKEN{i:06d}' for i in range(size)]
+        self.unclaimed = iter(self.tokens)
+        self.hashes = []
+        self.registrations = itertools.count(size)
+
+    def user(self):
+        return USER_ID_BASE + self.random.randrange(self.size)
+
+    def token(self):
+        return self.random.choice(self.tokens)
+
+    def claim(self):
+        token = next(self.unclaimed, None)
+        if token is None:
+            raise RuntimeError(f'All {self.size} tokens are claimed, a smaller --repeat is needed')
+
+        verification_hash = f'$benchmark${len(self.hashes)}'
+        self.hashes.append(verification_hash)
+        return self.user(), token, verification_hash
+
+    def registration(self):
+        n = next(self.registrations)
+        return USER_ID_BASE + n, 1000000 + n
+
+    def claimed_hash(self):
+        return self.random.choice(self.hashes) if self.hashes else '$benchmark$missing'
+
+
+# Connector methods and how to call them, in the order they are benchmarked (claims come before the hash lookups)
+METHODS = OrderedDict([
+    ('get_current_users', lambda connector, data: connector.get_current_users()),
+    ('get_all_users', lambda connector, data: connector.get_all_users()),
+    ('get_all_current_student_id', lambda connector, data: connector.get_all_current_student_id()),
+    ('is_registered', lambda connector, data: connector.is_registered(data.user())),
+    ('get_name', lambda connector, data: connector.get_name(data.user())),
+    ('get_student_id', lambda connector, data: connector.get_student_id(data.user())),
+    ('register_student_id', lambda connector, data: connector.register_student_id(*data.registration())),
+    ('get_hint', lambda connector, data: connector.get_hint(data.user())),
+    ('get_all_tokens', lambda connector, data: connector.get_all_tokens()),
+    ('get_unclaimed_tokens', lambda connector, data: connector.get_unclaimed_tokens()),
+    ('is_unclaimed', lambda connector, data: connector.is_unclaimed(data.token())),
+    ('claim_token', lambda connector, data: connector.claim_token(*data.claim())),
+    ('get_all_hash', lambda connector, data: connector.get_all_hash()),
+    ('get_hash_claim', lambda connector, data: connector.get_hash_claim(data.claimed_hash())),
+    ('get_verification', lambda connector, data: connector.get_verification(data.claimed_hash())),
+    ('get_progress', lambda connector, data: connector.get_progress(data.user())),
+    ('get_leaderboard', lambda connector, data: connector.get_leaderboard()),
+])
+
+# Calls made to each method per dataset size besides the `repeat` timed ones: one cold and one to warm up
+UNTIMED_CALLS = 2
+
+
+def clear_emulator(host, project):
+    request = urllib.request.Request(f'http://{host}/emulator/v1/projects/{project}/databases/(default)/documents',
+                                     method='DELETE')
+    urllib.request.urlopen(request).close()
+
+
+def seed(db, size):
+    # `size` tokens spread over the colour documents (written in chunks, since a colour document is a single map)
+    # and `size` registered participants, plus the `progress` counters
+    writes = []
+    for color_index, color in enumerate(COLORS):
+        tokens = [f'TOKEN{i:06d}' for i in range(color_index, size, len(COLORS))]
+        for i in range(0, len(tokens), MAX_BATCH_SIZE):
+            chunk = {token: dict({order: f'{order} of {token}' for order in HINT_ORDER},
+                                 claimant=u'', claimed=False, hash=u'') for token in tokens[i:i + MAX_BATCH_SIZE]}
+            writes.append((db.collection(u'tokens').document(color), chunk, True))
+        writes.append((db.collection(u'progress').document(color), {u'claimed': 0, u'total': len(tokens)}, False))
+
+    for i in range(size):
+        writes.append((db.collection(u'participants').document(f'{USER_ID_BASE + i}'),
+                       {u'name': f'User{i}', u'student_id': 1000000 + i, u'last_hint': None}, False))
+
+    for i in range(0, len(writes), MAX_BATCH_SIZE):
+        batch = db.batch()
+        for ref, data, merge in writes[i:i + MAX_BATCH_SIZE]:
+            batch.set(ref, data, merge=merge)
+        batch.commit()
+
+
+def reads(registry, include_listeners=True):
+    return sum(count for command, count in registry.documents_read.items()
+               if include_listeners or command != 'listener')
+
+
+def stop_listeners(connector):
+    for watch in (connector.participants_watch, connector.tokens_watch):
+        if watch is not None:
+            watch.unsubscribe()
+
+
+def benchmark_size(FirebaseConnector, registry, data, repeat):
+    results = OrderedDict()
+
+    # Cold: what a freshly started bot reads and waits for before it can answer the call
+    # Only one connector listens at a time, so that every listener read is counted once
+    for name, call in METHODS.items():
+        connector = FirebaseConnector()
+        before = reads(registry)
+        start = time.perf_counter()
+        connector.start()
+        call(connector, data)
+        cold = time.perf_counter() - start
+        connector.wait_synced()
+        results[name] = {'cold_ms': round(cold * 1000, 3), 'cold_reads': reads(registry) - before}
+        stop_listeners(connector)
+
+    # Warm: one connector whose caches have synced, shared by every method
+    warm_connector = FirebaseConnector()
+    warm_connector.start()
+    warm_connector.wait_synced()
+
+    for name, call in METHODS.items():
+        call(warm_connector, data)
+        samples = []
+        before = reads(registry, include_listeners=False)
+        for _ in range(repeat):
+            start = time.perf_counter()
+            call(warm_connector, data)
+            samples.append(time.perf_counter() - start)
+        warm_reads = (reads(registry, include_listeners=False) - before) / repeat
+
+        samples.sort()
+        results[name].update({
+            'warm_p50_ms': round(percentile(samples, 50) * 1000, 3),
+            'warm_p95_ms': round(percentile(samples, 95) * 1000, 3),
+            'warm_reads': warm_reads,
+        })
+
+    stop_listeners(warm_connector)
+
+    return results
+
+
+def compare(results, baseline, threshold, min_ms):
+    # A metric regressed if it grew by more than `threshold` (relative), and by more than `min_ms` for timings
+    # so that sub-millisecond noise on warm cache hits is not reported
+    regressions = []
+    for size, methods in results['sizes'].items():
+        previous_methods = baseline.get('sizes', {}).get(size, {})
+        if 'error' in methods or 'error' in previous_methods:
+            continue
+
+        for name, current in methods.items():
+            previous = previous_methods.get(name)
+            if previous is None:
+                continue
+
+            for key, value in current.items():
+                if key not in previous:
+                    continue
+                floor = min_ms if key.endswith('_ms') else 0
+                if value > previous[key] * (1 + threshold) and value - previous[key] > floor:
+                    regressions.append(f'{size} {name} {key}: {previous[key]} -> {value}')
+
+    return regressions
+
+
+def print_results(results):
+    for size, methods in results['sizes'].items():
+        print(f'\n{size} tokens and participants')
+        if 'error' in methods:
+            print(f'  Skipped: {methods["error"]}')
+            continue
+
+        print(f'{"method":<28}{"cold ms":>10}{"reads":>8}{"p50 ms":>10}{"p95 ms":>10}{"reads":>8}')
+        for name, result in methods.items():
+            print(f'{name:<28}{result["cold_ms"]:>10.2f}{result["cold_reads"]:>8}'
+                  f'{result["warm_p50_ms"]:>10.2f}{result["warm_p95_ms"]:>10.2f}{result["warm_reads"]:>8.1f}')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the FirebaseConnector methods against the Firestore emulator.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000],
+                        help='numbers of tokens and participants to seed (default: 100 1000 10000 100000)')
+    parser.add_argument('--repeat', type=int, default=20, help='warm calls timed per method')
+    parser.add_argument('--seed', type=int, default=2020)
+    parser.add_argument('--output', default='benchmark.json', help='JSON file to save the results to')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='relative increase of a timing or read count reported as a regression (default: 0.25)')
+    parser.add_argument('--min-ms', type=float, default=1.0,
+                        help='timing increases smaller than this are never regressions (default: 1.0)')
+    args = parser.parse_args()
+
+    # Every claim needs a token of its own, otherwise the later claims only measure "already claimed"
+    if min(args.sizes) < args.repeat + UNTIMED_CALLS:
+        parser.error(f'every size must be at least --repeat + {UNTIMED_CALLS}, so that each claim has a token')
+
+    host = os.environ.get('FIRESTORE_EMULATOR_HOST')
+    if not host:
+        sys.exit('FIRESTORE_EMULATOR_HOST is not set, refusing to run against a real Firestore project.')
+
+    # credentials.py reads the bot's configuration from the environment at import time
+    os.environ.setdefault('TELEGRAM_TOKEN', '0:benchmark')
+    os.environ.setdefault('MASTER_TOKEN', '1')
+    os.environ.setdefault('ADMIN_LIST', '[1]')
+    os.environ.setdefault('SUTD_AUTH', "['benchmark']")
+    os.environ.setdefault('WEBHOOK_URL', 'http://localhost/')
+
+    import metrics
+    metrics.instrument_firestore()
+    from firebase_connector import FirebaseConnector
+    from google.api_core.exceptions import InvalidArgument
+    import credentials
+
+    results = {
+        'commit': git_commit(),
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'repeat': args.repeat,
+        'sizes': OrderedDict(),
+    }
+
+    for size in args.sizes:
+        print(f'Seeding {size} tokens and participants...')
+        clear_emulator(host, credentials.FIRESTORE_PROJECT)
+        try:
+            seed(FirebaseConnector().db, size)
+
+        # e.g. a colour document going over Firestore's 1 MiB document size limit
+        except InvalidArgument as e:
+            results['sizes'][f'{size}'] = {'error': f'{e}'}
+            continue
+
+        results['sizes'][f'{size}'] = benchmark_size(FirebaseConnector, metrics.registry, Dataset(size, args.seed),
+                                                     args.repeat)
+
+    print_results(results)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f'\nResults saved to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+        regressions = compare(results, baseline, args.threshold, args.min_ms)
+        print(f'\nCompared with {args.baseline} (commit {baseline.get("commit")}): {len(regressions)} regressions')
+        for regression in regressions:
+            print(f'  {regression}')
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,11 @@
+# Helpers shared by the scripts in this directory, which run with it as their first import path
+
+# Token colours, each stored as one document of the `tokens` collection
+COLORS = ['blue', 'green', 'red', 'yellow']
+
+
+# Nearest-rank percentile of an already sorted list
+def percentile(samples, p):
+    if not samples:
+        return 0
+    return samples[min(len(samples) - 1, max(0, int(round(p / 100 * len(samples))) - 1))]
@@ -0,0 +1,306 @@
+# Offline load test harness for the bot
+# Replays synthetic traffic (registrations, hint spam, claim storms and verifications) as Telegram updates through the
+# same Dispatcher as the deployed bot (dedup, dispatcher partitions, conversations, metrics and the outbox),
+# using LocalBackend instead of Firestore and a fake Request instead of the Telegram Bot API
+# Run from the repository root: python3 scripts/load_test.py --users 200 --tokens 400
+# Lower ARGON2_MEMORY_COST in the environment to keep claim hashing cheap on a laptop, and set DISPATCHER_PARTITIONS
+# to compare partition counts (with 0, /claim runs on the run_async pool and is only timed until it is handed off)
+
+# Import libraries
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import itertools
+import threading
+from queue import Queue
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from telegram import Bot, Update
+from telegram.ext import Updater, TypeHandler
+from telegram.utils.request import Request
+import metrics
+from common import COLORS, percentile
+from hint_pool import HINT_ORDER
+
+ADMIN_ID_BASE = 1
+USER_ID_BASE = 100000000
+AUTH_TOKEN = 'load-test'
+
+
+class FakeRequest(Request):
+    # Answers the Bot API calls made through telegram.Bot like the Telegram servers would, without the network
+    def __init__(self, api_latency=0, con_pool_size=1):
+        super(FakeRequest, self).__init__(con_pool_size=con_pool_size)
+        self.api_latency = api_latency
+        self.lock = threading.Lock()
+        self.sent = defaultdict(list)  # chat ID -> texts sent to it
+        self.api_calls = 0
+        self.message_ids = itertools.count(1)
+
+    def get(self, url, timeout=None):
+        # Only getMe, used by CommandHandler to match commands addressed to the bot
+        return {'id': 1, 'is_bot': True, 'first_name': 'Hostel Hunt', 'username': 'hostelhunt_bot'}
+
+    def post(self, url, data, timeout=None):
+        # Simulate the round trip to the Telegram Bot API
+        if self.api_latency:
+            time.sleep(self.api_latency)
+
+        with self.lock:
+            self.sent[data.get('chat_id')].append(data.get('text'))
+            self.api_calls += 1
+
+        return {'message_id': next(self.message_ids), 'date': int(time.time()), 'text': data.get('text'),
+                'chat': {'id': data.get('chat_id'), 'type': 'private'}}
+
+
+class FakeUser:
+    def __init__(self, user_id, first_name):
+        self.id = user_id
+        self.first_name = first_name
+
+
+# Webhook payload of a private message, as Telegram sends it
+def make_update(update_id, user, text):
+    entities = []
+    if text.startswith('/'):
+        entities.append({'type': 'bot_command', 'offset': 0, 'length': len(text.split(None, 1)[0])})
+
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': int(time.time()), 'text': text, 'entities': entities,
+                        'from': {'id': user.id, 'is_bot': False, 'first_name': user.first_name},
+                        'chat': {'id': user.id, 'type': 'private', 'first_name': user.first_name}}}
+
+
+class LoadTest:
+    def __init__(self, updater, request, concurrency, outbox=None, duplicate_ratio=0, timeout=60):
+        self.updater = updater
+        self.request = request
+        self.outbox = outbox
+        self.concurrency = concurrency
+        self.duplicate_ratio = duplicate_ratio
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.update_ids = itertools.count(1)
+        self.pending = {}  # update ID -> Event set once every handler group has processed it
+        self.handled = defaultdict(int)  # update ID -> times handled
+        self.duplicates = 0
+        self.latencies = defaultdict(list)
+        self.durations = {}
+        self.current_phase = None
+        self.command_phases = {}
+
+        # Runs after the command handlers and _report_first_response, so the update has been fully handled
+        # Duplicates dropped by the dedup handler in group -1 never get here
+        updater.dispatcher.add_handler(TypeHandler(Update, self.mark_handled), group=2)
+
+    def mark_handled(self, bot, update):
+        with self.lock:
+            self.handled[update.update_id] += 1
+            event = self.pending.pop(update.update_id, None)
+
+        if event is not None:
+            event.set()
+
+    def send(self, command, user, text):
+        # A simulated user waits for each update to be handled before sending the next one
+        update_id = next(self.update_ids)
+        payload = make_update(update_id, user, text)
+        event = threading.Event()
+        with self.lock:
+            self.pending[update_id] = event
+
+        # Queued like the webhook does, so the Dispatcher hands it to the partitions through process_update
+        start = time.perf_counter()
+        self.updater.update_queue.put(Update.de_json(payload, self.updater.bot))
+
+        # Telegram delivers some updates more than once, e.g. when the webhook answers too slowly
+        if random.random() < self.duplicate_ratio:
+            self.updater.update_queue.put(Update.de_json(payload, self.updater.bot))
+            with self.lock:
+                self.duplicates += 1
+
+        if not event.wait(self.timeout):
+            raise RuntimeError(f'Update {update_id} ({text}) was not handled within {self.timeout} seconds')
+
+        with self.lock:
+            self.latencies[command].append(time.perf_counter() - start)
+            self.command_phases[command] = self.current_phase
+
+    def wait_for_handlers(self):
+        # Handlers on the run_async pool (/claim without dispatcher partitions) are still running when their update is
+        # marked as handled, metrics.instrument_handler observes every handler call once it has finished
+        deadline = time.perf_counter() + self.timeout
+        while time.perf_counter() < deadline:
+            with metrics.registry.lock:
+                finished = sum(histogram.count for histogram in metrics.registry.handler_latency.values())
+            with self.lock:
+                if finished >= sum(self.handled.values()):
+                    return
+            time.sleep(0.01)
+
+        raise RuntimeError(f'Handlers still running after {self.timeout} seconds')
+
+    def phase(self, name, users, task):
+        self.current_phase = name
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for future in [executor.submit(task, user) for user in users]:
+                future.result()
+        self.wait_for_handlers()
+        self.durations[name] = time.perf_counter() - start
+        print(f'Phase {name} finished in {self.durations[name]:.2f}s')
+
+        # Replies still queued are sent before the next phase, outside of the phase's timing
+        if self.outbox is not None:
+            start = time.perf_counter()
+            self.outbox.flush()
+            print(f'Replies of phase {name} drained in {time.perf_counter() - start:.2f}s')
+
+    def report(self, summary):
+        print(f'\n{"command":<10}{"count":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"req/s":>10}')
+        for command, samples in self.latencies.items():
+            samples = sorted(samples)
+            elapsed = self.durations[self.command_phases[command]]
+            print(f'{command:<10}{len(samples):>8}'
+                  f'{percentile(samples, 50) * 1000:>10.2f}'
+                  f'{percentile(samples, 95) * 1000:>10.2f}'
+                  f'{percentile(samples, 99) * 1000:>10.2f}'
+                  f'{len(samples) / elapsed:>10.1f}')
+        print(f'\nTelegram API calls: {self.request.api_calls}')
+        print(f'Duplicate deliveries: {self.duplicates}, '
+              f'handled more than once: {sum(1 for count in self.handled.values() if count > 1)}')
+        print(f'\n{summary}'.replace('\r\n\r\n', '\n'))
+
+
+# Synthetic Firestore export in the same format as sutd-hostel-hunt-bot.json
+def generate_data(tokens):
+    data = {u'participants': {}, u'tokens': {color: {} for color in COLORS}}
+    for i in range(tokens):
+        hints = {order: f'Hint {n} for token {i}' for n, order in enumerate(HINT_ORDER, 1)}
+        data[u'tokens'][COLORS[i % len(COLORS)]][f'TOKEN{i:06d}'] = dict(
+            hints, claimant=u'', claimed=False, hash=u'')
+
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay synthetic traffic through the bot handlers offline.')
+    parser.add_argument('--users', type=int, default=100, help='number of simulated participants')
+    parser.add_argument('--tokens', type=int, default=200, help='number of synthetic tokens (ignored with --data)')
+    parser.add_argument('--data', help='JSON export to load instead of synthetic tokens')
+    parser.add_argument('--hints', type=int, default=5, help='/hint requests per user')
+    parser.add_argument('--claims', type=int, default=3, help='/claim attempts per user')
+    parser.add_argument('--invalid-ratio', type=float, default=0.3, help='fraction of claims that are invalid guesses')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.05,
+                        help='fraction of updates that Telegram delivers twice')
+    parser.add_argument('--concurrency', type=int, default=16, help='number of users sending requests at the same time')
+    parser.add_argument('--api-latency', type=float, default=0, help='simulated Telegram API latency in seconds')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for an update to be handled')
+    parser.add_argument('--seed', type=int, default=2020)
+    parser.add_argument('--outbox', action='store_true',
+                        help='queue and coalesce replies like the deployed bot, with its flood limits')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    data_file = args.data
+    if data_file is None:
+        data_file = os.path.join(tempfile.mkdtemp(), 'load_test.json')
+        with open(data_file, 'w', encoding='utf-8') as f:
+            json.dump(generate_data(args.tokens), f)
+
+    # One admin per concurrent user, so that every verification gets its own chat
+    admin_ids = list(range(ADMIN_ID_BASE, ADMIN_ID_BASE + args.concurrency))
+
+    # app.py reads its configuration from the environment at import time
+    os.environ.setdefault('TELEGRAM_TOKEN', '123:offline')
+    os.environ.setdefault('MASTER_TOKEN', f'{ADMIN_ID_BASE}')
+    os.environ.setdefault('SUTD_AUTH', f'[{AUTH_TOKEN!r}]')
+    os.environ.setdefault('WEBHOOK_URL', 'http://localhost/')
+    os.environ['ADMIN_LIST'] = f'{admin_ids}'
+    os.environ['STORAGE_BACKEND'] = 'local'
+    os.environ['LOCAL_DATA_FILE'] = data_file
+    # Keep the bot's real state snapshot out of the test, in both directions
+    os.environ['STATE_SNAPSHOT_FILE'] = os.path.join(tempfile.mkdtemp(), 'state_snapshot.json')
+    if not args.outbox:
+        os.environ['OUTBOX_WORKERS'] = '0'
+
+    import app
+
+    # Normally run by app.main(), with the warm-up in the background
+    # The synthetic state must not end up in STATE_SNAPSHOT_FILE
+    app._init_services()
+    app._warm_up(write_snapshots=False)
+
+    # The Updater's run_async pool needs as many connections as it has threads, plus a few for the Dispatcher
+    request = FakeRequest(api_latency=args.api_latency, con_pool_size=args.concurrency + 4)
+    updater = Updater(bot=Bot(app.auth_key, request=request), workers=args.concurrency)
+    partitions, outbox, loop = app._setup_dispatcher(updater)
+    threading.Thread(target=updater.dispatcher.start, name='Dispatcher', daemon=True).start()
+
+    users = [FakeUser(USER_ID_BASE + i, f'User{i}') for i in range(args.users)]
+    admins = Queue()
+    for admin_id in admin_ids:
+        admins.put(FakeUser(admin_id, f'Admin{admin_id}'))
+    tokens = app.pb.get_all_tokens()
+    test = LoadTest(updater, request, args.concurrency, outbox, args.duplicate_ratio, args.timeout)
+
+    def register(user):
+        test.send('start', user, '/start')
+        test.send('register', user, '/register')
+        test.send('auth', user, AUTH_TOKEN)
+        test.send('studentid', user, f'{1000000 + user.id % 6000}')
+
+    def hint_spam(user):
+        for _ in range(args.hints):
+            test.send('hint', user, '/hint')
+
+    def claim_storm(user):
+        for _ in range(args.claims):
+            if random.random() < args.invalid_ratio or not tokens:
+                code = f'GUESS{random.randrange(10 ** 6):06d}'
+            else:
+                code = random.choice(tokens)
+            test.send('claim', user, f'/claim {code}')
+
+    def verify(user):
+        admin = admins.get()
+        try:
+            for text in list(request.sent[user.id]):
+                # Replies may have been coalesced with the ones sent before and after them
+                if 'verification hash is' in text:
+                    auth_hash = text.split('verification hash is:\r\n\r\n', 1)[1].split('\r\n', 1)[0]
+                    test.send('verify', admin, f'/verify {auth_hash}')
+
+                # Only issued if RECEIPT_SECRET is set
+                if 'receipt is:' in text:
+                    receipt = text.split('receipt is:\r\n\r\n', 1)[1].split('\r\n', 1)[0]
+                    test.send('receipt', admin, f'/verify {receipt}')
+
+        finally:
+            admins.put(admin)
+
+    try:
+        test.phase('registration', users, register)
+        test.phase('hint spam', users, hint_spam)
+        test.phase('claim storm', users, claim_storm)
+        test.phase('verification', users, verify)
+        test.report(metrics.registry.summary())
+
+    finally:
+        updater.dispatcher.stop()
+        app._stop(partitions, outbox, loop, write_snapshot=False)
+        app.hasher.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+# Export and restore of the game state (`participants` and `tokens`) as JSONL
+# Collections are paged through with query cursors and streamed line by line, so memory use does not grow with their size
+# Export: python3 scripts/state_backup.py export backup.jsonl
+# Restore: python3 scripts/state_backup.py import backup.jsonl --workers 4
+# A restore that fails or is interrupted can be rerun with the same command, it resumes after the last committed batch
+# Restored tokens do not update the /progress counters, run token_adder.py --rebuild-progress afterwards
+
+# Import libraries
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core.exceptions import Aborted, DeadlineExceeded, ServiceUnavailable
+from google.cloud import firestore
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+
+from firebase_connector import iter_documents
+from storage_backend import MAX_BATCH_SIZE
+
+COLLECTIONS = ['participants', 'tokens']
+
+# Number of times a batch is retried on transient errors, with exponential backoff starting at 1 second
+MAX_ATTEMPTS = 5
+
+# Firestore Client connection, established by main() so that importing this module needs no credentials
+db = None
+
+
+def export(path, collections, page_size):
+    # One line per participant and one line per token, written to a temporary file first
+    # so that a failed export never leaves a truncated backup behind
+    counts = {collection: 0 for collection in collections}
+    tmp_path = f'{path}.tmp'
+
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for collection in collections:
+            for snapshot in iter_documents(db, collection, page_size):
+                if collection == 'tokens':
+                    for token, value in (snapshot.to_dict() or {}).items():
+                        f.write(json.dumps({'collection': collection, 'id': snapshot.id, 'token': token, 'data': value},
+                                           default=str) + '\n')
+                        counts[collection] += 1
+                else:
+                    f.write(json.dumps({'collection': collection, 'id': snapshot.id, 'data': snapshot.to_dict()},
+                                       default=str) + '\n')
+                    counts[collection] += 1
+
+    os.replace(tmp_path, path)
+
+    for collection, count in counts.items():
+        print(f'{collection}: {count} exported')
+
+
+def read_batches(path, skip, batch_size):
+    # Yields (line number after the batch, [(reference, data, merge)], {collection: rows}) with at most `batch_size`
+    # writes each, skipping the first `skip` lines, without reading the rest of the file ahead
+    writes, tokens, rows = [], {}, {}
+    size = 0  # Rows count separately even when merged, so that no single write grows past `batch_size` tokens
+    line_number = skip
+
+    def flush():
+        return line_number, writes + [(db.collection(u'tokens').document(color), value, True)
+                                      for color, value in tokens.items()], rows
+
+    with open(path, 'r', encoding='utf-8') as f:
+        for i, line in enumerate(f):
+            if i < skip or not line.strip():
+                continue
+
+            row = json.loads(line)
+            collection = row['collection']
+            if collection == 'participants':
+                data = row['data']
+                # Keep the `student_ids` uniqueness index used by registrations in step with the participants
+                cost = 2 if data.get(u'student_id') else 1
+            elif collection == 'tokens':
+                # Tokens of the same colour within a batch are merged into a single write to their colour document
+                cost = 1
+            else:
+                raise ValueError(f'Unknown collection on line {i + 1} of {path}: {collection}')
+
+            if size + cost > batch_size:
+                yield flush()
+                writes, tokens, rows = [], {}, {}
+                size = 0
+
+            if collection == 'participants':
+                writes.append((db.collection(u'participants').document(row['id']), data, False))
+                if cost == 2:
+                    writes.append((db.collection(u'student_ids').document(f'{data[u"student_id"]}'),
+                                   {u'user_id': row['id']}, False))
+            else:
+                tokens.setdefault(row['id'], {})[row['token']] = row['data']
+
+            size += cost
+            rows[collection] = rows.get(collection, 0) + 1
+            line_number = i + 1
+
+    if writes or tokens:
+        yield flush()
+
+
+def commit(writes):
+    for attempt in range(MAX_ATTEMPTS):
+        batch = db.batch()
+        for ref, data, merge in writes:
+            batch.set(ref, data, merge=merge)
+
+        try:
+            batch.commit()
+            return
+
+        except (Aborted, DeadlineExceeded, ServiceUnavailable):
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(2 ** attempt)
+
+
+class Checkpoint:
+    # Number of input lines whose writes are all committed, kept in `<input>.checkpoint`
+    # Batches may finish out of order, so it only advances past a batch once every batch before it has finished
+    def __init__(self, path):
+        self.path = f'{path}.checkpoint'
+        self.lock = threading.Lock()
+        self.done = {}  # Batch number -> line number after the batch, for batches finished ahead of the checkpoint
+        self.next_batch = 0
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.lines = int(f.read().strip() or 0)
+        except FileNotFoundError:
+            self.lines = 0
+
+    def complete(self, batch_number, line_number):
+        with self.lock:
+            self.done[batch_number] = line_number
+            if self.next_batch not in self.done:
+                return
+
+            while self.next_batch in self.done:
+                self.lines = self.done.pop(self.next_batch)
+                self.next_batch += 1
+
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(f'{self.lines}')
+            os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def restore(path, workers, batch_size, restart=False):
+    checkpoint = Checkpoint(path)
+    if restart:
+        checkpoint.clear()
+        checkpoint.lines = 0
+    elif checkpoint.lines:
+        print(f'Resuming after line {checkpoint.lines}')
+
+    counts = {}
+    errors = []
+    lock = threading.Lock()
+    # Bound the batches read ahead of the workers, so memory stays constant however large the input is
+    in_flight = threading.BoundedSemaphore(workers * 2)
+
+    def run(batch_number, line_number, writes, rows):
+        try:
+            if not errors:
+                commit(writes)
+                checkpoint.complete(batch_number, line_number)
+                with lock:
+                    for collection, count in rows.items():
+                        counts[collection] = counts.get(collection, 0) + count
+
+        except Exception as e:
+            errors.append(e)
+
+        finally:
+            in_flight.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch_number, (line_number, writes, rows) in enumerate(read_batches(path, checkpoint.lines, batch_size)):
+            in_flight.acquire()
+            if errors:
+                in_flight.release()
+                break
+            executor.submit(run, batch_number, line_number, writes, rows)
+
+    for collection, count in sorted(counts.items()):
+        print(f'{collection}: {count} restored')
+
+    if errors:
+        sys.exit(f'Restore stopped after line {checkpoint.lines}: {errors[0]}\nRerun the same command to resume.')
+
+    checkpoint.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export or restore participants and tokens as JSONL.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    export_parser = subparsers.add_parser('export', help='stream collections to a JSONL file')
+    export_parser.add_argument('path', help='output JSONL file')
+    export_parser.add_argument('--collections', nargs='+', choices=COLLECTIONS, default=COLLECTIONS,
+                               help='collections to export (default: all)')
+    export_parser.add_argument('--page-size', type=int, default=MAX_BATCH_SIZE,
+                               help=f'documents read per query (default: {MAX_BATCH_SIZE})')
+
+    import_parser = subparsers.add_parser('import', help='restore a JSONL file written by export')
+    import_parser.add_argument('path', help='input JSONL file')
+    import_parser.add_argument('--workers', type=int, default=4, help='batches committed in parallel (default: 4)')
+    import_parser.add_argument('--batch-size', type=int, default=MAX_BATCH_SIZE,
+                               help=f'writes per batch, at most {MAX_BATCH_SIZE} (default: {MAX_BATCH_SIZE})')
+    import_parser.add_argument('--restart', action='store_true', help='ignore the checkpoint and restore from the start')
+    args = parser.parse_args()
+
+    global db
+    db = firestore.Client()
+
+    if args.command == 'export':
+        export(args.path, args.collections, args.page_size)
+    else:
+        restore(args.path, args.workers, min(args.batch_size, MAX_BATCH_SIZE), args.restart)
+
+
+if __name__ == '__main__':
+    main()
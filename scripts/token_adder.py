@@ -1,26 +1,250 @@
-# Initial automation setup script to add tokens from text files to Firestore
+# Automation script to add tokens and hints to Firestore
 # Created by James Raphael Tiovalen (2019)
+# Tokens are read from CSV/JSONL files (or the legacy <color>_tokens.txt files) and diffed against Firestore,
+# so that only new tokens and changed hints are written and existing claims are never touched
+# The token totals of the `progress` counters used by /progress are updated in the same batch
+# Optional `first_hint_release`, `second_hint_release` and `third_hint_release` columns (Unix timestamps or ISO 8601
+# times) schedule when each hint becomes available to /hint, otherwise the bot's HINT_POLICY decides
+# Safe to rerun during a live event: python3 scripts/token_adder.py tokens.csv --dry-run
 
 # Import libraries
+import os
+import sys
+import csv
+import json
+import argparse
+import datetime
+from collections import OrderedDict
+from google.api_core.exceptions import FailedPrecondition
 from google.cloud import firestore
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+
 import credentials
+from common import COLORS
+from hint_pool import HINT_ORDER
+from storage_backend import MAX_BATCH_SIZE
+
+RELEASE_FIELDS = [f'{order}_release' for order in HINT_ORDER]
+
+# Number of times the diff is recomputed if a colour document changes (e.g. a claim) while writing
+MAX_ATTEMPTS = 3
 
 # Establish Firestore Client connection
 db = firestore.Client()
 
 
-# Parse data from text files and store as dictionaries
-def parser(color):
-    colored_tokens = {}
-    for token in open(f"{color}_tokens.txt", "r"):
-        token = token.rstrip('\n')
-        colored_tokens[f'{token}'] = {
-            u'claimant': u'', u'claimed': False, u'hash': u'', u'first_hint': u'', u'second_hint': u'', u'third_hint': u''}
+# Parse data from text files (one token per line, no hints)
+def parse_txt(path, color):
+    with open(path, 'r', encoding='utf-8') as f:
+        for token in f:
+            token = token.strip()
+            if token:
+                yield {'color': color, 'token': token}
+
+
+# Parse rows with `color`, `token` and optionally `first_hint`, `second_hint` and `third_hint` columns
+def parse_csv(path):
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        yield from csv.DictReader(f)
+
+
+# Parse one JSON object per line with the same keys as the CSV columns
+def parse_jsonl(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+# Release times are stored as Unix timestamps
+def parse_release(value):
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value.strip()).timestamp()
+
+
+def read_tokens(paths, color=None):
+    # Returns {color: {token: {hint field: hint}}}, later rows override earlier ones
+    if not paths:
+        paths = [os.path.join(SCRIPT_DIR, f'{c}_tokens.txt') for c in COLORS]
+
+    wanted = OrderedDict()
+    for path in paths:
+        if path.endswith('.csv'):
+            rows = parse_csv(path)
+        elif path.endswith('.jsonl'):
+            rows = parse_jsonl(path)
+        else:
+            # Legacy text files are named after their colour
+            rows = parse_txt(path, color or os.path.basename(path).split('_')[0])
+
+        for row in rows:
+            token_color = (row.get('color') or '').strip().lower()
+            token = (row.get('token') or '').strip()
+            if token_color not in COLORS or not token:
+                raise ValueError(f'Invalid row in {path}: {row}')
+
+            # Empty or missing hints leave the current hint unchanged
+            hints = {order: row[order] for order in HINT_ORDER if row.get(order)}
+            hints.update({field: parse_release(row[field]) for field in RELEASE_FIELDS if row.get(field)})
+            wanted.setdefault(token_color, OrderedDict()).setdefault(token, {}).update(hints)
+
+    return wanted
+
+
+def diff(current, wanted, remove_missing=False):
+    # Returns the {(token, hint field or None): value} changes for one colour document and a report of what they do
+    changes = {}
+    report = {'added': [], 'updated': [], 'removed': [], 'unchanged': 0, 'kept_claimed': []}
+
+    for token, hints in wanted.items():
+        if token not in current:
+            changes[(token, None)] = {u'claimant': u'', u'claimed': False, u'hash': u'',
+                                        **{order: hints.get(order, u'') for order in HINT_ORDER},
+                                        **{field: hints[field] for field in RELEASE_FIELDS if field in hints}}
+            report['added'].append(token)
+            continue
+
+        # Only hint fields and their release times are ever updated, so the claim state of existing tokens is preserved
+        changed = {order: hint for order, hint in hints.items() if current[token].get(order) != hint}
+        for order, hint in changed.items():
+            changes[(token, order)] = hint
+
+        if changed:
+            report['updated'].append(token)
+        else:
+            report['unchanged'] += 1
+
+    if remove_missing:
+        for token, value in current.items():
+            if token in wanted:
+                continue
+
+            if value.get('claimed'):
+                report['kept_claimed'].append(token)
+            else:
+                changes[(token, None)] = firestore.DELETE_FIELD
+                report['removed'].append(token)
+
+    return changes, report
+
+
+def plan(wanted, remove_missing=False):
+    refs = [db.collection(u'tokens').document(color) for color in wanted]
+    writes = []
+    reports = OrderedDict()
+
+    for snapshot in db.get_all(refs):
+        color = snapshot.id
+        current = snapshot.to_dict() or {}
+        changes, reports[color] = diff(current, wanted[color], remove_missing)
+        if changes:
+            writes.append((snapshot, changes))
+
+    return writes, reports
+
+
+def apply(writes):
+    # One write per colour document, guarded by its update time so that a claim made since the diff
+    # aborts the batch instead of being overwritten, plus one write to its `progress` counter
+    for i in range(0, len(writes), MAX_BATCH_SIZE // 2):
+        batch = db.batch()
+        for snapshot, changes in writes[i:i + MAX_BATCH_SIZE // 2]:
+            added = sum(1 for (token, order), value in changes.items() if order is None and isinstance(value, dict))
+            removed = sum(1 for value in changes.values() if value is firestore.DELETE_FIELD)
+            if added != removed:
+                batch.set(db.collection(u'progress').document(snapshot.id),
+                          {u'total': firestore.Increment(added - removed)}, merge=True)
+
+            if snapshot.exists:
+                field_updates = {db.field_path(*(key for key in keys if key)): value for keys, value in changes.items()}
+                batch.update(snapshot.reference, field_updates,
+                             option=db.write_option(last_update_time=snapshot.update_time))
+            else:
+                # A new colour document only has new tokens
+                batch.create(snapshot.reference, {token: value for (token, order), value in changes.items()})
+        batch.commit()
+
+
+def rebuild_progress():
+    # Recount the `progress` and `claimants` counters from the token maps, e.g. for tokens added before they existed
+    # Claims made while this runs may be counted twice or not at all, so only run it when no claims are expected
+    progress = {}
+    claimants = {}
+    for snapshot in db.collection(u'tokens').stream():
+        tokens = snapshot.to_dict() or {}
+        claimed = [value for value in tokens.values() if value.get(u'claimed') == True]
+        progress[snapshot.id] = {u'claimed': len(claimed), u'total': len(tokens)}
+
+        for value in claimed:
+            counts = claimants.setdefault(value[u'claimant'], {u'claimed': 0, u'colors': {}})
+            counts[u'claimed'] += 1
+            counts[u'colors'][snapshot.id] = counts[u'colors'].get(snapshot.id, 0) + 1
+
+    writes = [(db.collection(u'progress').document(color), counts) for color, counts in progress.items()]
+    writes += [(db.collection(u'claimants').document(claimant), counts) for claimant, counts in claimants.items()]
+    for i in range(0, len(writes), MAX_BATCH_SIZE):
+        batch = db.batch()
+        for ref, counts in writes[i:i + MAX_BATCH_SIZE]:
+            batch.set(ref, counts, merge=True)
+        batch.commit()
+
+    for color, counts in sorted(progress.items()):
+        print(f'{color}: {counts["claimed"]}/{counts["total"]} claimed')
+    print(f'{len(claimants)} claimants')
+
+
+def print_report(reports, dry_run=False):
+    prefix = 'Would apply' if dry_run else 'Applied'
+    for color, report in reports.items():
+        print(f'{color}: {len(report["added"])} added, {len(report["updated"])} updated, '
+              f'{len(report["removed"])} removed, {report["unchanged"]} unchanged')
+        for key in ['added', 'updated', 'removed']:
+            for token in report[key]:
+                print(f'  {prefix}: {key} {token}')
+        for token in report['kept_claimed']:
+            print(f'  Kept claimed token {token} (not in input)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Add tokens and hints to Firestore without touching existing claims.')
+    parser.add_argument('paths', nargs='*',
+                        help='CSV/JSONL files with color, token and hint columns, or <color>_tokens.txt files '
+                             '(defaults to the four text files next to this script)')
+    parser.add_argument('--color', choices=COLORS, help='colour of the tokens in text files not named after one')
+    parser.add_argument('--remove-missing', action='store_true',
+                        help='remove unclaimed tokens of the listed colours that are not in the input')
+    parser.add_argument('--dry-run', action='store_true', help='only report the changes')
+    parser.add_argument('--rebuild-progress', action='store_true',
+                        help='only recount the /progress counters from the token maps (run while no claims are made)')
+    args = parser.parse_args()
+
+    if args.rebuild_progress:
+        rebuild_progress()
+        return
+
+    wanted = read_tokens(args.paths, args.color)
+
+    for attempt in range(MAX_ATTEMPTS):
+        writes, reports = plan(wanted, args.remove_missing)
+        if args.dry_run or not writes:
+            break
+
+        try:
+            apply(writes)
+            break
+
+        except FailedPrecondition:
+            print('Tokens changed while writing, retrying...')
+
+    else:
+        sys.exit('Tokens kept changing while writing, nothing was applied.')
 
-    # Add dictionary to Firestore database (overwrite mode)
-    db.collection(u'tokens').document(f'{color}').set(colored_tokens)
+    print_report(reports, dry_run=args.dry_run)
 
 
-# Add entries to Firestore database
-for i in ['blue', 'green', 'red', 'yellow']:
-    parser(i)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+# Offline claim receipt checker for the prize desk
+# Needs only the bot's RECEIPT_SECRET, no network or database access:
+# RECEIPT_SECRET=<secret> python3 scripts/verify_receipt.py <receipt> [--revoked revoked.txt]
+# Without receipts as arguments, receipts are read from standard input, one per line (e.g. from a QR code scanner)
+
+# Import libraries
+import os
+import sys
+import argparse
+import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from receipts import ReceiptSigner
+
+
+def check(signer, revoked, receipt):
+    # Returns True if the receipt is valid
+    claim = signer.verify(receipt)
+
+    if claim is None:
+        print(f'INVALID  {receipt}')
+        return False
+
+    if claim['receipt_id'] in revoked:
+        print(f'REVOKED  {claim["token"]} ({claim["color"]}) claimed by {claim["claimant"]}')
+        return False
+
+    claimed_at = datetime.datetime.fromtimestamp(claim['claimed_at']).strftime('%Y-%m-%d %H:%M:%S')
+    print(f'VALID    {claim["token"]} ({claim["color"]}) claimed by {claim["claimant"]} at {claimed_at}')
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check signed claim receipts without any database access.')
+    parser.add_argument('receipts', nargs='*', help='receipts to check (read from standard input if none are given)')
+    parser.add_argument('--revoked', help='file with one revoked receipt ID per line (e.g. exported from revoked_receipts)')
+    args = parser.parse_args()
+
+    secret = os.environ.get('RECEIPT_SECRET')
+    if not secret:
+        sys.exit('RECEIPT_SECRET is not set.')
+
+    revoked = set()
+    if args.revoked:
+        with open(args.revoked, 'r', encoding='utf-8') as f:
+            revoked = {line.strip() for line in f if line.strip()}
+
+    signer = ReceiptSigner(secret)
+    receipts = args.receipts or (line.strip() for line in sys.stdin if line.strip())
+    results = [check(signer, revoked, receipt) for receipt in receipts]
+
+    sys.exit(0 if results and all(results) else 1)
+
+
+if __name__ == '__main__':
+    main()
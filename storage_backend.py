@@ -0,0 +1,157 @@
+# Storage backend interface used by the bot's handlers
+# FirebaseConnector implements it on top of Cloud Firestore and LocalBackend keeps everything in memory,
+# which allows the handlers to be exercised offline (see scripts/load_test.py)
+
+from enum import Enum
+
+# Firestore allows at most 500 writes per batch or transaction
+# Defined here rather than in firebase_connector.py so that scripts can use it before credentials.py is configured
+MAX_BATCH_SIZE = 500
+
+
+# Outcome of an atomic claim attempt
+class ClaimResult(Enum):
+    CLAIMED = 'claimed'
+    ALREADY_CLAIMED = 'already_claimed'
+    UNKNOWN = 'unknown'
+
+
+class StorageBackend:
+    # Startup
+    def start(self, snapshot=None, listen=True):
+        raise NotImplementedError
+
+    def listeners(self):
+        raise NotImplementedError
+
+    def wait_ready(self, timeout=None):
+        raise NotImplementedError
+
+    def wait_synced(self, timeout=None):
+        raise NotImplementedError
+
+    def export_snapshot(self):
+        raise NotImplementedError
+
+    # Participants
+    def is_registered(self, user_id):
+        raise NotImplementedError
+
+    def get_cache_stats(self):
+        raise NotImplementedError
+
+    def get_current_users(self):
+        raise NotImplementedError
+
+    def get_all_users(self):
+        raise NotImplementedError
+
+    def add_user(self, user_id, first_name):
+        raise NotImplementedError
+
+    def get_name(self, user_id):
+        raise NotImplementedError
+
+    def get_all_current_student_id(self):
+        raise NotImplementedError
+
+    def get_student_id(self, user_id):
+        raise NotImplementedError
+
+    def update_student_id(self, user_id, student_id):
+        raise NotImplementedError
+
+    def register_student_id(self, user_id, student_id):
+        raise NotImplementedError
+
+    def get_last_hint_time(self, user_id):
+        raise NotImplementedError
+
+    def update_last_hint_time(self, user_id, last_hint):
+        raise NotImplementedError
+
+    def get_last_hint_times(self):
+        raise NotImplementedError
+
+    def update_last_hint_times(self, last_hints):
+        raise NotImplementedError
+
+    def get_hint_alerts(self, user_id):
+        raise NotImplementedError
+
+    def set_hint_alerts(self, user_id, enabled):
+        raise NotImplementedError
+
+    def get_hint_alert_users(self):
+        raise NotImplementedError
+
+    # Tokens
+    def get_all_tokens(self):
+        raise NotImplementedError
+
+    def is_token(self, token):
+        raise NotImplementedError
+
+    def is_unclaimed(self, token):
+        raise NotImplementedError
+
+    def get_hint(self, user_id=None):
+        raise NotImplementedError
+
+    def get_unclaimed_tokens(self):
+        raise NotImplementedError
+
+    def claim_token(self, user_id, token, verification_hash):
+        raise NotImplementedError
+
+    def claim_token_atomic(self, user_id, token, verification_hash):
+        raise NotImplementedError
+
+    def get_all_hash(self):
+        raise NotImplementedError
+
+    def get_hash_claim(self, verification_hash):
+        raise NotImplementedError
+
+    def get_token_color(self, token):
+        raise NotImplementedError
+
+    def get_verification(self, verification_hash):
+        raise NotImplementedError
+
+    # Progress
+    def get_progress(self, user_id=None):
+        raise NotImplementedError
+
+    def get_leaderboard(self, limit=10):
+        raise NotImplementedError
+
+    # Broadcasts
+    def create_broadcast(self, text):
+        raise NotImplementedError
+
+    def get_broadcast(self, broadcast_id):
+        raise NotImplementedError
+
+    def get_unfinished_broadcast(self):
+        raise NotImplementedError
+
+    # Returns True if the caller may send the broadcast: it is unfinished and no other run holds an unexpired lease
+    # The lease is then held for `lease` seconds, renewed and released through update_broadcast_progress's
+    # `running_until` (a Unix timestamp, 0 to release it)
+    def acquire_broadcast(self, broadcast_id, lease):
+        raise NotImplementedError
+
+    def update_broadcast_progress(self, broadcast_id, delivered, failed, done=False, running_until=0):
+        raise NotImplementedError
+
+    # Claim receipts
+    def revoke_receipt(self, receipt_id, revoked_by):
+        raise NotImplementedError
+
+    def get_revoked_receipts(self):
+        raise NotImplementedError
+
+    # Webhook updates
+    def mark_update_seen(self, update_id, ttl):
+        raise NotImplementedError
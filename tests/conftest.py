@@ -0,0 +1,15 @@
+# Run from the repository root: python -m pytest
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# The scripts import each other as if run from their own directory
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+
+# credentials.py reads the bot's configuration from the environment at import time
+os.environ.setdefault('TELEGRAM_TOKEN', '123:test')
+os.environ.setdefault('MASTER_TOKEN', '1')
+os.environ.setdefault('ADMIN_LIST', '[1]')
+os.environ.setdefault('SUTD_AUTH', "['test']")
+os.environ.setdefault('WEBHOOK_URL', 'http://localhost/')
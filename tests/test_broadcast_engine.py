@@ -0,0 +1,110 @@
+import threading
+import time
+from collections import Counter
+
+from telegram.error import TelegramError
+
+from broadcast_engine import BroadcastEngine
+from local_backend import LocalBackend
+
+
+class FakeBot:
+    def __init__(self, fail=(), block=None):
+        self.fail = set(fail)
+        self.block = block  # Event that every send waits for
+        self.sent = Counter()
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text):
+        if self.block is not None:
+            self.block.wait(5)
+        if chat_id in self.fail:
+            raise ValueError('unexpected')
+        with self.lock:
+            self.sent[chat_id] += 1
+
+
+def engine(bot, backend, **kwargs):
+    return BroadcastEngine(bot, backend, global_rate=1000, per_chat_rate=1000, **kwargs)
+
+
+def test_resume_during_a_live_send_is_refused():
+    backend = LocalBackend()
+    broadcast_id = backend.create_broadcast('Hello')
+    chat_ids = list(range(1, 21))
+    release = threading.Event()
+    bot = FakeBot(block=release)
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(engine(bot, backend).run(broadcast_id, chat_ids)))
+    first.start()
+
+    # Wait until the first run holds the lease
+    while backend.get_broadcast(broadcast_id)[u'running_until'] == 0:
+        time.sleep(0.01)
+
+    assert backend.get_unfinished_broadcast() is None
+    assert engine(bot, backend).run(broadcast_id, chat_ids) is None
+
+    release.set()
+    first.join(5)
+
+    assert results[0][u'delivered'] == len(chat_ids)
+    assert all(bot.sent[chat_id] == 1 for chat_id in chat_ids)
+    assert backend.get_broadcast(broadcast_id)[u'done']
+    assert backend.get_broadcast(broadcast_id)[u'running_until'] == 0
+
+
+def test_unfinished_broadcasts_are_resumed_oldest_first():
+    backend = LocalBackend()
+    first = backend.create_broadcast('first')
+    second = backend.create_broadcast('second')
+    backend.broadcasts[first][u'created'], backend.broadcasts[second][u'created'] = 2, 1
+
+    assert backend.get_unfinished_broadcast() == second
+
+
+def test_failing_recipients_do_not_stop_the_broadcast():
+    backend = LocalBackend()
+    broadcast_id = backend.create_broadcast('Hello')
+
+    class FlakyBot(FakeBot):
+        def send_message(self, chat_id, text):
+            if chat_id == 5:
+                raise TelegramError('odd')
+            super().send_message(chat_id, text)
+
+    result = engine(FlakyBot(fail={3}), backend, checkpoint_every=3).run(broadcast_id, list(range(1, 11)))
+    broadcast = backend.get_broadcast(broadcast_id)
+
+    assert result == {u'delivered': 8, u'failed': 2, u'skipped': 0}
+    assert sorted(broadcast[u'failed']) == ['3', '5']
+    assert len(broadcast[u'delivered']) == 8
+    assert broadcast[u'done']
+
+
+def test_interrupted_broadcast_is_not_finished_and_can_be_resumed():
+    backend = LocalBackend()
+    broadcast_id = backend.create_broadcast('Hello')
+
+    class InterruptedBot(FakeBot):
+        def send_message(self, chat_id, text):
+            if chat_id == 3:
+                raise KeyboardInterrupt
+            super().send_message(chat_id, text)
+
+    try:
+        engine(InterruptedBot(), backend, workers=1).run(broadcast_id, [1, 2, 3])
+    except KeyboardInterrupt:
+        pass
+
+    broadcast = backend.get_broadcast(broadcast_id)
+    assert sorted(broadcast[u'delivered']) == ['1', '2']
+    assert not broadcast[u'done']
+    assert backend.get_unfinished_broadcast() == broadcast_id
+
+    bot = FakeBot()
+    result = engine(bot, backend).run(broadcast_id, [1, 2, 3])
+
+    assert result == {u'delivered': 3, u'failed': 0, u'skipped': 2}
+    assert bot.sent == Counter({3: 1})
@@ -0,0 +1,33 @@
+from claim_guard import ClaimGuard
+
+
+def test_lockouts_double_up_to_the_maximum():
+    guard = ClaimGuard(max_attempts=2, window=60, lockout=10, max_lockout=35)
+
+    assert guard.record_failure(1, now=0) == 0
+    assert guard.record_failure(1, now=1) == 0
+    assert guard.record_failure(1, now=2) == 10
+    assert guard.remaining(1, now=5) == 7
+    assert guard.remaining(1, now=12) == 0
+
+    lockouts = []
+    for start in (100, 200, 300):
+        lockouts.append([guard.record_failure(1, now=start + i) for i in range(3)][-1])
+
+    assert lockouts == [20, 35, 35]
+
+
+def test_failures_outside_the_window_do_not_count():
+    guard = ClaimGuard(max_attempts=2, window=60, lockout=10)
+
+    assert all(guard.record_failure(1, now=i * 30) == 0 for i in range(10))
+    assert guard.remaining(1, now=300) == 0
+
+
+def test_users_are_throttled_separately():
+    guard = ClaimGuard(max_attempts=1, window=60, lockout=10)
+
+    guard.record_failure(1, now=0)
+    assert guard.record_failure(1, now=1) == 10
+    assert guard.record_failure(2, now=1) == 0
+    assert guard.remaining(2, now=1) == 0
@@ -0,0 +1,56 @@
+import pytest
+from telegram.ext import DispatcherHandlerStop
+
+from dedup import SqliteUpdateStore, UpdateDeduplicator
+
+
+class FakeUpdate:
+    def __init__(self, update_id):
+        self.update_id = update_id
+
+
+def test_duplicates_are_dropped_within_the_window_only():
+    dedup = UpdateDeduplicator(ttl=600)
+
+    assert not dedup.is_duplicate(1, now=0)
+    assert dedup.is_duplicate(1, now=599)
+    assert not dedup.is_duplicate(1, now=1200)
+    assert dedup.duplicates == 1
+
+
+def test_the_oldest_updates_are_forgotten_past_the_maximum_size():
+    dedup = UpdateDeduplicator(ttl=600, max_size=2)
+    for update_id in (1, 2, 3):
+        dedup.is_duplicate(update_id, now=0)
+
+    assert list(dedup.seen) == [2, 3]
+    assert not dedup.is_duplicate(1, now=0)
+
+
+def test_check_stops_duplicates_before_the_handlers():
+    dedup = UpdateDeduplicator()
+    dedup.check(None, FakeUpdate(1))
+
+    with pytest.raises(DispatcherHandlerStop):
+        dedup.check(None, FakeUpdate(1))
+
+
+def test_sqlite_store_catches_duplicates_handled_by_another_process(tmp_path):
+    path = str(tmp_path / 'updates.sqlite3')
+    first = UpdateDeduplicator(store=SqliteUpdateStore(path))
+    second = UpdateDeduplicator(store=SqliteUpdateStore(path))
+
+    assert not first.is_duplicate(1)
+    assert second.is_duplicate(1)
+    assert not second.is_duplicate(2)
+
+
+def test_updates_are_handled_while_the_shared_store_is_unavailable():
+    class FailingStore:
+        def mark_update_seen(self, update_id, ttl):
+            raise ConnectionError('unavailable')
+
+    dedup = UpdateDeduplicator(store=FailingStore())
+
+    assert not dedup.is_duplicate(1)
+    assert dedup.is_duplicate(1)
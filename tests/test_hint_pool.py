@@ -0,0 +1,59 @@
+import pytest
+
+from hint_pool import HintPool, PROGRESSIVE
+
+
+def test_progressive_policy_needs_the_hunt_start_time():
+    # Defaulting to the current time would re-lock the second and third hints whenever the bot restarts
+    with pytest.raises(ValueError):
+        HintPool(PROGRESSIVE)
+
+
+def test_progressive_tiers_unlock_relative_to_the_hunt_start_time():
+    pool = HintPool(PROGRESSIVE, tier_interval=100, start_time=1000)
+    pool.add_token('red', 'r1', {'first_hint': 'h1', 'second_hint': 'h2', 'third_hint': 'h3'}, now=1150)
+
+    # A restart at 1150 still has the second hint unlocked, only the third waits for its release
+    assert pool.choose() in ('h1', 'h2')
+    assert pool.next_release() == 1200
+    assert pool.release_due(now=1200) == {('red', 2)}
+
+
+def assert_positions_consistent(pool):
+    for token, positions in pool.positions.items():
+        for color, tier, index in positions:
+            assert pool.entries[(color, tier)][index][0] == token
+
+
+def test_removing_a_token_swaps_the_last_hint_into_its_slot():
+    pool = HintPool()
+    for i in range(5):
+        pool.add_token('red', f't{i}', {'first_hint': f'h{i}', 'second_hint': f's{i}'}, now=0)
+
+    pool.remove_token('t1')
+    pool.remove_token('t4')  # Now in t1's old slot
+    pool.remove_token('t0')
+
+    assert len(pool) == 4
+    assert {token for token, hint in pool.entries[('red', 0)]} == {'t2', 't3'}
+    assert_positions_consistent(pool)
+    assert all(pool.choose() in ('h2', 'h3', 's2', 's3') for _ in range(50))
+
+
+def test_scheduled_hints_are_released_in_order_and_dropped_with_their_token():
+    pool = HintPool()
+    pool.add_token('red', 'r1', {'first_hint': 'r', 'first_hint_release': 300}, now=0)
+    pool.add_token('blue', 'b1', {'first_hint': 'b', 'first_hint_release': 100}, now=0)
+    pool.add_token('green', 'g1', {'first_hint': 'g', 'first_hint_release': 200}, now=0)
+
+    assert len(pool) == 0
+    assert pool.choose() == ''
+    assert pool.next_release() == 100
+
+    # A claimed token's releases stay in the heap until they reach the top, but are never released
+    pool.remove_token('g1')
+    assert pool.release_due(now=100) == {('blue', 0)}
+    assert pool.next_release() == 300
+    assert pool.release_due(now=1000) == {('red', 0)}
+    assert pool.next_release() is None
+    assert {pool.choose() for _ in range(50)} == {'b', 'r'}
@@ -0,0 +1,49 @@
+from metrics import Metrics
+
+
+def worker_metrics(handler_seconds, reads, queued):
+    worker = Metrics()
+    worker.observe_handler('hint', handler_seconds)
+    worker.add_reads(reads, command='hint')
+    worker.add_gauge('hostelhunt_dispatcher_queue_depth', 'partition', lambda: {'0': queued})
+
+    return worker.export()
+
+
+def test_render_sums_the_metrics_reported_by_the_workers():
+    front = Metrics()
+    front.add_reads(3, command='listener')
+    front.set_worker(101, worker_metrics(0.003, 1, 2))
+    front.set_worker(102, worker_metrics(0.2, 4, 5))
+
+    rendered = front.render()
+
+    assert 'hostelhunt_handler_latency_seconds_count{command="hint"} 2' in rendered
+    assert 'hostelhunt_handler_latency_seconds_bucket{command="hint",le="0.005"} 1' in rendered
+    assert 'hostelhunt_firestore_documents_read_total{command="hint"} 5' in rendered
+    assert 'hostelhunt_firestore_documents_read_total{command="listener"} 3' in rendered
+    assert 'hostelhunt_dispatcher_queue_depth{partition="0"} 7' in rendered
+
+
+def test_a_newer_report_replaces_the_previous_one_of_the_same_worker():
+    front = Metrics()
+    front.set_worker(101, worker_metrics(0.003, 1, 0))
+    front.set_worker(101, worker_metrics(0.003, 2, 0))
+
+    assert 'hostelhunt_firestore_documents_read_total{command="hint"} 2' in front.render()
+
+
+def test_counts_of_an_exited_worker_are_kept():
+    front = Metrics()
+    front.set_worker(101, worker_metrics(0.003, 4, 9))
+    front.worker_exited(101)
+    # A report still queued when the worker exited must not be counted twice
+    front.set_worker(101, worker_metrics(0.003, 4, 9))
+    front.set_worker(102, worker_metrics(0.003, 1, 0))
+
+    rendered = front.render()
+
+    assert 'hostelhunt_handler_latency_seconds_count{command="hint"} 2' in rendered
+    assert 'hostelhunt_firestore_documents_read_total{command="hint"} 5' in rendered
+    # Gauges of the exited worker no longer apply
+    assert 'hostelhunt_dispatcher_queue_depth{partition="0"} 0' in rendered
@@ -0,0 +1,67 @@
+import threading
+
+import metrics
+from outbox import coalesce, Outbox, SEPARATOR, MAX_MESSAGE_LENGTH
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self.lock:
+            self.sent.append((chat_id, text))
+
+
+def test_coalesce_merges_replies_of_the_same_handler_call():
+    messages = [('hint', 1, {'text': 'a'}), ('hint', 1, {'text': 'b'})]
+
+    assert coalesce(messages) == [('hint', 1, {'text': f'a{SEPARATOR}b'})]
+
+
+def test_coalesce_never_merges_replies_of_different_handler_calls():
+    # e.g. a /register confirmation followed by the next /hint, or a /hint cooldown reply followed by a /claim receipt
+    messages = [('register', 1, {'text': 'Successfully registered!'}),
+                ('hint', 2, {'text': 'hA2'}),
+                ('hint', 3, {'text': 'Please try again in 3599 seconds.'}),
+                ('claim', 4, {'text': 'Congratulations!'}),
+                ('claim', 4, {'text': 'Your receipt is: ...'})]
+
+    assert coalesce(messages) == [('register', 1, {'text': 'Successfully registered!'}),
+                                  ('hint', 2, {'text': 'hA2'}),
+                                  ('hint', 3, {'text': 'Please try again in 3599 seconds.'}),
+                                  ('claim', 4, {'text': f'Congratulations!{SEPARATOR}Your receipt is: ...'})]
+
+
+def test_coalesce_never_merges_background_messages():
+    messages = [('background', None, {'text': 'a'}), ('background', None, {'text': 'b'})]
+
+    assert coalesce(messages) == messages
+
+
+def test_coalesce_keeps_keyboards_options_and_length_limit():
+    keyboard = [('start', 1, {'text': 'a', 'reply_markup': 'keyboard'}), ('start', 1, {'text': 'b'})]
+    options = [('help', 1, {'text': 'a'}), ('help', 1, {'text': 'b', 'parse_mode': 'Markdown'})]
+    long = [('hint', 1, {'text': 'x' * MAX_MESSAGE_LENGTH}), ('hint', 1, {'text': 'y'})]
+
+    assert coalesce(keyboard) == keyboard
+    assert coalesce(options) == options
+    assert coalesce(long) == long
+
+
+def test_outbox_sends_replies_of_different_updates_separately():
+    bot = FakeBot()
+    outbox = Outbox(bot, global_rate=1000, per_chat_rate=1000, workers=1, linger=0.05)
+
+    with metrics.attributed_to('register'):
+        outbox.send_message(5, 'Successfully registered!')
+    with metrics.attributed_to('hint'):
+        outbox.send_message(5, 'hA2')
+        outbox.send_message(5, 'Next hint in an hour.')
+
+    outbox.start()
+    assert outbox.flush(5)
+    outbox.stop()
+
+    assert bot.sent == [(5, 'Successfully registered!'), (5, f'hA2{SEPARATOR}Next hint in an hour.')]
@@ -0,0 +1,49 @@
+from local_backend import LocalBackend
+from receipts import ReceiptSigner, RevocationList
+
+
+def test_receipts_round_trip():
+    signer = ReceiptSigner('secret')
+    receipt = signer.issue('TOKEN|1', 'red', '100', claimed_at=1577836800)
+
+    assert receipt.isascii() and '|' not in receipt
+    assert signer.verify(f' {receipt}\n') == {u'receipt_id': receipt.split('.')[1], u'token': 'TOKEN|1',
+                                              u'color': 'red', u'claimant': '100', u'claimed_at': 1577836800}
+
+
+def test_forged_or_malformed_receipts_are_rejected():
+    signer = ReceiptSigner('secret')
+    receipt = signer.issue('TOKEN1', 'red', '100', claimed_at=1577836800)
+    forged = ReceiptSigner('secret').issue('TOKEN1', 'red', '200', claimed_at=1577836800).split('.')[0]
+
+    assert ReceiptSigner('other secret').verify(receipt) is None
+    assert signer.verify(f'{forged}.{receipt.split(".")[1]}') is None
+    assert signer.verify(receipt[:-2]) is None
+    assert signer.verify('not a receipt') is None
+    assert signer.verify('a.b.c') is None
+
+
+def test_revocations_reach_other_processes_on_their_next_sync():
+    backend = LocalBackend()
+    receipt_id = ReceiptSigner('secret').verify(ReceiptSigner('secret').issue('T', 'red', '1'))[u'receipt_id']
+    here, elsewhere = RevocationList(backend), RevocationList(backend)
+
+    here.revoke(receipt_id, revoked_by=1)
+
+    assert here.is_revoked(receipt_id)
+    assert not elsewhere.is_revoked(receipt_id)
+    elsewhere.sync()
+    assert elsewhere.is_revoked(receipt_id)
+
+
+def test_a_failed_sync_keeps_the_last_revocation_list():
+    class FailingBackend(LocalBackend):
+        def get_revoked_receipts(self):
+            raise ConnectionError('unavailable')
+
+    backend = FailingBackend()
+    revocations = RevocationList(backend)
+    revocations.revoke('abc', revoked_by=1)
+    revocations.sync()
+
+    assert revocations.is_revoked('abc')
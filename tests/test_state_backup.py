@@ -0,0 +1,87 @@
+import json
+from collections import Counter
+
+import pytest
+
+import state_backup
+from state_backup import Checkpoint, restore
+
+
+class FakeCollection:
+    def __init__(self, name):
+        self.name = name
+
+    def document(self, doc_id):
+        return (self.name, doc_id)
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, ref, data, merge=False):
+        self.writes.append((ref, data, merge))
+
+    def commit(self):
+        self.db.commits += 1
+        if self.db.commits in self.db.fail:
+            raise ValueError('commit failed')
+
+        for ref, data, merge in self.writes:
+            self.db.written[ref] += 1
+            if merge:
+                self.db.documents.setdefault(ref, {}).update(data)
+            else:
+                self.db.documents[ref] = dict(data)
+
+
+class FakeDb:
+    def __init__(self, fail=()):
+        self.fail = set(fail)  # Numbers of the commits that fail
+        self.commits = 0
+        self.documents = {}
+        self.written = Counter()
+
+    def collection(self, name):
+        return FakeCollection(name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+
+def test_checkpoint_only_advances_past_contiguous_batches(tmp_path):
+    path = str(tmp_path / 'backup.jsonl')
+    checkpoint = Checkpoint(path)
+
+    checkpoint.complete(1, 20)
+    assert checkpoint.lines == 0
+    checkpoint.complete(0, 10)
+    assert checkpoint.lines == 20
+    assert Checkpoint(path).lines == 20
+
+    checkpoint.clear()
+    assert Checkpoint(path).lines == 0
+
+
+def test_interrupted_restore_resumes_after_the_last_committed_batch(tmp_path, monkeypatch):
+    path = str(tmp_path / 'backup.jsonl')
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(5):
+            f.write(json.dumps({'collection': 'participants', 'id': f'{i}', 'data': {'name': f'User{i}'}}) + '\n')
+        f.write(json.dumps({'collection': 'tokens', 'id': 'red', 'token': 'T1', 'data': {'claimed': False}}) + '\n')
+
+    db = FakeDb(fail={2})
+    monkeypatch.setattr(state_backup, 'db', db)
+    with pytest.raises(SystemExit):
+        restore(path, workers=1, batch_size=2)
+    assert Checkpoint(path).lines == 2
+
+    db.fail.clear()
+    restore(path, workers=1, batch_size=2)
+
+    assert db.documents[('participants', '4')] == {'name': 'User4'}
+    assert db.documents[('tokens', 'red')] == {'T1': {'claimed': False}}
+    # The batch committed before the failure is not written again
+    assert db.written[('participants', '0')] == 1
+    assert Checkpoint(path).lines == 0
@@ -0,0 +1,145 @@
+# In-memory index of the `tokens` collection, kept up to date from Firestore snapshot deltas
+# Each colour document maps token -> {claimant, claimed, hash, first_hint, second_hint, third_hint} and optionally
+# the `first_hint_release`, `second_hint_release` and `third_hint_release` times of the hints (see hint_pool.py)
+
+from hint_pool import HintPool
+import threading
+
+
+class TokenIndex:
+    def __init__(self, hint_pool=None):
+        self.lock = threading.Lock()
+        # Notified whenever tokens are applied, so that HintScheduler can pick up earlier release times
+        self.changed = threading.Condition(self.lock)
+        # `ready` is set once any full state has been applied (possibly from an on-disk snapshot),
+        # `synced` once the Firestore listener has delivered its first snapshot
+        self.ready = threading.Event()
+        self.synced = threading.Event()
+
+        self.colors = {}  # colour -> {token: value}
+        self.token_colors = {}  # token -> colour
+        self.unclaimed = set()
+        self.claimed_hashes = {}  # hash -> (token, claimant)
+        self.hint_pool = hint_pool if hint_pool is not None else HintPool()  # Hints of unclaimed tokens only
+
+    def on_snapshot(self, docs, changes, read_time):
+        # Firestore listener callback; the first call delivers every colour document as ADDED
+        with self.lock:
+            if not self.synced.is_set():
+                # Drop colours from the on-disk snapshot that no longer exist in Firestore
+                for color in self.colors.keys() - {doc.id for doc in docs}:
+                    self._apply_color(color, {})
+
+            for change in changes:
+                if change.type.name == 'REMOVED':
+                    self._apply_color(change.document.id, {})
+                else:
+                    self._apply_color(change.document.id, change.document.to_dict() or {})
+
+            self.changed.notify_all()
+
+        self.synced.set()
+        self.ready.set()
+
+    def load(self, colors):
+        # Apply a full {colour: {token: value}} mapping at once, e.g. from a local data file or an on-disk snapshot
+        with self.lock:
+            for color in self.colors.keys() - colors.keys():
+                self._apply_color(color, {})
+            for color, tokens in colors.items():
+                self._apply_color(color, tokens)
+
+            self.changed.notify_all()
+
+        self.ready.set()
+
+    def wait_ready(self, timeout=None):
+        return self.ready.wait(timeout)
+
+    def wait_synced(self, timeout=None):
+        return self.synced.wait(timeout)
+
+    def export(self):
+        with self.lock:
+            return {color: dict(tokens) for color, tokens in self.colors.items()}
+
+    def _apply_color(self, color, tokens):
+        old_tokens = self.colors.get(color, {})
+
+        for token in old_tokens.keys() - tokens.keys():
+            self._remove_token(token, old_tokens[token])
+
+        for token, value in tokens.items():
+            old_value = old_tokens.get(token)
+            if old_value == value:
+                continue
+            if old_value is not None:
+                self._remove_token(token, old_value)
+            self._add_token(color, token, value)
+
+        if tokens:
+            self.colors[color] = tokens
+        else:
+            self.colors.pop(color, None)
+
+    def _add_token(self, color, token, value):
+        self.token_colors[token] = color
+
+        if value[u'claimed'] == False:
+            self.unclaimed.add(token)
+            self.hint_pool.add_token(color, token, value)
+        elif value[u'claimed'] == True:
+            self.claimed_hashes[value[u'hash']] = (token, value[u'claimant'])
+
+    def _remove_token(self, token, value):
+        self.token_colors.pop(token, None)
+        self.unclaimed.discard(token)
+        self.hint_pool.remove_token(token)
+        if value.get(u'hash'):
+            self.claimed_hashes.pop(value[u'hash'], None)
+
+    def mark_claimed(self, token, claimant, verification_hash):
+        # Write-through for our own claims so that they are visible before the listener echoes them
+        with self.lock:
+            color = self.token_colors.get(token)
+            if color is None:
+                return
+
+            value = dict(self.colors[color][token], claimant=f'{claimant}', claimed=True, hash=f'{verification_hash}')
+            self.colors[color] = dict(self.colors[color], **{token: value})
+            self.unclaimed.discard(token)
+            self.hint_pool.remove_token(token)
+            self.claimed_hashes[value[u'hash']] = (token, value[u'claimant'])
+
+    def get_color(self, token):
+        return self.token_colors.get(token)
+
+    def is_token(self, token):
+        return token in self.token_colors
+
+    def is_unclaimed(self, token):
+        return token in self.unclaimed
+
+    def get_hash_claim(self, verification_hash):
+        return self.claimed_hashes.get(verification_hash)
+
+    def all_colors(self):
+        # Copied under the lock, since the listener may add a colour while the caller iterates
+        with self.lock:
+            return sorted(self.colors)
+
+    def all_tokens(self):
+        with self.lock:
+            return list(self.token_colors)
+
+    def unclaimed_tokens(self):
+        with self.lock:
+            return list(self.unclaimed)
+
+    def all_hashes(self):
+        with self.lock:
+            return list(self.claimed_hashes)
+
+    def random_hint(self, user_id=None):
+        with self.lock:
+            return self.hint_pool.choose(user_id)
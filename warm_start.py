@@ -0,0 +1,65 @@
+# On-disk snapshot of the bot's token and participant state, used to warm the caches on startup
+# The snapshot is only a head start: the Firestore listeners reconcile it with the live data right after
+
+import threading
+import logging
+import json
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def load_snapshot(path):
+    # Returns the snapshot, or None if there is no usable snapshot at `path`
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    except FileNotFoundError:
+        return None
+
+    except (OSError, ValueError) as e:
+        logger.warning('Ignoring unreadable state snapshot %s: %s', path, e)
+        return None
+
+
+def save_snapshot(path, connector):
+    # Write to a temporary file first so that a crash never leaves a truncated snapshot behind
+    snapshot = connector.export_snapshot()
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f, default=str)
+    os.replace(tmp_path, path)
+
+
+class SnapshotWriter:
+    def __init__(self, connector, path, interval=300):
+        self.connector = connector
+        self.path = path
+        self.interval = interval  # Unit in seconds
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='SnapshotWriter', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def save(self):
+        try:
+            save_snapshot(self.path, self.connector)
+
+        except Exception as e:
+            logger.warning('Failed to save state snapshot %s: %s', self.path, e)
+
+    def _run(self):
+        # Only snapshot live data, never the stale state loaded from the previous snapshot
+        self.connector.wait_synced()
+
+        self.save()
+        while not self.stop_event.wait(self.interval):
+            self.save()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.connector.wait_synced(0):
+            self.save()